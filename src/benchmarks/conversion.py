@@ -0,0 +1,80 @@
+"""
+Compares the conversion profiles on representative fixtures.
+
+Run with `PYTHONPATH=src python -m benchmarks.conversion`. Requires ffmpeg.
+"""
+
+import asyncio
+import shutil
+import statistics
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+
+from benchmarks.fixtures import FIXTURES, create_fixtures
+from bot.conversion import AudioConverter, conversion_profiles
+
+
+async def _measure(
+    converter: AudioConverter,
+    fixture_file: Path,
+    work_dir: Path,
+) -> tuple[float, int]:
+    input_file = work_dir / fixture_file.name
+    shutil.copy(fixture_file, input_file)
+    try:
+        start = perf_counter()
+        output_file = await converter.convert_to_wave(input_file)
+        duration = perf_counter() - start
+        size = output_file.stat().st_size
+        output_file.unlink()
+        return duration, size
+    finally:
+        input_file.unlink(missing_ok=True)
+
+
+async def _run(fixture_dir: Path | None, iterations: int) -> None:
+    with TemporaryDirectory() as work_path:
+        work_dir = Path(work_path)
+        fixture_files = await create_fixtures(fixture_dir or work_dir)
+
+        click.echo(
+            f"{'fixture':<12} {'profile':<8} {'median ms':>10} {'min ms':>8}"
+            f" {'output KiB':>11} {'input KiB':>10}"
+        )
+        for fixture in FIXTURES:
+            fixture_file = fixture_files[fixture.name]
+            for profile in conversion_profiles.values():
+                converter = AudioConverter(profile)
+                durations = []
+                size = 0
+                for _ in range(iterations):
+                    duration, size = await _measure(converter, fixture_file, work_dir)
+                    durations.append(duration)
+
+                click.echo(
+                    f"{fixture.name:<12} {profile.name:<8}"
+                    f" {statistics.median(durations) * 1000:>10.1f}"
+                    f" {min(durations) * 1000:>8.1f}"
+                    f" {size / 1024:>11.0f}"
+                    f" {fixture_file.stat().st_size / 1024:>10.0f}"
+                )
+
+
+@click.command
+@click.option(
+    "--fixture-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Directory to store and reuse the generated fixtures in",
+)
+@click.option("--iterations", default=5, show_default=True)
+def main(fixture_dir: Path | None, iterations: int) -> None:
+    if fixture_dir:
+        fixture_dir.mkdir(parents=True, exist_ok=True)
+    asyncio.run(_run(fixture_dir, iterations))
+
+
+if __name__ == "__main__":
+    main()
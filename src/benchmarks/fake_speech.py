@@ -0,0 +1,113 @@
+import asyncio
+import random
+from datetime import timedelta
+from typing import TYPE_CHECKING
+
+from bot.recognition import RecognitionBackend, TranscriptionCanceledError
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterable, Callable
+    from pathlib import Path
+
+    from bot.conversion import CompressedFormat
+
+
+class FakeRecognitionBackend(RecognitionBackend):
+    """
+    Local stand-in for a speech service endpoint, to simulate slow or failing
+    regions without talking to Azure.
+
+    Recognizes a fixed transcript phrase by phrase, taking `latency` in total.
+    Streamed audio is consumed completely, like the real service would.
+    """
+
+    def __init__(
+        self,
+        name: str = "fake",
+        *,
+        weight: int = 100,
+        transcript: str = "Das ist nur ein Test.",
+        language: str = "de-DE",
+        latency: timedelta = timedelta(seconds=1),
+        failure_rate: float = 0.0,
+        phrases: int = 3,
+    ) -> None:
+        super().__init__(name, weight=weight)
+        self.transcript = transcript
+        self.language = language
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.phrases = phrases
+        self.recognitions = 0
+
+    async def recognize_file(
+        self,
+        audio_file: Path,
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        return await self._recognize(
+            locale,
+            on_phrase=on_phrase,
+            on_language=on_language,
+        )
+
+    async def recognize_stream(
+        self,
+        chunks: AsyncIterable[bytes],
+        audio_format: CompressedFormat | None,
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        async def consume() -> None:
+            async for _ in chunks:
+                pass
+
+        consumer = asyncio.create_task(consume())
+        try:
+            result = await self._recognize(
+                locale,
+                on_phrase=on_phrase,
+                on_language=on_language,
+            )
+        except BaseException:
+            consumer.cancel()
+            raise
+
+        # Propagates download/conversion errors
+        await consumer
+        return result
+
+    async def _recognize(
+        self,
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        self.recognitions += 1
+        latency = self.latency.total_seconds()
+        if random.random() < self.failure_rate:
+            await asyncio.sleep(latency / 2)
+            raise TranscriptionCanceledError(
+                reason="CancellationReason.Error",
+                error_code="CancellationErrorCode.ServiceTimeout",
+                error_details="Simulated failure",
+            )
+
+        words = self.transcript.split()
+        phrase_count = max(1, min(self.phrases, len(words)))
+        phrase_length = -(-len(words) // phrase_count)
+        for index in range(0, len(words), phrase_length):
+            await asyncio.sleep(latency / phrase_count)
+            if on_phrase is not None:
+                on_phrase(" ".join(words[index : index + phrase_length]))
+
+        if locale is None and on_language is not None:
+            on_language(self.language)
+
+        return self.transcript or None
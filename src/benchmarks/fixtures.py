@@ -0,0 +1,118 @@
+import asyncio
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+# Speech-like signal: a tone with a syllable-rate tremolo, pauses and some noise
+_SPEECH_SOURCE = (
+    "sine=frequency=220:sample_rate=48000,"
+    "tremolo=f=4:d=0.9,"
+    "volume='if(lt(mod(t,6),4.5),1,0)':eval=frame"
+)
+_NOISE_SOURCE = "anoisesrc=color=pink:amplitude=0.02:sample_rate=48000"
+
+
+@dataclass(frozen=True)
+class Fixture:
+    name: str
+    file_name: str
+    duration: int
+    output_args: tuple[str, ...]
+    extra_input_args: tuple[str, ...] = ()
+
+
+# Roughly what Telegram sends us for each message type
+FIXTURES = [
+    Fixture(
+        name="voice",
+        file_name="voice.oga",
+        duration=30,
+        output_args=("-c:a", "libopus", "-b:a", "32k", "-ac", "1", "-f", "ogg"),
+    ),
+    Fixture(
+        name="audio",
+        file_name="audio.mp3",
+        duration=180,
+        output_args=(
+            "-c:a",
+            "libmp3lame",
+            "-b:a",
+            "192k",
+            "-ac",
+            "2",
+            "-ar",
+            "44100",
+        ),
+    ),
+    Fixture(
+        name="video_note",
+        file_name="video_note.mp4",
+        duration=30,
+        extra_input_args=("-f", "lavfi", "-i", "testsrc2=size=384x384:rate=30"),
+        output_args=(
+            "-map",
+            "2:v",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "veryfast",
+            "-pix_fmt",
+            "yuv420p",
+            "-c:a",
+            "aac",
+            "-b:a",
+            "64k",
+            "-ac",
+            "1",
+            "-movflags",
+            "+faststart",
+        ),
+    ),
+]
+
+
+async def create_fixture(fixture: Fixture, directory: Path) -> Path:
+    path = directory / fixture.file_name
+    if path.exists():
+        return path
+
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg",
+        "-nostdin",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-f",
+        "lavfi",
+        "-i",
+        _SPEECH_SOURCE,
+        "-f",
+        "lavfi",
+        "-i",
+        _NOISE_SOURCE,
+        *fixture.extra_input_args,
+        "-filter_complex",
+        "[0:a][1:a]amix=inputs=2:duration=first[audio]",
+        "-map",
+        "[audio]",
+        *fixture.output_args,
+        "-t",
+        str(fixture.duration),
+        "-y",
+        path,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+    if process.returncode:
+        raise OSError(f"Could not create fixture {fixture.name}: {stderr.decode()}")
+
+    return path
+
+
+async def create_fixtures(directory: Path) -> dict[str, Path]:
+    paths = await asyncio.gather(
+        *(create_fixture(fixture, directory) for fixture in FIXTURES)
+    )
+    return {fixture.name: path for fixture, path in zip(FIXTURES, paths, strict=True)}
@@ -0,0 +1,687 @@
+"""
+Drives messages through the whole pipeline of the bot, from the download to
+the reply, at fixed concurrency levels.
+
+Run with `PYTHONPATH=src python -m benchmarks.pipeline`. Requires ffmpeg.
+Telegram, the speech service, Redis and Postgres are replaced by local
+stand-ins (see `benchmarks.standins`), so only the work done in the bot and
+its subprocesses is measured, plus the configured fake latencies.
+"""
+
+import asyncio
+import itertools
+import os
+import statistics
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import monotonic
+from typing import TYPE_CHECKING
+
+import click
+import httpx
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+    InMemorySpanExporter,
+)
+from telegram import Audio, Chat, Message, User, VideoNote, Voice
+from telegram.constants import ChatType
+
+from benchmarks.fake_speech import FakeRecognitionBackend
+from benchmarks.fixtures import FIXTURES, Fixture, create_fixtures
+from benchmarks.standins import (
+    FakeFile,
+    FakeTelegramBot,
+    MemoryGreenlistStorage,
+    MemoryRateLimitingRepo,
+    MemoryRedis,
+    serve_files,
+)
+from bot.bot import Bot
+from bot.cache import TranscriptCache
+from bot.coalescing import TranscriptionCoalescer
+from bot.config import (
+    ArtifactCacheConfig,
+    AzureTtsConfig,
+    CoalescingConfig,
+    Config,
+    DatabaseConfig,
+    HedgingConfig,
+    LocaleLearningConfig,
+    LongAudioConfig,
+    OutboxConfig,
+    OverflowPolicy,
+    ProfilingConfig,
+    RateLimitConfig,
+    RecognizerPoolConfig,
+    RedisStateConfig,
+    SchedulerConfig,
+    SilenceTrimmingConfig,
+    SpeechEndpointConfig,
+    TelegramConfig,
+    TracingConfig,
+    TranscriptCacheConfig,
+)
+from bot.conversion import conversion_profiles
+from bot.greenlist import Greenlist
+from bot.locale_learning import LocaleLearner
+from bot.speech import Transcriber
+from bot.usage import UsageTracker
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+_KEY_PREFIX = "benchmark"
+_PERCENTILES = (50, 90, 99)
+_DISK_SAMPLE_INTERVAL = timedelta(milliseconds=50)
+# Short enough to see most ffmpeg processes, which are gone after a few 100 ms
+_MEMORY_SAMPLE_INTERVAL = timedelta(milliseconds=10)
+# Generous, a stuck message should fail the run rather than hang it
+_RESPONSE_TIMEOUT = timedelta(minutes=5)
+
+
+@dataclass(frozen=True)
+class _Latencies:
+    telegram_api: timedelta
+    telegram_download: timedelta
+    recognition: timedelta
+
+
+@dataclass
+class _MemoryPeaks:
+    # Levels share the process, so its growth during a level is reported too
+    start_rss_bytes: int
+    rss_bytes: int = 0
+    ffmpeg_bytes: int = 0
+
+
+@dataclass
+class _Run:
+    concurrency: int
+    duration: float
+    latencies: list[float]
+    outcomes: Counter[str]
+    peak_scratch_bytes: int
+    memory: _MemoryPeaks
+
+
+def _file_url(fixture_file: Path) -> str:
+    return f"https://api.telegram.org/file/bot-benchmark/{fixture_file.name}"
+
+
+def _create_config(
+    *,
+    scratch_dir: Path,
+    conversion_profile: str,
+    streaming: bool,
+    passthrough: bool,
+    trim_silence: bool,
+) -> Config:
+    hedging = HedgingConfig(
+        enabled=False,
+        percentile=95,
+        default_delay=timedelta(seconds=3),
+        min_delay=timedelta(milliseconds=500),
+        max_delay=timedelta(seconds=10),
+        failure_threshold=5,
+        open_duration=timedelta(seconds=30),
+    )
+    return Config(
+        artifact_cache=ArtifactCacheConfig(
+            enabled=True,
+            max_bytes=512 * 1024 * 1024,
+            max_age=timedelta(hours=1),
+        ),
+        # Never started, the speech service is replaced after creating the bot
+        azure_tts=AzureTtsConfig(
+            endpoints=[
+                SpeechEndpointConfig(region="benchmark", key="unused", weight=100)
+            ],
+            hedging=hedging,
+        ),
+        coalescing=CoalescingConfig(
+            redis_lease=False,
+            lease_ttl=timedelta(seconds=60),
+        ),
+        compressed_passthrough=passthrough,
+        conversion_profile=conversion_profile,
+        database=DatabaseConfig(db_host="", db_name="", db_user="", db_password=""),
+        enable_telemetry=False,
+        locale_learning=LocaleLearningConfig(
+            enabled=True,
+            min_observations=3,
+            min_share_percent=80,
+            redetect_percent=10,
+        ),
+        long_audio=LongAudioConfig(
+            min_duration=180,
+            max_segment_duration=60,
+            max_parallel_segments=4,
+            silence_threshold_db=-40,
+        ),
+        # Never connected, messages are passed to the bot directly
+        nats=None,  # type: ignore[arg-type]
+        # Telegram's limits would only measure the token buckets
+        outbox=OutboxConfig(
+            global_rate=10_000,
+            private_chat_rate=10_000,
+            group_chat_rate=10_000,
+            max_concurrent_sends=4,
+        ),
+        profiling=ProfilingConfig(
+            stall_threshold=timedelta(milliseconds=250),
+            sample_interval=timedelta(milliseconds=10),
+            max_duration=timedelta(minutes=2),
+        ),
+        progressive_replies=False,
+        rate_limit=RateLimitConfig(daily=10),
+        recognizer_pool=RecognizerPoolConfig(
+            size=0,
+            idle_timeout=timedelta(minutes=2),
+            formats=[],
+            locales=[],
+        ),
+        redis=RedisStateConfig(host="", username=_KEY_PREFIX, password=""),
+        scheduler=SchedulerConfig(
+            download_workers=4,
+            conversion_workers=2,
+            transcription_workers=8,
+            queue_size=16,
+            overflow_policy=OverflowPolicy.QUEUE,
+            deadline_base=timedelta(seconds=60),
+            deadline_audio_percent=200,
+        ),
+        scratch_dir=scratch_dir,
+        sentry=None,
+        silence_trimming=SilenceTrimmingConfig(
+            enabled=trim_silence,
+            threshold_db=-40,
+            padding_ms=300,
+            min_silence_ms=500,
+        ),
+        streaming_pipeline=streaming,
+        telegram=TelegramConfig(admin_id=0, token=""),
+        tracing=TracingConfig(
+            sample_percent=100,
+            slow_threshold=timedelta(seconds=20),
+            max_buffered_traces=512,
+        ),
+        transcript_cache=TranscriptCacheConfig(
+            memory_entries=512,
+            redis_entries=10_000,
+            ttl=timedelta(days=7),
+        ),
+    )
+
+
+async def _create_bot(
+    config: Config,
+    *,
+    chat_ids: Sequence[int],
+    latencies: _Latencies,
+    fixture_files: dict[str, Path],
+) -> Bot:
+    """Like `Bot._init`, but with the stand-ins."""
+    bot = Bot(config)
+    redis = MemoryRedis()
+    bot.redis = redis  # type: ignore[assignment]
+    bot.greenlist = Greenlist(
+        MemoryGreenlistStorage(set(chat_ids)),
+        redis=redis,  # type: ignore[arg-type]
+        key_prefix=_KEY_PREFIX,
+    )
+    # Without the change notifications, those need a real Redis
+    await bot.greenlist.refresh()
+    bot.transcript_cache = TranscriptCache(
+        config.transcript_cache,
+        redis=redis,  # type: ignore[arg-type]
+        key_prefix=_KEY_PREFIX,
+    )
+    bot.coalescer = TranscriptionCoalescer(
+        config.coalescing,
+        cache=bot.transcript_cache,
+        redis=redis,  # type: ignore[arg-type]
+        key_prefix=_KEY_PREFIX,
+    )
+    bot.locale_learner = LocaleLearner(
+        config.locale_learning,
+        redis=redis,  # type: ignore[arg-type]
+        key_prefix=_KEY_PREFIX,
+    )
+    bot.usage_tracker = UsageTracker(MemoryRateLimitingRepo(), config.rate_limit)
+    bot.usage_tracker.start()
+    bot.http_client = serve_files(
+        {httpx.URL(_file_url(path)).path: path for path in fixture_files.values()},
+        latency=latencies.telegram_download,
+    )
+    bot.transcriber = Transcriber(
+        [FakeRecognitionBackend(latency=latencies.recognition)],
+        hedging=config.azure_tts.hedging,
+    )
+    await bot.artifact_cache.start()
+    bot.outbox.start()
+    bot.transcriber.start()
+    return bot
+
+
+async def _close_bot(bot: Bot) -> None:
+    await bot.outbox.close()
+    await bot.http_client.aclose()
+    await bot.transcriber.close()
+    await bot.usage_tracker.close()
+
+
+def _create_file(
+    fixture: Fixture,
+    fixture_file: Path,
+    *,
+    index: int,
+) -> Voice | Audio | VideoNote:
+    # Unique IDs, so neither the caches nor the coalescing skip any work
+    file_id = f"{fixture.name}-{index}"
+    file_unique_id = f"unique-{file_id}"
+    file_size = fixture_file.stat().st_size
+    match fixture.name:
+        case "voice":
+            return Voice(
+                file_id=file_id,
+                file_unique_id=file_unique_id,
+                duration=fixture.duration,
+                mime_type="audio/ogg",
+                file_size=file_size,
+            )
+        case "audio":
+            return Audio(
+                file_id=file_id,
+                file_unique_id=file_unique_id,
+                duration=fixture.duration,
+                mime_type="audio/mpeg",
+                file_size=file_size,
+            )
+        case _:
+            return VideoNote(
+                file_id=file_id,
+                file_unique_id=file_unique_id,
+                length=384,
+                duration=fixture.duration,
+                file_size=file_size,
+            )
+
+
+def _create_message(
+    telegram: FakeTelegramBot,
+    file: Voice | Audio | VideoNote,
+    *,
+    chat_id: int,
+) -> Message:
+    message = Message(
+        message_id=chat_id,
+        date=datetime.now(UTC),
+        chat=Chat(id=chat_id, type=ChatType.PRIVATE),
+        # One user per message, so the daily limit doesn't kick in
+        from_user=User(id=chat_id, first_name="Bench", is_bot=False),
+        voice=file if isinstance(file, Voice) else None,
+        audio=file if isinstance(file, Audio) else None,
+        video_note=file if isinstance(file, VideoNote) else None,
+    )
+    message.set_bot(telegram)  # type: ignore[arg-type]
+    file.set_bot(telegram)  # type: ignore[arg-type]
+    return message
+
+
+def _directory_size(directory: Path) -> int:
+    size = 0
+    for path in directory.rglob("*"):
+        try:
+            if path.is_file():
+                size += path.stat().st_size
+        except FileNotFoundError:
+            # Removed while walking
+            pass
+    return size
+
+
+async def _sample_disk_usage(directory: Path, peak: list[int]) -> None:
+    while True:
+        size = await asyncio.to_thread(_directory_size, directory)
+        peak[0] = max(peak[0], size)
+        await asyncio.sleep(_DISK_SAMPLE_INTERVAL.total_seconds())
+
+
+def _status_bytes(pid: int | str, field: str) -> int | None:
+    try:
+        with Path(f"/proc/{pid}/status").open() as f:
+            for line in f:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        # Already reaped
+        pass
+    # Exited processes don't have memory fields anymore
+    return None
+
+
+def _ffmpeg_pids() -> list[int]:
+    own_pid = os.getpid()
+    pids = []
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+
+        # The name is in parentheses and may contain spaces
+        name = stat[stat.index("(") + 1 : stat.rindex(")")]
+        _state, parent_pid, *_ = stat[stat.rindex(")") + 2 :].split()
+        if name == "ffmpeg" and int(parent_pid) == own_pid:
+            pids.append(int(entry.name))
+    return pids
+
+
+def _sample_memory_usage_once(peaks: _MemoryPeaks) -> None:
+    # getrusage only has peaks over the lifetime of the process, and the peak
+    # of a child includes the parent's from before the exec
+    if (rss := _status_bytes("self", "VmRSS")) is not None:
+        peaks.rss_bytes = max(peaks.rss_bytes, rss)
+
+    for pid in _ffmpeg_pids():
+        # The high water mark of the process since the exec
+        if (peak := _status_bytes(pid, "VmHWM")) is not None:
+            peaks.ffmpeg_bytes = max(peaks.ffmpeg_bytes, peak)
+
+
+async def _sample_memory_usage(peaks: _MemoryPeaks) -> None:
+    while True:
+        await asyncio.to_thread(_sample_memory_usage_once, peaks)
+        await asyncio.sleep(_MEMORY_SAMPLE_INTERVAL.total_seconds())
+
+
+async def _process(
+    bot: Bot,
+    telegram: FakeTelegramBot,
+    message: Message,
+    file: Voice | Audio | VideoNote,
+) -> tuple[float, str]:
+    started_at = monotonic()
+    response = telegram.expect_response(message.chat.id)
+    try:
+        await bot._process_message(
+            message,
+            file,
+            update_id=message.message_id,
+            locale=None,
+        )
+        async with asyncio.timeout(_RESPONSE_TIMEOUT.total_seconds()):
+            outcome = await response
+    except Exception as e:
+        outcome = f"error {type(e).__name__}"
+
+    return monotonic() - started_at, outcome
+
+
+async def _run_level(
+    bot: Bot,
+    telegram: FakeTelegramBot,
+    *,
+    concurrency: int,
+    messages: list[tuple[Message, Voice | Audio | VideoNote]],
+    scratch_dir: Path,
+) -> _Run:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(
+        message: Message,
+        file: Voice | Audio | VideoNote,
+    ) -> tuple[float, str]:
+        async with semaphore:
+            return await _process(bot, telegram, message, file)
+
+    peak_scratch_bytes = [0]
+    memory = _MemoryPeaks(start_rss_bytes=_status_bytes("self", "VmRSS") or 0)
+    samplers = [
+        asyncio.create_task(_sample_disk_usage(scratch_dir, peak_scratch_bytes)),
+        asyncio.create_task(_sample_memory_usage(memory)),
+    ]
+    started_at = monotonic()
+    try:
+        results = await asyncio.gather(
+            *(process(message, file) for message, file in messages)
+        )
+    finally:
+        duration = monotonic() - started_at
+        for sampler in samplers:
+            sampler.cancel()
+        await asyncio.gather(*samplers, return_exceptions=True)
+
+    return _Run(
+        concurrency=concurrency,
+        duration=duration,
+        latencies=[latency for latency, _ in results],
+        outcomes=Counter(outcome for _, outcome in results),
+        peak_scratch_bytes=peak_scratch_bytes[0],
+        memory=memory,
+    )
+
+
+def _percentiles(values: list[float]) -> list[float]:
+    if len(values) < 2:
+        return [values[0] if values else 0.0] * len(_PERCENTILES)
+
+    cut_points = statistics.quantiles(values, n=100, method="inclusive")
+    return [cut_points[percentile - 1] for percentile in _PERCENTILES]
+
+
+def _stage_latencies(exporter: InMemorySpanExporter) -> dict[str, list[float]]:
+    durations: defaultdict[str, list[float]] = defaultdict(list)
+    for span in exporter.get_finished_spans():
+        if span.start_time is not None and span.end_time is not None:
+            durations[span.name].append((span.end_time - span.start_time) / 1e9)
+    exporter.clear()
+    return durations
+
+
+def _echo_latencies(name: str, durations: list[float]) -> None:
+    percentiles = "".join(f" {value * 1000:>9.1f}" for value in _percentiles(durations))
+    click.echo(
+        f"  {name:<28} {len(durations):>6}{percentiles} {max(durations) * 1000:>9.1f}"
+    )
+
+
+def _echo_run(run: _Run, stages: dict[str, list[float]]) -> None:
+    outcomes = ", ".join(f"{count}x {name}" for name, count in run.outcomes.items())
+    click.echo(
+        f"concurrency {run.concurrency}:"
+        f" {len(run.latencies) / run.duration:.2f} msgs/s ({outcomes})"
+    )
+    memory = run.memory
+    sample_ms = int(_MEMORY_SAMPLE_INTERVAL.total_seconds() * 1000)
+    click.echo(
+        f"  peak RSS {memory.rss_bytes / 1024 / 1024:.1f} MiB"
+        f" (+{(memory.rss_bytes - memory.start_rss_bytes) / 1024 / 1024:.1f} MiB),"
+        f" largest ffmpeg {memory.ffmpeg_bytes / 1024 / 1024:.1f} MiB"
+        f" (sampled every {sample_ms} ms),"
+        f" peak scratch disk {run.peak_scratch_bytes / 1024 / 1024:.1f} MiB"
+        " (incl. artifact cache)"
+    )
+
+    percentile_header = "".join(f" {f'p{p} ms':>9}" for p in _PERCENTILES)
+    click.echo(f"  {'stage':<28} {'count':>6}{percentile_header} {'max ms':>9}")
+    _echo_latencies("end to end", run.latencies)
+    for name, durations in sorted(
+        stages.items(),
+        key=lambda item: statistics.median(item[1]),
+        reverse=True,
+    ):
+        _echo_latencies(name, durations)
+
+
+async def _run(
+    *,
+    fixture_dir: Path | None,
+    fixture_names: Sequence[str],
+    concurrency_levels: Sequence[int],
+    messages_per_level: int,
+    latencies: _Latencies,
+    conversion_profile: str,
+    streaming: bool,
+    passthrough: bool,
+    trim_silence: bool,
+) -> None:
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    # The pipeline's own spans are the stage measurements
+    trace.set_tracer_provider(provider)
+
+    with TemporaryDirectory() as work_path:
+        work_dir = Path(work_path)
+        scratch_dir = work_dir / "scratch"
+        scratch_dir.mkdir()
+        fixture_files = await create_fixtures(fixture_dir or work_dir)
+        fixtures = [fixture for fixture in FIXTURES if fixture.name in fixture_names]
+
+        telegram = FakeTelegramBot(latency=latencies.telegram_api)
+        chat_ids = itertools.count(1)
+        levels: list[list[tuple[Message, Voice | Audio | VideoNote]]] = []
+        for _ in concurrency_levels:
+            messages = []
+            for index in range(messages_per_level):
+                chat_id = next(chat_ids)
+                fixture = fixtures[index % len(fixtures)]
+                fixture_file = fixture_files[fixture.name]
+                file = _create_file(fixture, fixture_file, index=chat_id)
+                telegram.add_file(
+                    FakeFile(
+                        file_id=file.file_id,
+                        file_size=file.file_size or 0,
+                        file_path=_file_url(fixture_file),
+                        source=fixture_file,
+                        latency=latencies.telegram_download,
+                    )
+                )
+                messages.append(
+                    (_create_message(telegram, file, chat_id=chat_id), file)
+                )
+            levels.append(messages)
+
+        config = _create_config(
+            scratch_dir=scratch_dir,
+            conversion_profile=conversion_profile,
+            streaming=streaming,
+            passthrough=passthrough,
+            trim_silence=trim_silence,
+        )
+        bot = await _create_bot(
+            config,
+            chat_ids=[
+                message.chat.id for messages in levels for message, _ in messages
+            ],
+            latencies=latencies,
+            fixture_files=fixture_files,
+        )
+        try:
+            for concurrency, messages in zip(concurrency_levels, levels, strict=True):
+                run = await _run_level(
+                    bot,
+                    telegram,
+                    concurrency=concurrency,
+                    messages=messages,
+                    scratch_dir=scratch_dir,
+                )
+                _echo_run(run, _stage_latencies(exporter))
+        finally:
+            await _close_bot(bot)
+            provider.shutdown()
+
+
+def _parse_levels(_: click.Context, __: click.Parameter, value: str) -> list[int]:
+    try:
+        levels = [int(level) for level in value.split(",")]
+    except ValueError as e:
+        raise click.BadParameter("must be a comma-separated list of numbers") from e
+
+    if any(level < 1 for level in levels):
+        raise click.BadParameter("must be positive")
+    return levels
+
+
+@click.command
+@click.option(
+    "--fixture-dir",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Reuses generated fixtures across runs",
+)
+@click.option(
+    "--fixture",
+    "fixture_names",
+    type=click.Choice([fixture.name for fixture in FIXTURES]),
+    multiple=True,
+    default=[fixture.name for fixture in FIXTURES],
+    show_default=True,
+)
+@click.option(
+    "--concurrency",
+    "concurrency_levels",
+    default="1,4,16",
+    show_default=True,
+    callback=_parse_levels,
+)
+@click.option("--messages", "messages_per_level", default=24, show_default=True)
+@click.option("--telegram-api-latency-ms", default=50, show_default=True)
+@click.option("--telegram-download-latency-ms", default=100, show_default=True)
+@click.option("--recognition-latency-ms", default=1000, show_default=True)
+@click.option(
+    "--conversion-profile",
+    type=click.Choice(list(conversion_profiles)),
+    default="speech",
+    show_default=True,
+)
+@click.option("--streaming/--no-streaming", default=False, show_default=True)
+@click.option("--passthrough/--no-passthrough", default=True, show_default=True)
+@click.option(
+    "--trim-silence/--no-trim-silence",
+    default=False,
+    show_default=True,
+    help="Trimming decodes all audio, so it turns off passthrough",
+)
+def main(
+    fixture_dir: Path | None,
+    fixture_names: tuple[str, ...],
+    concurrency_levels: list[int],
+    messages_per_level: int,
+    telegram_api_latency_ms: int,
+    telegram_download_latency_ms: int,
+    recognition_latency_ms: int,
+    conversion_profile: str,
+    streaming: bool,
+    passthrough: bool,
+    trim_silence: bool,
+) -> None:
+    asyncio.run(
+        _run(
+            fixture_dir=fixture_dir,
+            fixture_names=fixture_names,
+            concurrency_levels=concurrency_levels,
+            messages_per_level=messages_per_level,
+            latencies=_Latencies(
+                telegram_api=timedelta(milliseconds=telegram_api_latency_ms),
+                telegram_download=timedelta(milliseconds=telegram_download_latency_ms),
+                recognition=timedelta(milliseconds=recognition_latency_ms),
+            ),
+            conversion_profile=conversion_profile,
+            streaming=streaming,
+            passthrough=passthrough,
+            trim_silence=trim_silence,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
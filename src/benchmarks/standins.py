@@ -0,0 +1,357 @@
+"""
+Local stand-ins for the services the bot talks to, so the whole pipeline can
+run offline.
+"""
+
+import asyncio
+import shutil
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+from typing import TYPE_CHECKING, Any
+
+import httpx
+from rate_limiter import RateLimitingRepo, Usage
+from telegram import Chat, Message
+from telegram.constants import ChatType
+
+from bot.state import GreenlistSnapshot, GreenlistStorage
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+    from pathlib import Path
+
+
+class MemoryRedis:
+    """
+    The part of the asyncio Redis client the bot uses, kept in a dict.
+
+    Expiration is ignored, a benchmark doesn't run long enough to notice.
+    """
+
+    def __init__(self) -> None:
+        self._values: dict[str, str] = {}
+        self._hashes: dict[str, dict[str, str]] = {}
+        self._sorted_sets: dict[str, dict[str, float]] = {}
+
+    def _stores(self) -> tuple[dict[str, Any], ...]:
+        return self._values, self._hashes, self._sorted_sets
+
+    async def get(self, key: str) -> str | None:
+        return self._values.get(key)
+
+    async def set(
+        self,
+        key: str,
+        value: Any,
+        *,
+        ex: timedelta | int | None = None,
+        px: timedelta | int | None = None,
+        nx: bool = False,
+    ) -> bool | None:
+        if nx and key in self._values:
+            return None
+
+        self._values[key] = str(value)
+        return True
+
+    async def exists(self, *keys: str) -> int:
+        return sum(any(key in store for store in self._stores()) for key in keys)
+
+    async def delete(self, *keys: str) -> int:
+        deleted = 0
+        for key in keys:
+            for store in self._stores():
+                if store.pop(key, None) is not None:
+                    deleted += 1
+        return deleted
+
+    async def incr(self, key: str) -> int:
+        value = int(self._values.get(key, 0)) + 1
+        self._values[key] = str(value)
+        return value
+
+    async def publish(self, channel: str, message: str) -> int:
+        return 0
+
+    async def hgetall(self, key: str) -> dict[str, str]:
+        return dict(self._hashes.get(key, {}))
+
+    async def hincrby(self, key: str, name: str, amount: int = 1) -> int:
+        values = self._hashes.setdefault(key, {})
+        value = int(values.get(name, 0)) + amount
+        values[name] = str(value)
+        return value
+
+    async def hset(
+        self,
+        key: str,
+        name: str | None = None,
+        value: Any = None,
+        *,
+        mapping: dict[str, Any] | None = None,
+    ) -> int:
+        items = dict(mapping or {})
+        if name is not None:
+            items[name] = value
+
+        values = self._hashes.setdefault(key, {})
+        added = sum(name not in values for name in items)
+        values.update((name, str(value)) for name, value in items.items())
+        return added
+
+    async def hdel(self, key: str, *names: str) -> int:
+        values = self._hashes.get(key, {})
+        return sum(values.pop(name, None) is not None for name in names)
+
+    async def zadd(self, key: str, mapping: dict[str, float]) -> int:
+        members = self._sorted_sets.setdefault(key, {})
+        added = sum(member not in members for member in mapping)
+        members.update(mapping)
+        return added
+
+    async def zremrangebyscore(
+        self,
+        key: str,
+        min: float | str,
+        max: float | str,
+    ) -> int:
+        members = self._sorted_sets.get(key, {})
+        removed = [
+            member
+            for member, score in members.items()
+            if float(min) <= score <= float(max)
+        ]
+        for member in removed:
+            del members[member]
+        return len(removed)
+
+    async def zcard(self, key: str) -> int:
+        return len(self._sorted_sets.get(key, {}))
+
+    async def zpopmin(self, key: str, count: int = 1) -> list[tuple[str, float]]:
+        members = self._sorted_sets.get(key, {})
+        popped = sorted(members.items(), key=lambda item: item[1])[:count]
+        for member, _ in popped:
+            del members[member]
+        return popped
+
+    def register_script(self, script: str) -> Callable[..., Awaitable[int]]:
+        """
+        Supports the scripts of the transcription lease, which extend or
+        delete a key only if it still holds the given token.
+        """
+        is_release = 'redis.call("del"' in script
+        if not is_release and 'redis.call("pexpire"' not in script:
+            raise NotImplementedError("Only the transcription lease is supported")
+
+        async def run(*, keys: list[str], args: list[Any]) -> int:
+            [key] = keys
+            if self._values.get(key) != str(args[0]):
+                return 0
+
+            if is_release:
+                del self._values[key]
+            return 1
+
+        return run
+
+    def pipeline(self, transaction: bool = True) -> MemoryPipeline:
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline:
+    """Queues commands and runs them one after another on `execute`."""
+
+    def __init__(self, redis: MemoryRedis) -> None:
+        self._redis = redis
+        self._commands: list[tuple[str, tuple[Any, ...], dict[str, Any]]] = []
+
+    async def __aenter__(self) -> MemoryPipeline:
+        return self
+
+    async def __aexit__(self, *_: object) -> None:
+        self._commands = []
+
+    def __getattr__(self, name: str) -> Callable[..., MemoryPipeline]:
+        def queue(*args: Any, **kwargs: Any) -> MemoryPipeline:
+            self._commands.append((name, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self) -> list[Any]:
+        commands, self._commands = self._commands, []
+        return [
+            await getattr(self._redis, name)(*args, **kwargs)
+            for name, args, kwargs in commands
+        ]
+
+
+class MemoryGreenlistStorage(GreenlistStorage):
+    def __init__(self, allowed_chat_ids: set[int] | None = None) -> None:
+        self._allowed_chat_ids = set(allowed_chat_ids or ())
+        self._informed_chats: set[int] = set()
+
+    async def load(self) -> GreenlistSnapshot:
+        return GreenlistSnapshot(
+            allowed_chat_ids=frozenset(self._allowed_chat_ids),
+            informed_chats=frozenset(self._informed_chats),
+        )
+
+    async def is_allowed(self, chat_id: int) -> bool:
+        return chat_id in self._allowed_chat_ids
+
+    async def allow(self, chat_id: int) -> None:
+        self._allowed_chat_ids.add(chat_id)
+        self._informed_chats.discard(chat_id)
+
+    async def deny(self, chat_id: int) -> None:
+        self._allowed_chat_ids.discard(chat_id)
+
+    async def informed_chat(self, chat_id: int) -> bool:
+        if chat_id in self._informed_chats:
+            return False
+
+        self._informed_chats.add(chat_id)
+        return True
+
+
+class MemoryRateLimitingRepo(RateLimitingRepo):
+    """Keeps usages in a list instead of Postgres."""
+
+    def __init__(self) -> None:
+        self.usages: list[Usage] = []
+
+    async def get_usages(
+        self,
+        context_id: str,
+        user_id: int,
+        limit: int = 1,
+    ) -> list[Usage]:
+        usages = [
+            usage
+            for usage in self.usages
+            if usage.context_id == context_id and usage.user_id == user_id
+        ]
+        usages.sort(key=lambda usage: usage.time, reverse=True)
+        return usages[:limit]
+
+    async def add_usage(
+        self,
+        context_id: str,
+        user_id: int,
+        utc_time: datetime,
+        reference_id: str | None = None,
+        response_id: str | None = None,
+    ) -> Usage:
+        usage = Usage(
+            context_id=context_id,
+            user_id=user_id,
+            time=utc_time,
+            reference_id=reference_id,
+            response_id=response_id,
+        )
+        self.usages.append(usage)
+        return usage
+
+    async def delete_old_usages(self, retention_time: timedelta) -> None:
+        oldest_allowed = datetime.now(UTC) - retention_time
+        self.usages = [usage for usage in self.usages if usage.time >= oldest_allowed]
+
+    async def close(self) -> None:
+        pass
+
+
+@dataclass
+class FakeFile:
+    """What `get_file` returns, the downloadable version of a Telegram file."""
+
+    file_id: str
+    file_size: int
+    file_path: str
+    source: Path
+    latency: timedelta
+
+    async def download_to_drive(self, custom_path: Path) -> Path:
+        await asyncio.sleep(self.latency.total_seconds())
+        await asyncio.to_thread(shutil.copyfile, self.source, custom_path)
+        return custom_path
+
+
+class FakeTelegramBot:
+    """
+    Answers the Bot API calls of the pipeline locally.
+
+    Every message is expected in its own chat, so a response can be told apart
+    by its chat ID. The final response of a chat (a reply or a reaction other
+    than "queued") resolves the future returned by `expect_response`.
+    """
+
+    def __init__(self, *, latency: timedelta) -> None:
+        self._latency = latency.total_seconds()
+        self._files: dict[str, FakeFile] = {}
+        self._responses: dict[int, asyncio.Future[str]] = {}
+        self._next_message_id = 1_000_000
+
+    def add_file(self, file: FakeFile) -> None:
+        self._files[file.file_id] = file
+
+    def expect_response(self, chat_id: int) -> asyncio.Future[str]:
+        done = asyncio.get_running_loop().create_future()
+        self._responses[chat_id] = done
+        return done
+
+    def _respond(self, chat_id: int, outcome: str) -> None:
+        done = self._responses.pop(chat_id, None)
+        if done is not None and not done.done():
+            done.set_result(outcome)
+
+    async def get_file(self, file_id: str, **_: Any) -> FakeFile:
+        await asyncio.sleep(self._latency)
+        return self._files[file_id]
+
+    async def send_message(self, chat_id: int, text: str, **_: Any) -> Message:
+        await asyncio.sleep(self._latency)
+        self._next_message_id += 1
+        message = Message(
+            message_id=self._next_message_id,
+            date=datetime.now(UTC),
+            chat=Chat(id=chat_id, type=ChatType.PRIVATE),
+            text=text,
+        )
+        self._respond(chat_id, "reply")
+        return message
+
+    async def set_message_reaction(
+        self,
+        chat_id: int,
+        message_id: int,
+        reaction: str | None = None,
+        **_: Any,
+    ) -> bool:
+        await asyncio.sleep(self._latency)
+        # Queued messages get a reaction that is cleared again later
+        if reaction is not None and reaction != "👀":
+            self._respond(chat_id, f"reaction {reaction}")
+        return True
+
+
+def serve_files(
+    files: dict[str, Path],
+    *,
+    latency: timedelta,
+) -> httpx.AsyncClient:
+    """
+    Creates an HTTP client that serves the given files (by URL path) like the
+    Bot API file server does.
+    """
+    contents = {path: file.read_bytes() for path, file in files.items()}
+
+    async def handle(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(latency.total_seconds())
+        content = contents.get(request.url.path)
+        if content is None:
+            return httpx.Response(404)
+        return httpx.Response(200, content=content)
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(handle))
@@ -0,0 +1,125 @@
+"""
+Measures the tracing overhead per Telegram update with different samplers.
+
+Run with `PYTHONPATH=src python -m benchmarks.tracing`. Spans are exported to
+a sink that discards them, so only the work done in the bot is measured.
+"""
+
+import asyncio
+import statistics
+from datetime import UTC, datetime, timedelta
+from time import perf_counter
+from typing import TYPE_CHECKING
+
+import click
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    SpanExporter,
+    SpanExportResult,
+)
+from opentelemetry.sdk.trace.sampling import Decision, StaticSampler
+from telegram import Chat, Message, Update, User, Voice
+from telegram.constants import ChatType
+
+import bot.bot
+from bot.config import TracingConfig
+from bot.telemetry import create_tracer_provider
+
+if TYPE_CHECKING:
+    from collections.abc import Sequence
+
+# Spans a transcribed voice message usually has below the update span
+_CHILD_SPANS = ("process_message", "download_file", "convert_to_wave", "transcribe")
+
+
+class _DiscardingExporter(SpanExporter):
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        return SpanExportResult.SUCCESS
+
+
+def _always_sampled(*, export: bool) -> TracerProvider:
+    # What every update went through before sampling was configurable
+    provider = TracerProvider(sampler=StaticSampler(Decision.RECORD_AND_SAMPLE))
+    if export:
+        provider.add_span_processor(BatchSpanProcessor(_DiscardingExporter()))
+    return provider
+
+
+def _scenarios(sample_percent: int) -> dict[str, TracerProvider]:
+    config = TracingConfig(
+        sample_percent=sample_percent,
+        slow_threshold=timedelta(seconds=20),
+        max_buffered_traces=512,
+    )
+    return {
+        "always sampled, no export (old default)": _always_sampled(export=False),
+        "always sampled, exported (old enabled)": _always_sampled(export=True),
+        "disabled": create_tracer_provider(
+            None,
+            resource=Resource.get_empty(),
+            create_exporter=_DiscardingExporter,
+        ),
+        f"{sample_percent}% sampled + tail": create_tracer_provider(
+            config,
+            resource=Resource.get_empty(),
+            create_exporter=_DiscardingExporter,
+        ),
+    }
+
+
+def _create_update(update_id: int) -> Update:
+    user = User(id=1, first_name="Bench", last_name="Mark", is_bot=False)
+    chat = Chat(id=-1001, type=ChatType.SUPERGROUP, title="Benchmark")
+    voice = Voice(file_id="file", file_unique_id="unique", duration=12)
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(UTC),
+        chat=chat,
+        from_user=user,
+        voice=voice,
+    )
+    return Update(update_id=update_id, message=message)
+
+
+async def _handle(update: Update) -> None:
+    async with bot.bot.telegram_span(update=update, name="handle_message"):
+        for name in _CHILD_SPANS:
+            with bot.bot.tracer.start_as_current_span(name):
+                pass
+
+
+async def _measure(updates: list[Update]) -> float:
+    start = perf_counter()
+    for update in updates:
+        await _handle(update)
+    return (perf_counter() - start) / len(updates)
+
+
+async def _run(iterations: int, repetitions: int, sample_percent: int) -> None:
+    updates = [_create_update(update_id) for update_id in range(iterations)]
+
+    click.echo(f"{'scenario':<42} {'median µs':>10} {'min µs':>8}")
+    for name, provider in _scenarios(sample_percent).items():
+        bot.bot.tracer = provider.get_tracer(bot.bot.__name__)
+        durations = [await _measure(updates) for _ in range(repetitions)]
+        provider.shutdown()
+
+        click.echo(
+            f"{name:<42}"
+            f" {statistics.median(durations) * 1e6:>10.1f}"
+            f" {min(durations) * 1e6:>8.1f}"
+        )
+
+
+@click.command
+@click.option("--iterations", default=5000, show_default=True)
+@click.option("--repetitions", default=5, show_default=True)
+@click.option("--sample-percent", default=10, show_default=True)
+def main(iterations: int, repetitions: int, sample_percent: int) -> None:
+    asyncio.run(_run(iterations, repetitions, sample_percent))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import time
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+    from bot.config import ArtifactCacheConfig
+
+_LOG = logging.getLogger(__name__)
+_meter = metrics.get_meter(__name__)
+
+_lookup_counter = _meter.create_counter(
+    "artifact_cache.lookups",
+    description="Number of audio artifact lookups by variant and outcome",
+)
+_evicted_bytes = _meter.create_counter(
+    "artifact_cache.evicted",
+    unit="By",
+    description="Size of audio artifacts removed from the cache",
+)
+
+# Variant of the file as it was downloaded, used for compressed passthrough
+ORIGINAL_VARIANT = "original"
+
+_PARTIAL_SUFFIX = ".partial"
+
+
+@dataclass
+class _Entry:
+    path: Path
+    size: int
+    last_used: float
+
+
+def _link_or_copy(source: Path, destination: Path) -> None:
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Different file systems
+        shutil.copyfile(source, destination)
+
+
+def _store(source: Path, path: Path, *, max_size: int) -> int | None:
+    size = source.stat().st_size
+    if size > max_size:
+        return None
+
+    partial_path = path.with_name(path.name + _PARTIAL_SUFFIX)
+    _link_or_copy(source, partial_path)
+    # Readers never see a partially copied file
+    partial_path.replace(path)
+    return size
+
+
+def _scan(directory: Path) -> list[_Entry]:
+    directory.mkdir(parents=True, exist_ok=True)
+    entries = []
+    for path in directory.iterdir():
+        if path.suffix == _PARTIAL_SUFFIX:
+            path.unlink(missing_ok=True)
+            continue
+
+        stat = path.stat()
+        entries.append(_Entry(path, stat.st_size, stat.st_mtime))
+
+    entries.sort(key=lambda entry: entry.last_used)
+    return entries
+
+
+def _remove(paths: list[Path]) -> None:
+    for path in paths:
+        path.unlink(missing_ok=True)
+
+
+class AudioArtifactCache:
+    """
+    Keeps downloaded and converted audio on disk, so transcribing the same
+    file again (e.g. with `/retry`) only needs the recognition.
+
+    Artifacts are keyed by the file's unique ID and the variant, i.e. the
+    conversion profile or `ORIGINAL_VARIANT`. The least recently used ones are
+    removed once the cache exceeds its size, or when they're too old.
+
+    Callers get a hard link in their own scratch directory, so eviction can't
+    pull a file out from under a running recognition.
+    """
+
+    def __init__(self, config: ArtifactCacheConfig, *, directory: Path) -> None:
+        self._config = config
+        self._directory = directory
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._size = 0
+
+    async def start(self) -> None:
+        if not self._config.enabled:
+            return
+
+        # Artifacts of the previous run are still useful after a restart
+        entries = await asyncio.to_thread(_scan, self._directory)
+        for entry in entries:
+            self._entries[entry.path.stem] = entry
+            self._size += entry.size
+
+        _LOG.info(
+            "Found %d cached audio artifacts with %d bytes",
+            len(entries),
+            self._size,
+        )
+        await self._evict()
+
+    @staticmethod
+    def _key(file_unique_id: str, variant: str) -> str:
+        digest = hashlib.sha256(f"{file_unique_id}:{variant}".encode()).hexdigest()
+        return f"{digest[:32]}-{variant}"
+
+    async def get(
+        self,
+        file_unique_id: str,
+        variant: str,
+        *,
+        destination: Path,
+    ) -> Path | None:
+        """
+        Places the cached artifact in the given directory and returns its
+        path, or returns None if there is none.
+        """
+        if not self._config.enabled:
+            return None
+
+        key = self._key(file_unique_id, variant)
+        entry = self._entries.get(key)
+        max_age = self._config.max_age.total_seconds()
+        if entry is None or time() - entry.last_used > max_age:
+            _lookup_counter.add(1, {"variant": variant, "outcome": "miss"})
+            return None
+
+        entry.last_used = time()
+        self._entries.move_to_end(key)
+        target = destination / entry.path.name
+        try:
+            await asyncio.to_thread(_link_or_copy, entry.path, target)
+        except OSError as e:
+            # Evicted in the meantime
+            _LOG.warning("Could not use cached audio artifact", exc_info=e)
+            _lookup_counter.add(1, {"variant": variant, "outcome": "miss"})
+            return None
+
+        _lookup_counter.add(1, {"variant": variant, "outcome": "hit"})
+        return target
+
+    async def put(self, file_unique_id: str, variant: str, source: Path) -> None:
+        """
+        Stores the given artifact, unless it would take up more than a quarter
+        of the cache.
+        """
+        config = self._config
+        if not config.enabled:
+            return
+
+        key = self._key(file_unique_id, variant)
+        path = self._directory / f"{key}{source.suffix}"
+        try:
+            size = await asyncio.to_thread(
+                _store,
+                source,
+                path,
+                max_size=config.max_bytes // 4,
+            )
+        except OSError as e:
+            _LOG.warning("Could not cache audio artifact", exc_info=e)
+            return
+
+        if size is None:
+            return
+
+        if previous := self._entries.pop(key, None):
+            self._size -= previous.size
+            if previous.path != path:
+                await asyncio.to_thread(_remove, [previous.path])
+        self._entries[key] = _Entry(path, size, time())
+        self._size += size
+        await self._evict()
+
+    async def _evict(self) -> None:
+        config = self._config
+        oldest_allowed = time() - config.max_age.total_seconds()
+        evicted: list[_Entry] = []
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if self._size <= config.max_bytes and entry.last_used >= oldest_allowed:
+                break
+
+            del self._entries[key]
+            self._size -= entry.size
+            evicted.append(entry)
+
+        if not evicted:
+            return
+
+        _evicted_bytes.add(sum(entry.size for entry in evicted))
+        try:
+            await asyncio.to_thread(_remove, [entry.path for entry in evicted])
+        except OSError as e:
+            _LOG.warning("Could not remove cached audio artifacts", exc_info=e)
@@ -0,0 +1,337 @@
+import math
+import sys
+import wave
+from array import array
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+_FRAME_DURATION_MS = 20
+_FULL_SCALE = 2**15
+
+
+@dataclass
+class PcmAudio:
+    """Mono 16-bit PCM audio."""
+
+    samples: array[int]
+    sample_rate: int
+
+    @property
+    def duration(self) -> float:
+        return len(self.samples) / self.sample_rate
+
+    @property
+    def frame_size(self) -> int:
+        return self.sample_rate * _FRAME_DURATION_MS // 1000
+
+    def slice(self, start: int, end: int) -> PcmAudio:
+        return PcmAudio(samples=self.samples[start:end], sample_rate=self.sample_rate)
+
+
+def read_wave(path: Path) -> PcmAudio:
+    with wave.open(str(path), "rb") as wav:
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+            raise ValueError(f"Expected mono 16-bit PCM, got {wav.getparams()}")
+
+        samples = array("h")
+        samples.frombytes(wav.readframes(wav.getnframes()))
+        if sys.byteorder == "big":
+            samples.byteswap()
+
+        return PcmAudio(samples=samples, sample_rate=wav.getframerate())
+
+
+def write_wave(path: Path, audio: PcmAudio) -> None:
+    samples = audio.samples
+    if sys.byteorder == "big":
+        samples = array("h", samples)
+        samples.byteswap()
+
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(audio.sample_rate)
+        wav.writeframes(samples.tobytes())
+
+
+def threshold_energy(threshold_db: float) -> float:
+    """Converts a level in dBFS to the matching mean frame energy."""
+    return (_FULL_SCALE * 10 ** (threshold_db / 20)) ** 2
+
+
+def frame_energies(audio: PcmAudio) -> list[float]:
+    """
+    Calculates the mean energy of each 20 ms frame.
+
+    math.sumprod does the multiply-accumulate in C, which is fast enough for
+    long recordings without pulling in NumPy.
+    """
+    samples = audio.samples
+    frame_size = audio.frame_size
+    energies = []
+    for start in range(0, len(samples), frame_size):
+        frame = samples[start : start + frame_size]
+        energies.append(math.sumprod(frame, frame) / len(frame))
+    return energies
+
+
+def silent_runs(
+    energies: list[float],
+    *,
+    threshold_db: float,
+    min_frames: int,
+) -> list[tuple[int, int]]:
+    """
+    Finds runs of at least `min_frames` consecutive frames below the threshold.
+
+    Returns (start, end) frame indices with an exclusive end.
+    """
+    threshold = threshold_energy(threshold_db)
+    runs = []
+    run_start: int | None = None
+    for index, energy in enumerate(energies):
+        if energy < threshold:
+            if run_start is None:
+                run_start = index
+        elif run_start is not None:
+            if index - run_start >= min_frames:
+                runs.append((run_start, index))
+            run_start = None
+
+    if run_start is not None and len(energies) - run_start >= min_frames:
+        runs.append((run_start, len(energies)))
+
+    return runs
+
+
+def split_at_silence(
+    audio: PcmAudio,
+    *,
+    max_segment_seconds: float,
+    threshold_db: float,
+    min_silence_ms: int = 300,
+) -> list[PcmAudio]:
+    """
+    Splits the audio into segments of at most `max_segment_seconds`, cutting
+    only in the middle of silent stretches.
+
+    If there is no silence within a segment, the segment grows until the next
+    silence instead, so words are never cut.
+    """
+    frame_size = audio.frame_size
+    runs = silent_runs(
+        frame_energies(audio),
+        threshold_db=threshold_db,
+        min_frames=max(1, min_silence_ms // _FRAME_DURATION_MS),
+    )
+    candidates = [(start + end) // 2 * frame_size for start, end in runs]
+
+    max_length = int(max_segment_seconds * audio.sample_rate)
+    # Avoid tiny segments, they are slower than they are worth
+    min_length = max_length // 4
+    total = len(audio.samples)
+
+    segments = []
+    start = 0
+    while total - start > max_length:
+        in_range = [
+            point
+            for point in candidates
+            if start + min_length <= point <= start + max_length
+        ]
+        if in_range:
+            end = in_range[-1]
+        else:
+            later = [point for point in candidates if point > start + max_length]
+            if not later:
+                break
+            end = later[0]
+
+        segments.append(audio.slice(start, end))
+        start = end
+
+    segments.append(audio.slice(start, total))
+    return segments
+
+
+def compress_silence(
+    audio: PcmAudio,
+    *,
+    threshold_db: float,
+    padding_ms: int,
+    min_silence_ms: int,
+) -> PcmAudio:
+    """
+    Removes leading and trailing silence and shortens pauses, keeping
+    `padding_ms` of silence next to speech so words aren't clipped.
+
+    Only pauses of at least `min_silence_ms` plus the padding on both sides
+    are shortened.
+    """
+    frame_size = audio.frame_size
+    padding = padding_ms // _FRAME_DURATION_MS
+    energies = frame_energies(audio)
+    runs = silent_runs(
+        energies,
+        threshold_db=threshold_db,
+        min_frames=max(1, min_silence_ms // _FRAME_DURATION_MS + 2 * padding),
+    )
+    if not runs:
+        return audio
+
+    samples = audio.samples
+    kept = array("h")
+    position = 0
+    for start, end in runs:
+        cut_start = start if start == 0 else start + padding
+        cut_end = end if end == len(energies) else end - padding
+        kept.extend(samples[position * frame_size : cut_start * frame_size])
+        position = cut_end
+
+    kept.extend(samples[position * frame_size :])
+    if not kept:
+        # Nothing but silence, let the speech service tell there's no result
+        return audio
+
+    return PcmAudio(samples=kept, sample_rate=audio.sample_rate)
+
+
+class SilenceCompressor:
+    """
+    Compresses silence like `compress_silence`, but incrementally on a stream
+    of PCM chunks.
+
+    Speech is passed on right away, only the current pause is held back until
+    it's clear how much of it to keep. At most `min_silence_ms` plus the
+    padding is buffered for that.
+    """
+
+    def __init__(
+        self,
+        *,
+        sample_rate: int,
+        threshold_db: float,
+        padding_ms: int,
+        min_silence_ms: int,
+    ) -> None:
+        self._frame_bytes = sample_rate * _FRAME_DURATION_MS // 1000 * 2
+        self._threshold = threshold_energy(threshold_db)
+        self._padding = padding_ms // _FRAME_DURATION_MS
+        self._min_frames = max(
+            1, min_silence_ms // _FRAME_DURATION_MS + 2 * self._padding
+        )
+        self._incomplete_frame = b""
+        # The first and last frames of the current pause
+        self._silence: list[bytes] = []
+        self._silent_frames = 0
+        self._is_start = True
+        self._removed_frames = 0
+
+    @property
+    def removed_seconds(self) -> float:
+        return self._removed_frames * _FRAME_DURATION_MS / 1000
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Returns the audio that can be passed on so far."""
+        data = self._incomplete_frame + chunk
+        end = len(data) - len(data) % self._frame_bytes
+        self._incomplete_frame = data[end:]
+        return b"".join(
+            self._add_frame(data[start : start + self._frame_bytes])
+            for start in range(0, end, self._frame_bytes)
+        )
+
+    def flush(self) -> bytes:
+        """Returns the rest of the audio once the stream has ended."""
+        # An odd byte isn't a sample
+        last_frame = self._incomplete_frame[: len(self._incomplete_frame) // 2 * 2]
+        self._incomplete_frame = b""
+        output = self._add_frame(last_frame) if last_frame else b""
+        return output + self._end_silence(is_end=True)
+
+    def _add_frame(self, frame: bytes) -> bytes:
+        samples = array("h")
+        samples.frombytes(frame)
+        if sys.byteorder == "big":
+            samples.byteswap()
+
+        if math.sumprod(samples, samples) / len(samples) < self._threshold:
+            self._silence.append(frame)
+            self._silent_frames += 1
+            if len(self._silence) > self._min_frames:
+                # Will be cut anyway, only the padding on both sides is kept
+                del self._silence[self._padding]
+            return b""
+
+        output = self._end_silence(is_end=False) + frame
+        self._is_start = False
+        return output
+
+    def _end_silence(self, *, is_end: bool) -> bytes:
+        silence = self._silence
+        kept = silence
+        if self._silent_frames >= self._min_frames and not (
+            # Nothing but silence, let the speech service tell there's no result
+            self._is_start and is_end
+        ):
+            head = [] if self._is_start else silence[: self._padding]
+            tail = [] if is_end else silence[len(silence) - self._padding :]
+            kept = head + tail
+
+        self._removed_frames += self._silent_frames - len(kept)
+        self._silence = []
+        self._silent_frames = 0
+        return b"".join(kept)
+
+
+def compress_silence_file(
+    path: Path,
+    output_path: Path,
+    *,
+    threshold_db: float,
+    padding_ms: int,
+    min_silence_ms: int,
+) -> float:
+    """
+    Writes the audio with compressed silence to `output_path`.
+
+    Returns the removed duration in seconds. If nothing was removed, no file
+    is written.
+    """
+    audio = read_wave(path)
+    compressed = compress_silence(
+        audio,
+        threshold_db=threshold_db,
+        padding_ms=padding_ms,
+        min_silence_ms=min_silence_ms,
+    )
+    removed_seconds = audio.duration - compressed.duration
+    if removed_seconds > 0:
+        write_wave(output_path, compressed)
+
+    return removed_seconds
+
+
+def split_wave_file(
+    path: Path,
+    output_dir: Path,
+    *,
+    max_segment_seconds: float,
+    threshold_db: float,
+) -> list[Path]:
+    segments = split_at_silence(
+        read_wave(path),
+        max_segment_seconds=max_segment_seconds,
+        threshold_db=threshold_db,
+    )
+
+    paths = []
+    for index, segment in enumerate(segments):
+        segment_path = output_dir / f"{path.stem}-{index:03d}.wav"
+        write_wave(segment_path, segment)
+        paths.append(segment_path)
+
+    return paths
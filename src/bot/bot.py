@@ -1,15 +1,23 @@
+import asyncio
 import logging
 import re
 import signal
+import statistics
 from contextlib import asynccontextmanager
+from dataclasses import replace
+from datetime import timedelta
+from functools import partial
 from pathlib import Path
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, gettempdir
+from time import monotonic
 from typing import TYPE_CHECKING, Any, cast
 
+import httpx
 import telegram
 from bs_nats_updater import create_updater
 from bs_state.implementation import redis_storage
-from opentelemetry import trace
+from opentelemetry import metrics, trace
+from redis.asyncio import Redis
 from telegram import Audio, Chat, Message, Update, User, VideoNote, Voice
 from telegram.constants import ChatType, FileSizeLimit, MessageLimit, ParseMode
 from telegram.ext import (
@@ -20,77 +28,238 @@ from telegram.ext import (
     filters,
 )
 
-from bot.conversion import AudioConverter
+from bot.artifacts import ORIGINAL_VARIANT, AudioArtifactCache
+from bot.audio import SilenceCompressor, compress_silence_file, split_wave_file
+from bot.cache import TranscriptCache
+from bot.coalescing import TranscriptionCoalescer
+from bot.conversion import (
+    PCM_SAMPLE_RATE,
+    SPEECH_PROFILE,
+    AudioConverter,
+    CompressedFormat,
+    conversion_profiles,
+    detect_compressed_format,
+    is_streamable,
+    peek_header,
+    read_chunks,
+    read_header,
+)
+from bot.greenlist import Greenlist
+from bot.housekeeping import Housekeeper
+from bot.locale_learning import LocaleLearner
 from bot.localization import find_locale, locale_by_language
+from bot.outbox import Outbox, Priority
+from bot.profiling import LoopLagMonitor, SamplingProfiler
+from bot.progressive import ProgressiveReply
+from bot.sampling import set_deferred_attributes
+from bot.scheduler import JobDeadlineExceededError, JobScheduler
 from bot.speech import Transcriber
-from bot.state import GreenlistState
-from bot.telemetry import InstrumentedHttpxRequest
+from bot.state import GreenlistState, RedisGreenlistStorage
+from bot.telemetry import InstrumentedHttpxRequest, instrument_httpx_client
 from bot.usage import UsageTracker
 
 if TYPE_CHECKING:
-    from collections.abc import AsyncIterator
+    from collections.abc import (
+        AsyncGenerator,
+        AsyncIterable,
+        AsyncIterator,
+        Callable,
+    )
 
-    from bs_state import StateStorage
+    from opentelemetry.util.types import AttributeValue
 
-    from bot.config import Config
+    from bot.config import Config, RecognizerPoolConfig
+    from bot.scheduler import Job
 
 _LOG = logging.getLogger(__name__)
 tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
+
+_download_duration = _meter.create_histogram(
+    "telegram.download_duration",
+    unit="s",
+    description="Duration of file downloads from Telegram by mode",
+)
+_downloaded_bytes = _meter.create_counter(
+    "telegram.downloaded",
+    unit="By",
+    description="Bytes downloaded from Telegram",
+)
+_jobs_in_flight = _meter.create_up_down_counter(
+    "pipeline.jobs_in_flight",
+    description="Number of transcription jobs admitted to the pipeline",
+)
+_processed_audio = _meter.create_counter(
+    "pipeline.processed_audio",
+    unit="s",
+    description="Duration of transcribed audio, its rate is the throughput",
+)
+_real_time_factor = _meter.create_histogram(
+    "pipeline.real_time_factor",
+    unit="1",
+    description="Time to recognize a recording relative to its duration",
+)
+_greenlist_denials = _meter.create_counter(
+    "greenlist.denials",
+    description="Number of messages ignored because the chat isn't allowed",
+)
+_removed_silence = _meter.create_histogram(
+    "silence_trimming.removed_audio",
+    unit="s",
+    description="Silence removed from a recording before recognition",
+)
+
+
+def _update_attributes(update: Update) -> dict[str, AttributeValue]:
+    attributes: dict[str, AttributeValue] = {
+        "telegram.update_keys": list(update.to_dict(recursive=False).keys()),
+        "telegram.update_id": update.update_id,
+    }
+
+    if message := update.effective_message:
+        attributes["telegram.message_id"] = message.message_id
+        attributes["telegram.message_timestamp"] = message.date.isoformat()
+
+    if chat := update.effective_chat:
+        attributes["telegram.chat_id"] = chat.id
+        attributes["telegram.chat_type"] = chat.type
+        if chat_name := chat.effective_name:
+            attributes["telegram.chat_name"] = chat_name
+
+    if user := update.effective_user:
+        attributes["telegram.user_id"] = user.id
+        attributes["telegram.user_full_name"] = user.full_name
+        if user_username := user.username:
+            attributes["telegram.user_username"] = user_username
+
+    return attributes
 
 
 @asynccontextmanager
 async def telegram_span(*, update: Update, name: str) -> AsyncIterator[trace.Span]:
     with tracer.start_as_current_span(name) as span:
-        span.set_attribute(
-            "telegram.update_keys",
-            list(update.to_dict(recursive=False).keys()),
-        )
-        span.set_attribute("telegram.update_id", update.update_id)
+        # Serializing the update is wasted unless the trace is exported
+        set_deferred_attributes(span, partial(_update_attributes, update))
+        yield span
 
-        if message := update.effective_message:
-            span.set_attribute("telegram.message_id", message.message_id)
-            span.set_attribute("telegram.message_timestamp", message.date.isoformat())
 
-        if chat := update.effective_chat:
-            span.set_attribute("telegram.chat_id", chat.id)
-            span.set_attribute("telegram.chat_type", chat.type)
-            if chat_name := chat.effective_name:
-                span.set_attribute("telegram.chat_name", chat_name)
+class _NotStreamableError(Exception):
+    pass
 
-        if user := update.effective_user:
-            span.set_attribute("telegram.user_id", user.id)
-            span.set_attribute("telegram.user_full_name", user.full_name)
-            if user_username := user.username:
-                span.set_attribute("telegram.user_username", user_username)
 
-        yield span
+class _PipelineFullError(Exception):
+    pass
+
+
+def _audio_seconds(file: Voice | Audio | VideoNote) -> int:
+    duration = file.duration
+    if isinstance(duration, timedelta):
+        return int(duration.total_seconds())
+    return duration
 
 
 class Bot:
     def __init__(self, config: Config):
         self.config = config
-        self.converter = AudioConverter()
-        self.state_storage: StateStorage[GreenlistState] = None  # type: ignore
-        self.transcriber = Transcriber(config.azure_tts)
+        self.artifact_cache = AudioArtifactCache(
+            config.artifact_cache,
+            directory=(config.scratch_dir or Path(gettempdir())) / "audio-artifacts",
+        )
+        self.coalescer: TranscriptionCoalescer = None  # type: ignore
+        self.converter = AudioConverter(
+            conversion_profiles[config.conversion_profile],
+        )
+        self.greenlist: Greenlist = None  # type: ignore
+        self.housekeeper: Housekeeper = None  # type: ignore
+        self.locale_learner: LocaleLearner = None  # type: ignore
+        self.http_client: httpx.AsyncClient = None  # type: ignore
+        self.loop_monitor = LoopLagMonitor(config.profiling)
+        self.outbox = Outbox(config.outbox)
+        self.profiler = SamplingProfiler(config.profiling)
+        self.redis: Redis = None  # type: ignore
+        self.scheduler = JobScheduler(config.scheduler)
+        self.transcript_cache: TranscriptCache = None  # type: ignore
+        self.transcriber = Transcriber.from_config(
+            config.azure_tts,
+            pool_config=self._recognizer_pool_config(),
+        )
         self.usage_tracker: UsageTracker = None  # type: ignore
 
     async def _init(self, _: Any) -> None:
         config = self.config
         redis = config.redis
-        self.state_storage = await redis_storage.load(
-            initial_state=GreenlistState.initial_state(),
+        self.redis = Redis(
             host=redis.host,
             username=redis.username,
             password=redis.password,
-            key=f"{redis.username}:greenlist",
+            decode_responses=True,
+        )
+        greenlist_storage = RedisGreenlistStorage(
+            self.redis,
+            key_prefix=redis.username,
+        )
+        if await greenlist_storage.needs_migration():
+            legacy_storage = await redis_storage.load(
+                initial_state=GreenlistState.initial_state(),
+                host=redis.host,
+                username=redis.username,
+                password=redis.password,
+                key=f"{redis.username}:greenlist",
+            )
+            try:
+                await greenlist_storage.migrate(await legacy_storage.load())
+            finally:
+                await legacy_storage.close()
+
+        self.greenlist = Greenlist(
+            greenlist_storage,
+            redis=self.redis,
+            key_prefix=redis.username,
+        )
+        await self.greenlist.start()
+        self.transcript_cache = TranscriptCache(
+            config.transcript_cache,
+            redis=self.redis,
+            key_prefix=redis.username,
+        )
+        self.coalescer = TranscriptionCoalescer(
+            config.coalescing,
+            cache=self.transcript_cache,
+            redis=self.redis,
+            key_prefix=redis.username,
+        )
+        self.locale_learner = LocaleLearner(
+            config.locale_learning,
+            redis=self.redis,
+            key_prefix=redis.username,
         )
         self.usage_tracker = await UsageTracker.create(
             config.database, config.rate_limit
         )
+        self.housekeeper = Housekeeper(
+            self.usage_tracker,
+            redis=self.redis,
+            key_prefix=redis.username,
+        )
+        self.housekeeper.start()
+        self.http_client = instrument_httpx_client(httpx.AsyncClient())
+        await self.artifact_cache.start()
+        self.loop_monitor.start()
+        self.outbox.start()
+        self.transcriber.start()
+
+    async def _stop(self, _: Any) -> None:
+        # Telegram requests are only possible until the application shuts down
+        await self.outbox.close()
 
     async def _shutdown(self, _: Any) -> None:
-        await self.state_storage.close()
+        await self.housekeeper.close()
+        await self.greenlist.close()
+        await self.redis.aclose()
+        await self.http_client.aclose()
+        await self.transcriber.close()
         await self.usage_tracker.close()
+        await self.loop_monitor.close()
 
     def run(self) -> None:
         bot = telegram.Bot(
@@ -101,6 +270,7 @@ class Bot:
             Application.builder()
             .updater(create_updater(bot, self.config.nats))
             .post_init(self._init)
+            .post_stop(self._stop)
             .post_shutdown(self._shutdown)
             .build()
         )
@@ -122,6 +292,15 @@ class Bot:
             )
         )
 
+        app.add_handler(
+            CommandHandler(
+                command="locale",
+                has_args=1,
+                callback=self._pin_locale,
+                filters=~filters.UpdateType.EDITED,
+            )
+        )
+
         app.add_handler(
             CommandHandler(
                 command="allow",
@@ -137,6 +316,15 @@ class Bot:
                 filters=~filters.UpdateType.EDITED,
             )
         )
+        app.add_handler(
+            CommandHandler(
+                command="profile",
+                has_args=1,
+                callback=self._profile,
+                filters=~filters.UpdateType.EDITED,
+                block=False,
+            )
+        )
 
         app.run_polling(
             stop_signals=[signal.SIGTERM, signal.SIGINT],
@@ -178,8 +366,13 @@ class Bot:
             if not locale:
                 _LOG.info("[%s] Unsupported locale: '%s'", update_id, locale_query)
                 supported_langs = ", ".join(sorted(locale_by_language.keys()))
-                await message.reply_text(
-                    f"Konnte die angegebene Sprache nicht verstehen. Unterstützt werden: {supported_langs}.",
+                self.outbox.submit(
+                    message.chat,
+                    partial(
+                        message.reply_text,
+                        f"Konnte die angegebene Sprache nicht verstehen. Unterstützt werden: {supported_langs}.",
+                    ),
+                    priority=Priority.NOTICE,
                 )
                 return
 
@@ -190,8 +383,13 @@ class Bot:
                 or replied_to_message.audio
             ):
                 _LOG.info("[%s] No suitable reply_to_message", update_id)
-                await message.reply_text(
-                    "Das Command muss als Antwort auf eine Sprachnachricht, Videonachricht, oder Audiodatei verschickt werden."
+                self.outbox.submit(
+                    message.chat,
+                    partial(
+                        message.reply_text,
+                        "Das Command muss als Antwort auf eine Sprachnachricht, Videonachricht, oder Audiodatei verschickt werden.",
+                    ),
+                    priority=Priority.NOTICE,
                 )
                 return
 
@@ -199,6 +397,46 @@ class Bot:
                 message, file, update_id=update_id, locale=locale
             )
 
+    async def _pin_locale(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+    ) -> None:
+        async with telegram_span(update=update, name="pin_locale"):
+            if update.edited_message:
+                return
+
+            update_id = update.update_id
+            _LOG.info("[%s] Received command update", update_id)
+
+            message: Message = update.message  # type: ignore
+            if not await self._check_greenlist(message.chat):
+                return
+
+            locale_query: str = context.args[0]  # type: ignore
+            if locale_query.strip().lower() == "auto":
+                locale = None
+            elif not (locale := find_locale(locale_query)):
+                _LOG.info("[%s] Unsupported locale: '%s'", update_id, locale_query)
+                supported_langs = ", ".join(sorted(locale_by_language.keys()))
+                self.outbox.submit(
+                    message.chat,
+                    partial(
+                        message.reply_text,
+                        f"Konnte die angegebene Sprache nicht verstehen. Unterstützt werden: {supported_langs}, auto.",
+                    ),
+                    priority=Priority.NOTICE,
+                )
+                return
+
+            # Pinned per user, other members of a group keep their locale
+            await self.locale_learner.pin(cast(User, message.from_user).id, locale)
+            self.outbox.submit(
+                message.chat,
+                partial(message.set_reaction, "👍"),
+                priority=Priority.REACTION,
+            )
+
     async def _handle_message(self, update: Update, _: Any) -> None:
         async with telegram_span(update=update, name="handle_message"):
             update_id = update.update_id
@@ -219,24 +457,32 @@ class Bot:
 
     @tracer.start_as_current_span("check_greenlist")
     async def _check_greenlist(self, chat: Chat) -> bool:
-        state = await self.state_storage.load()
+        greenlist = self.greenlist
         chat_id = chat.id
-        if chat_id in state.allowed_chat_ids:
+        if await greenlist.is_allowed(chat_id):
             return True
 
-        if chat_id not in state.informed_chats:
+        _greenlist_denials.add(1, {"chat.type": chat.type})
+
+        # Marking the chat first ensures concurrent messages only inform once
+        if not greenlist.was_informed(chat_id) and await greenlist.informed_chat(
+            chat_id
+        ):
             _LOG.info("Informing chat of greenlist approach")
-            await chat.send_message(
-                (
-                    "Entschuldige, aber dieser Chat ist nicht für die Nutzung dieses Bots"
-                    " freigeschaltet. Zum Freischalten kannst du die Chat-ID"
-                    f" <code>{chat_id}</code> an Björn schicken."
-                    " Du weißt nicht, wer das ist? Schade."
+            self.outbox.submit(
+                chat,
+                partial(
+                    chat.send_message,
+                    (
+                        "Entschuldige, aber dieser Chat ist nicht für die Nutzung dieses Bots"
+                        " freigeschaltet. Zum Freischalten kannst du die Chat-ID"
+                        f" <code>{chat_id}</code> an Björn schicken."
+                        " Du weißt nicht, wer das ist? Schade."
+                    ),
+                    parse_mode=ParseMode.HTML,
                 ),
-                parse_mode=ParseMode.HTML,
+                priority=Priority.NOTICE,
             )
-            state.informed_chat(chat_id)
-            await self.state_storage.store(state)
 
         return False
 
@@ -256,14 +502,19 @@ class Bot:
         file_size = int(file.file_size or 0)
         if file_size > FileSizeLimit.FILESIZE_DOWNLOAD:
             _LOG.info("[%s] File size exceeds limit", update_id)
-            await message.reply_text(
-                disable_notification=True,
-                text="Sorry, ich bearbeite nur Dateien bis zu 20 MB",
+            self.outbox.submit(
+                message.chat,
+                partial(
+                    message.reply_text,
+                    disable_notification=True,
+                    text="Sorry, ich bearbeite nur Dateien bis zu 20 MB",
+                ),
+                priority=Priority.NOTICE,
             )
             return
 
         user_id = cast(User, message.from_user).id
-        if await self.usage_tracker.get_conflict(
+        if await self.usage_tracker.is_rate_limited(
             user_id=user_id,
             at_time=message.date,
             unique_file_id=file.file_unique_id,
@@ -275,76 +526,563 @@ class Bot:
                 user_id,
             )
             if message.chat.type == ChatType.PRIVATE:
-                await message.reply_text("Sorry, du hast dein Limit erreicht.")
+                self.outbox.submit(
+                    message.chat,
+                    partial(message.reply_text, "Sorry, du hast dein Limit erreicht."),
+                    priority=Priority.NOTICE,
+                )
             else:
-                await message.set_reaction("👎")
+                self.outbox.submit(
+                    message.chat,
+                    partial(message.set_reaction, "👎"),
+                    priority=Priority.REACTION,
+                )
             return
 
-        with TemporaryDirectory(dir=self.config.scratch_dir) as scratch_path:
-            scratch_dir = Path(scratch_path)
+        # Usages refer to the requested locale, but transcripts depend on the
+        # locale the audio is recognized with, which may be learned or pinned.
+        recognition_locale = locale
+        if recognition_locale is None:
+            recognition_locale = await self.locale_learner.resolve(
+                chat_id=message.chat.id,
+                user_id=user_id,
+            )
 
-            _LOG.debug("[%s] Downloading file", update_id)
-            original_audio_file = await self._download_file(file, scratch_dir)
+        result = await self.transcript_cache.get(
+            file_unique_id=file.file_unique_id,
+            locale=recognition_locale,
+            audio_seconds=_audio_seconds(file),
+        )
+        progressive_reply: ProgressiveReply | None = None
+        if result is None:
+            if self.config.progressive_replies:
+                progressive_reply = ProgressiveReply(
+                    message,
+                    outbox=self.outbox,
+                    split_chunks=self._split_chunks,
+                    transform=self._easter_eggs,
+                )
+
+            detected_locales: list[str] = []
+
+            try:
+                # Identical files are often forwarded to multiple chats at once
+                result = await self.coalescer.transcribe(
+                    file_unique_id=file.file_unique_id,
+                    locale=recognition_locale,
+                    audio_seconds=_audio_seconds(file),
+                    transcribe=partial(
+                        self._transcribe_in_job,
+                        message,
+                        file,
+                        update_id=update_id,
+                        locale=recognition_locale,
+                        on_phrase=(
+                            None
+                            if progressive_reply is None
+                            else progressive_reply.add_phrase
+                        ),
+                        on_language=detected_locales.append,
+                    ),
+                )
+            except _PipelineFullError:
+                _LOG.info("[%s] Rejecting message, pipeline is full", update_id)
+                self.outbox.submit(
+                    message.chat,
+                    partial(message.set_reaction, "😴"),
+                    priority=Priority.REACTION,
+                )
+                return
+            except JobDeadlineExceededError as e:
+                _LOG.warning("[%s] Aborted transcription: %s", update_id, e)
+                self.outbox.submit(
+                    message.chat,
+                    partial(message.set_reaction, "🥱"),
+                    priority=Priority.REACTION,
+                )
+                return
+            finally:
+                # Covers failures and empty results as well
+                if progressive_reply is not None and not result:
+                    await progressive_reply.abort()
+
+            if detected_locales:
+                await self.locale_learner.observe(
+                    chat_id=message.chat.id,
+                    user_id=user_id,
+                    # Long audio reports a language per segment
+                    locale=statistics.mode(detected_locales),
+                )
+        else:
+            _LOG.info("[%s] Using cached transcription", update_id)
+
+        if not result:
+            _LOG.info("[%s] No transcription result", update_id)
+            if isinstance(file, Voice):
+                self.outbox.submit(
+                    message.chat,
+                    partial(message.set_reaction, "🤷‍♂️", is_big=True),
+                    priority=Priority.REACTION,
+                )
+                await self.usage_tracker.track(
+                    message,
+                    response_id=None,
+                    unique_file_id=file.file_unique_id,
+                    locale=locale,
+                )
+            return
+
+        result = self._easter_eggs(result)
 
-            _LOG.debug("[%s] Converting file", update_id)
-            converted_audio_file = await self.converter.convert_to_wave(
-                original_audio_file
+        async def track_response(response_message: Message) -> None:
+            await self.usage_tracker.track(
+                message,
+                response_id=response_message.message_id,
+                unique_file_id=file.file_unique_id,
+                locale=locale,
             )
 
-            _LOG.debug(
-                "[%s] Transcribing audio with locale %s",
+        if progressive_reply is not None and progressive_reply.has_replied:
+            _LOG.info(
+                "[%s] Finishing progressive reply of length %d",
                 update_id,
-                locale,
+                len(result),
             )
-            result = await self.transcriber.transcribe(
-                converted_audio_file, locale=locale
+            if first_reply := await progressive_reply.finish(result):
+                await track_response(first_reply)
+                return
+
+            _LOG.info("[%s] Replying again, progressive reply failed", update_id)
+
+        if progressive_reply is not None:
+            await progressive_reply.cancel()
+
+        chunks = self._split_chunks(result)
+        _LOG.info(
+            "[%s] Sending message of length %d in %d chunks",
+            update_id,
+            len(result),
+            len(chunks),
+        )
+        for index, chunk in enumerate(chunks):
+            self.outbox.submit(
+                message.chat,
+                partial(message.reply_text, text=chunk, disable_notification=True),
+                priority=Priority.REPLY,
+                # The usage refers to the first message of the response
+                on_sent=track_response if index == 0 else None,
             )
 
-            if not result:
-                _LOG.info("[%s] No transcription result", update_id)
-                if isinstance(file, Voice):
-                    await message.set_reaction(
-                        "🤷‍♂️",
-                        is_big=True,
+    async def _transcribe_in_job(
+        self,
+        message: Message,
+        file: Voice | Audio | VideoNote,
+        *,
+        update_id: int,
+        locale: str | None,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None],
+    ) -> str | None:
+        async with self.scheduler.job(audio_seconds=_audio_seconds(file)) as job:
+            if job is None:
+                raise _PipelineFullError
+
+            if job.queued:
+                _LOG.info("[%s] Queueing message, pipeline is busy", update_id)
+                self.outbox.submit(
+                    message.chat,
+                    partial(message.set_reaction, "👀"),
+                    priority=Priority.REACTION,
+                )
+
+            _jobs_in_flight.add(1)
+            try:
+                result = await self._transcribe_file(
+                    message,
+                    file,
+                    job=job,
+                    update_id=update_id,
+                    locale=locale,
+                    on_phrase=on_phrase,
+                    on_language=on_language,
+                )
+            finally:
+                _jobs_in_flight.add(-1)
+
+        if audio_seconds := _audio_seconds(file):
+            _processed_audio.add(audio_seconds)
+            # Waiting, downloading and converting are measured by the scheduler
+            transcription_seconds = job.worker_seconds.get(
+                self.scheduler.transcription.name
+            )
+            if transcription_seconds is not None:
+                _real_time_factor.record(
+                    transcription_seconds / audio_seconds,
+                    {"locale": locale or "auto"},
+                )
+
+        return result
+
+    async def _transcribe_file(
+        self,
+        message: Message,
+        file: Voice | Audio | VideoNote,
+        *,
+        job: Job,
+        update_id: int,
+        locale: str | None,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None],
+    ) -> str | None:
+        scheduler = self.scheduler
+        # Long audio needs to be decoded completely so it can be split up
+        is_long_audio = self._is_long_audio(file)
+
+        if self.config.streaming_pipeline and not is_long_audio:
+            try:
+                return await self._transcribe_streamed(
+                    message,
+                    file,
+                    job=job,
+                    update_id=update_id,
+                    locale=locale,
+                    on_phrase=on_phrase,
+                    on_language=on_language,
+                )
+            except _NotStreamableError:
+                # ffmpeg would have to seek to the index at the end of the file
+                _LOG.debug("[%s] Downloading file that can't be streamed", update_id)
+
+        # Splitting long audio can't be interrupted and might still write files
+        # after the job was abandoned
+        with TemporaryDirectory(
+            dir=self.config.scratch_dir,
+            ignore_cleanup_errors=True,
+        ) as scratch_path:
+            scratch_dir = Path(scratch_path)
+            artifact_cache = self.artifact_cache
+            profile_name = self.converter.profile.name
+
+            # A retry with another locale doesn't need to download or convert
+            # the file again
+            converted_audio_file = await artifact_cache.get(
+                file.file_unique_id,
+                profile_name,
+                destination=scratch_dir,
+            )
+            if converted_audio_file is not None:
+                _LOG.debug("[%s] Using cached converted audio", update_id)
+                job.skip(scheduler.download)
+                job.skip(scheduler.conversion)
+                if job.queued:
+                    self._clear_reaction(message)
+            else:
+                original_audio_file = await self._fetch_file(
+                    message,
+                    file,
+                    scratch_dir,
+                    job=job,
+                    update_id=update_id,
+                )
+                header = await read_header(original_audio_file)
+                if not is_long_audio and (
+                    audio_format := self._passthrough_format(header)
+                ):
+                    await artifact_cache.put(
+                        file.file_unique_id,
+                        ORIGINAL_VARIANT,
+                        original_audio_file,
                     )
-                    await self.usage_tracker.track(
-                        message,
-                        response_id=None,
-                        unique_file_id=file.file_unique_id,
-                        locale=locale,
+                    job.skip(scheduler.conversion)
+                    async with job.stage(scheduler.transcription):
+                        _LOG.debug(
+                            "[%s] Transcribing %s audio with locale %s",
+                            update_id,
+                            audio_format,
+                            locale,
+                        )
+                        return await self.transcriber.transcribe_compressed(
+                            read_chunks(original_audio_file),
+                            audio_format,
+                            locale=locale,
+                            on_phrase=on_phrase,
+                            on_language=on_language,
+                        )
+
+                async with job.stage(scheduler.conversion):
+                    _LOG.debug("[%s] Converting file", update_id)
+                    converted_audio_file = await self.converter.convert_to_wave(
+                        original_audio_file
                     )
-                return
 
-            result = self._easter_eggs(result)
+                await artifact_cache.put(
+                    file.file_unique_id,
+                    profile_name,
+                    converted_audio_file,
+                )
 
-            chunks = self._split_chunks(result)
-            _LOG.info(
-                "[%s] Sending message of length %d in %d chunks",
-                update_id,
-                len(result),
-                len(chunks),
+            audio_file = await self._compress_silence(
+                converted_audio_file,
+                update_id=update_id,
             )
-            first_response_message: Message | None = None
-            for chunk in chunks:
-                response_message = await message.reply_text(
-                    text=chunk,
-                    disable_notification=True,
+
+            async with job.stage(scheduler.transcription):
+                if is_long_audio:
+                    return await self._transcribe_long_audio(
+                        audio_file,
+                        scratch_dir,
+                        update_id=update_id,
+                        locale=locale,
+                        on_language=on_language,
+                    )
+
+                _LOG.debug(
+                    "[%s] Transcribing audio with locale %s",
+                    update_id,
+                    locale,
                 )
-                if first_response_message is None:
-                    first_response_message = response_message
-            await self.usage_tracker.track(
-                message,
-                response_id=first_response_message.message_id,  # type: ignore[union-attr]
-                unique_file_id=file.file_unique_id,
-                locale=locale,
+                return await self.transcriber.transcribe(
+                    audio_file,
+                    locale=locale,
+                    on_phrase=on_phrase,
+                    on_language=on_language,
+                )
+
+    async def _transcribe_streamed(
+        self,
+        message: Message,
+        file: Voice | Audio | VideoNote,
+        *,
+        job: Job,
+        update_id: int,
+        locale: str | None,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None],
+    ) -> str | None:
+        scheduler = self.scheduler
+        async with job.stage(scheduler.download):
+            stream = self._stream_file(file)
+            header, chunks = await peek_header(stream)
+            if not is_streamable(header):
+                await stream.aclose()
+                raise _NotStreamableError
+
+            if job.queued:
+                self._clear_reaction(message)
+
+            if audio_format := self._passthrough_format(header):
+                job.skip(scheduler.conversion)
+                async with job.stage(scheduler.transcription):
+                    _LOG.debug(
+                        "[%s] Streaming %s file into transcription with locale %s",
+                        update_id,
+                        audio_format,
+                        locale,
+                    )
+                    return await self.transcriber.transcribe_compressed(
+                        chunks,
+                        audio_format,
+                        locale=locale,
+                        on_phrase=on_phrase,
+                        on_language=on_language,
+                    )
+
+            async with (
+                job.stage(scheduler.conversion),
+                job.stage(scheduler.transcription),
+            ):
+                _LOG.debug(
+                    "[%s] Streaming file into transcription with locale %s",
+                    update_id,
+                    locale,
+                )
+                pcm_chunks = self.converter.stream_to_pcm(chunks)
+                if self._trims_silence:
+                    pcm_chunks = self._compress_silence_stream(pcm_chunks)
+                return await self.transcriber.transcribe_stream(
+                    pcm_chunks,
+                    locale=locale,
+                    on_phrase=on_phrase,
+                    on_language=on_language,
+                )
+
+    @property
+    def _trims_silence(self) -> bool:
+        # Relies on the mono PCM the speech profile produces
+        return (
+            self.config.silence_trimming.enabled
+            and self.converter.profile == SPEECH_PROFILE
+        )
+
+    async def _compress_silence(self, audio_file: Path, *, update_id: int) -> Path:
+        """
+        Shortens silence in the audio, since the speech service bills for it
+        and takes time to process it.
+        """
+        if not self._trims_silence:
+            return audio_file
+
+        config = self.config.silence_trimming
+
+        output_file = audio_file.with_name(f"{audio_file.stem}-trimmed.wav")
+        with tracer.start_as_current_span("compress_silence"):
+            removed_seconds = await asyncio.to_thread(
+                compress_silence_file,
+                audio_file,
+                output_file,
+                threshold_db=config.threshold_db,
+                padding_ms=config.padding_ms,
+                min_silence_ms=config.min_silence_ms,
+            )
+
+        _removed_silence.record(removed_seconds, {"mode": "file"})
+        if removed_seconds <= 0:
+            return audio_file
+
+        _LOG.debug("[%s] Removed %.1f seconds of silence", update_id, removed_seconds)
+        return output_file
+
+    async def _compress_silence_stream(
+        self,
+        pcm_chunks: AsyncIterable[bytes],
+    ) -> AsyncIterator[bytes]:
+        """Like `_compress_silence`, for PCM produced by `stream_to_pcm`."""
+        config = self.config.silence_trimming
+        compressor = SilenceCompressor(
+            sample_rate=PCM_SAMPLE_RATE,
+            threshold_db=config.threshold_db,
+            padding_ms=config.padding_ms,
+            min_silence_ms=config.min_silence_ms,
+        )
+        async for chunk in pcm_chunks:
+            if compressed := compressor.feed(chunk):
+                yield compressed
+
+        if rest := compressor.flush():
+            yield rest
+        _removed_silence.record(compressor.removed_seconds, {"mode": "stream"})
+
+    async def _fetch_file(
+        self,
+        message: Message,
+        file: Voice | Audio | VideoNote,
+        scratch_dir: Path,
+        *,
+        job: Job,
+        update_id: int,
+    ) -> Path:
+        scheduler = self.scheduler
+        audio_file = await self.artifact_cache.get(
+            file.file_unique_id,
+            ORIGINAL_VARIANT,
+            destination=scratch_dir,
+        )
+        if audio_file is not None:
+            _LOG.debug("[%s] Using cached original audio", update_id)
+            job.skip(scheduler.download)
+            if job.queued:
+                self._clear_reaction(message)
+            return audio_file
+
+        async with job.stage(scheduler.download):
+            if job.queued:
+                self._clear_reaction(message)
+
+            _LOG.debug("[%s] Downloading file", update_id)
+            return await self._download_file(file, scratch_dir)
+
+    def _clear_reaction(self, message: Message) -> None:
+        self.outbox.submit(
+            message.chat,
+            message.set_reaction,
+            priority=Priority.REACTION,
+        )
+
+    def _is_long_audio(self, file: Voice | Audio | VideoNote) -> bool:
+        # Splitting relies on the mono PCM the speech profile produces
+        return (
+            self.converter.profile == SPEECH_PROFILE
+            and _audio_seconds(file) >= self.config.long_audio.min_duration
+        )
+
+    async def _transcribe_long_audio(
+        self,
+        audio_file: Path,
+        scratch_dir: Path,
+        *,
+        update_id: int,
+        locale: str | None,
+        on_language: Callable[[str], None],
+    ) -> str | None:
+        config = self.config.long_audio
+        with tracer.start_as_current_span("split_at_silence"):
+            segments = await asyncio.to_thread(
+                split_wave_file,
+                audio_file,
+                scratch_dir,
+                max_segment_seconds=config.max_segment_duration,
+                threshold_db=config.silence_threshold_db,
             )
 
+        _LOG.debug(
+            "[%s] Transcribing long audio in %d segments with locale %s",
+            update_id,
+            len(segments),
+            locale,
+        )
+        # The job holds one transcription worker, segments running alongside
+        # the one using it have to borrow more
+        job_worker = asyncio.Lock()
+
+        @asynccontextmanager
+        async def segment_worker() -> AsyncIterator[None]:
+            if not job_worker.locked():
+                async with job_worker:
+                    yield
+            else:
+                async with self.scheduler.transcription.additional_worker():
+                    yield
+
+        return await self.transcriber.transcribe_segments(
+            segments,
+            locale=locale,
+            max_parallel=config.max_parallel_segments,
+            segment_worker=segment_worker,
+            on_language=on_language,
+        )
+
+    @property
+    def _uses_passthrough(self) -> bool:
+        # Silence can only be trimmed after decoding the audio
+        return self.config.compressed_passthrough and not self._trims_silence
+
+    def _passthrough_format(self, header: bytes) -> CompressedFormat | None:
+        if not self._uses_passthrough:
+            return None
+
+        return detect_compressed_format(header)
+
+    def _recognizer_pool_config(self) -> RecognizerPoolConfig:
+        config = self.config.recognizer_pool
+        if config.formats:
+            return config
+
+        # Keeps only connections warm that recognition will actually ask for
+        formats = []
+        if self.config.streaming_pipeline or self.converter.profile == SPEECH_PROFILE:
+            formats.append("pcm")
+        if self._uses_passthrough:
+            # Most compressed files are voice messages
+            formats.append(CompressedFormat.OGG_OPUS)
+        return replace(config, formats=formats)
+
     @tracer.start_as_current_span("download_file")
     async def _download_file(
         self,
         file: Voice | Audio | VideoNote,
         scratch_dir: Path,
     ) -> Path:
+        started_at = monotonic()
         prepared_file = await file.get_file()
 
         path = prepared_file.file_path
@@ -353,7 +1091,31 @@ class Bot:
         else:
             file_name = prepared_file.file_id
 
-        return await prepared_file.download_to_drive(scratch_dir / file_name)
+        downloaded_file = await prepared_file.download_to_drive(scratch_dir / file_name)
+        _download_duration.record(monotonic() - started_at, {"mode": "file"})
+        _downloaded_bytes.add(prepared_file.file_size or file.file_size or 0)
+        return downloaded_file
+
+    async def _stream_file(
+        self,
+        file: Voice | Audio | VideoNote,
+    ) -> AsyncGenerator[bytes]:
+        started_at = monotonic()
+        prepared_file = await file.get_file()
+        if not prepared_file.file_path:
+            raise OSError(f"No download path for file {file.file_unique_id}")
+
+        async with self.http_client.stream(
+            "GET",
+            prepared_file.file_path,
+        ) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                _downloaded_bytes.add(len(chunk))
+                yield chunk
+
+        # Includes the time the consumer needed for the chunks
+        _download_duration.record(monotonic() - started_at, {"mode": "stream"})
 
     @staticmethod
     def _split_chunks(
@@ -424,10 +1186,7 @@ class Bot:
             else:
                 target_chat_id = message.chat.id
 
-            state_storage = self.state_storage
-            state = await state_storage.load()
-            state.allow(target_chat_id)
-            await state_storage.store(state)
+            await self.greenlist.allow(target_chat_id)
             await message.set_reaction("👍")
 
     async def _deny_chat(
@@ -463,8 +1222,72 @@ class Bot:
                 await message.reply_text("Invalid chat ID")
                 return
 
-            state_storage = self.state_storage
-            state = await state_storage.load()
-            state.deny(target_chat_id)
-            await state_storage.store(state)
+            await self.greenlist.deny(target_chat_id)
             await message.set_reaction("👍")
+
+    async def _profile(
+        self,
+        update: Update,
+        context: ContextTypes.DEFAULT_TYPE,
+    ) -> None:
+        async with telegram_span(update=update, name="profile"):
+            if update.edited_message:
+                return
+
+            update_id = update.update_id
+            _LOG.info("[%s] Received command update", update_id)
+
+            message: Message = update.message  # type: ignore
+            admin_id = self.config.telegram.admin_id
+
+            from_user = message.from_user
+            if from_user is None:
+                _LOG.info("No from_user found.")
+                return
+
+            if from_user.id != admin_id:
+                _LOG.warning("Received admin command from non-admin")
+                await message.set_reaction("👎")
+                return
+
+            seconds_arg: str = context.args[0]  # type: ignore
+            max_duration = self.config.profiling.max_duration
+            try:
+                duration = timedelta(seconds=int(seconds_arg.strip()))
+            except ValueError:
+                await message.reply_text("Invalid duration")
+                return
+
+            if not timedelta(0) < duration <= max_duration:
+                max_seconds = int(max_duration.total_seconds())
+                await message.reply_text(
+                    f"Duration must be between 1 and {max_seconds} seconds"
+                )
+                return
+
+            if self.profiler.is_running:
+                await message.reply_text("Already profiling")
+                return
+
+            # Nothing may be awaited before profiling starts, or a second
+            # command could pass the check above as well
+            self.outbox.submit(
+                message.chat,
+                partial(message.set_reaction, "👀"),
+                priority=Priority.REACTION,
+            )
+            _LOG.info("[%s] Profiling for %s", update_id, duration)
+            stacks = await self.profiler.profile(duration)
+            # The stacks reveal internals, so they don't belong in a group
+            self.outbox.submit(
+                Chat(id=admin_id, type=ChatType.PRIVATE),
+                partial(
+                    context.bot.send_document,
+                    chat_id=admin_id,
+                    document=stacks.encode(),
+                    filename=f"profile-{update_id}.txt",
+                    caption="Collapsed stacks, e.g. for speedscope.app",
+                ),
+                priority=Priority.NOTICE,
+            )
+            self._clear_reaction(message)
@@ -0,0 +1,153 @@
+import logging
+from collections import OrderedDict
+from time import time
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics, trace
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+    from bot.config import TranscriptCacheConfig
+
+_LOG = logging.getLogger(__name__)
+_tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
+
+_hit_counter = _meter.create_counter(
+    "transcript_cache.hits",
+    description="Number of transcript cache hits",
+)
+_miss_counter = _meter.create_counter(
+    "transcript_cache.misses",
+    description="Number of transcript cache misses",
+)
+_saved_seconds_counter = _meter.create_counter(
+    "transcript_cache.saved_audio",
+    unit="s",
+    description="Audio duration that didn't have to be transcribed again",
+)
+
+
+class _LruCache:
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+        self._entries: OrderedDict[str, str] = OrderedDict()
+
+    def get(self, key: str) -> str | None:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        if self._max_entries <= 0:
+            return
+
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+class TranscriptCache:
+    """
+    Two-tier cache of finished transcripts, keyed by Telegram's file_unique_id
+    and the requested locale.
+
+    The first tier is a per-process LRU, the second one is shared between
+    replicas via Redis. Redis entries expire after the configured TTL, and the
+    oldest entries are evicted once more than `redis_entries` are stored.
+    """
+
+    def __init__(
+        self,
+        config: TranscriptCacheConfig,
+        *,
+        redis: Redis,
+        key_prefix: str,
+    ) -> None:
+        self._config = config
+        self._redis = redis
+        self._key_prefix = f"{key_prefix}:transcript"
+        self._index_key = f"{self._key_prefix}-index"
+        self._memory = _LruCache(config.memory_entries)
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_audio_seconds = 0
+
+    def _key(self, file_unique_id: str, locale: str | None) -> str:
+        return f"{self._key_prefix}:{file_unique_id}:{locale or 'auto'}"
+
+    def _record_hit(self, *, tier: str, audio_seconds: int) -> None:
+        self.hits += 1
+        self.saved_audio_seconds += audio_seconds
+        _hit_counter.add(1, {"tier": tier})
+        _saved_seconds_counter.add(audio_seconds, {"tier": tier})
+
+    async def get(
+        self,
+        *,
+        file_unique_id: str,
+        locale: str | None,
+        audio_seconds: int,
+    ) -> str | None:
+        with _tracer.start_as_current_span("transcript_cache.get") as span:
+            key = self._key(file_unique_id, locale)
+
+            if (result := self._memory.get(key)) is not None:
+                span.set_attribute("cache.tier", "memory")
+                self._record_hit(tier="memory", audio_seconds=audio_seconds)
+                return result
+
+            try:
+                result = await self._redis.get(key)
+            except Exception as e:
+                _LOG.warning("Could not read transcript from Redis", exc_info=e)
+                result = None
+
+            if result is not None:
+                span.set_attribute("cache.tier", "redis")
+                self._memory.put(key, result)
+                self._record_hit(tier="redis", audio_seconds=audio_seconds)
+                return result
+
+            span.set_attribute("cache.tier", "miss")
+            self.misses += 1
+            _miss_counter.add(1)
+            return None
+
+    async def put(
+        self,
+        *,
+        file_unique_id: str,
+        locale: str | None,
+        transcript: str,
+    ) -> None:
+        with _tracer.start_as_current_span("transcript_cache.put"):
+            key = self._key(file_unique_id, locale)
+            self._memory.put(key, transcript)
+
+            try:
+                async with self._redis.pipeline(transaction=True) as pipe:
+                    pipe.set(key, transcript, ex=self._config.ttl)
+                    pipe.zadd(self._index_key, {key: time()})
+                    # Entries that expired on their own are still in the index,
+                    # so prune them by age before enforcing the size bound.
+                    pipe.zremrangebyscore(
+                        self._index_key,
+                        "-inf",
+                        time() - self._config.ttl.total_seconds(),
+                    )
+                    pipe.zcard(self._index_key)
+                    *_, size = await pipe.execute()
+
+                overflow = size - self._config.redis_entries
+                if overflow > 0:
+                    evicted = await self._redis.zpopmin(self._index_key, overflow)
+                    if evicted:
+                        await self._redis.delete(*(key for key, _ in evicted))
+                        _LOG.debug("Evicted %d cached transcripts", len(evicted))
+            except Exception as e:
+                _LOG.warning("Could not store transcript in Redis", exc_info=e)
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import secrets
+from datetime import timedelta
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics, trace
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from redis.asyncio import Redis
+
+    from bot.cache import TranscriptCache
+    from bot.config import CoalescingConfig
+
+_LOG = logging.getLogger(__name__)
+_tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
+
+_joined_counter = _meter.create_counter(
+    "coalescing.joined",
+    description="Number of transcriptions that waited for an identical one",
+)
+_saved_seconds_counter = _meter.create_counter(
+    "coalescing.saved_audio",
+    unit="s",
+    description="Audio duration that didn't have to be transcribed twice",
+)
+
+_LEASE_POLL_INTERVAL = timedelta(seconds=1)
+
+# Only the replica holding the lease may extend or release it
+_RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class TranscriptionCoalescer:
+    """
+    Runs concurrent transcriptions of the same file and locale only once.
+
+    The first caller does the work and every caller that arrives while it's
+    running gets the same result. With the Redis lease enabled, this also
+    works across replicas: the replica holding the lease transcribes, the
+    others wait for the lease to go away and then read the transcript cache.
+    """
+
+    def __init__(
+        self,
+        config: CoalescingConfig,
+        *,
+        cache: TranscriptCache,
+        redis: Redis,
+        key_prefix: str,
+    ) -> None:
+        self._config = config
+        self._cache = cache
+        self._redis = redis
+        self._lease_key_prefix = f"{key_prefix}:transcription-lease"
+        self._renew_lease = redis.register_script(_RENEW_SCRIPT)
+        self._release_lease = redis.register_script(_RELEASE_SCRIPT)
+        self._in_flight: dict[tuple[str, str | None], asyncio.Future[str | None]] = {}
+
+        self.joined_waiters = 0
+        self.saved_audio_seconds = 0
+
+    async def transcribe(
+        self,
+        *,
+        file_unique_id: str,
+        locale: str | None,
+        audio_seconds: int,
+        transcribe: Callable[[], Awaitable[str | None]],
+    ) -> str | None:
+        """
+        Calls `transcribe` unless an identical transcription is already
+        running and stores its result in the transcript cache.
+
+        Errors of the shared transcription are raised to every waiter.
+        """
+        key = (file_unique_id, locale)
+        while (in_flight := self._in_flight.get(key)) is not None:
+            try:
+                result = await asyncio.shield(in_flight)
+            except asyncio.CancelledError:
+                # The first caller was cancelled, so one of us has to take over
+                if in_flight.cancelled():
+                    continue
+                raise
+
+            _LOG.debug("Joined running transcription of %s", file_unique_id)
+            self.joined_waiters += 1
+            self.saved_audio_seconds += audio_seconds
+            _joined_counter.add(1, {"scope": "local"})
+            _saved_seconds_counter.add(audio_seconds, {"scope": "local"})
+            return result
+
+        future: asyncio.Future[str | None] = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            if self._config.redis_lease:
+                result = await self._transcribe_with_lease(
+                    file_unique_id=file_unique_id,
+                    locale=locale,
+                    audio_seconds=audio_seconds,
+                    transcribe=transcribe,
+                )
+            else:
+                result = await self._transcribe_and_cache(
+                    file_unique_id=file_unique_id,
+                    locale=locale,
+                    transcribe=transcribe,
+                )
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Nobody might be waiting, which is fine
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    async def _transcribe_and_cache(
+        self,
+        *,
+        file_unique_id: str,
+        locale: str | None,
+        transcribe: Callable[[], Awaitable[str | None]],
+    ) -> str | None:
+        result = await transcribe()
+        if result:
+            await self._cache.put(
+                file_unique_id=file_unique_id,
+                locale=locale,
+                transcript=result,
+            )
+        return result
+
+    async def _transcribe_with_lease(
+        self,
+        *,
+        file_unique_id: str,
+        locale: str | None,
+        audio_seconds: int,
+        transcribe: Callable[[], Awaitable[str | None]],
+    ) -> str | None:
+        lease_key = f"{self._lease_key_prefix}:{file_unique_id}:{locale or 'auto'}"
+        token = secrets.token_hex(8)
+        lease_ms = int(self._config.lease_ttl.total_seconds() * 1000)
+
+        while True:
+            try:
+                acquired = await self._redis.set(lease_key, token, nx=True, px=lease_ms)
+            except Exception as e:
+                _LOG.warning("Could not acquire transcription lease", exc_info=e)
+                break
+
+            if acquired:
+                renewal = asyncio.create_task(
+                    self._keep_lease(lease_key, token, lease_ms)
+                )
+                try:
+                    return await self._transcribe_and_cache(
+                        file_unique_id=file_unique_id,
+                        locale=locale,
+                        transcribe=transcribe,
+                    )
+                finally:
+                    renewal.cancel()
+                    await asyncio.gather(renewal, return_exceptions=True)
+                    try:
+                        await self._release_lease(keys=[lease_key], args=[token])
+                    except Exception as e:
+                        _LOG.warning(
+                            "Could not release transcription lease",
+                            exc_info=e,
+                        )
+
+            if not await self._wait_for_lease(lease_key):
+                break
+
+            result = await self._cache.get(
+                file_unique_id=file_unique_id,
+                locale=locale,
+                audio_seconds=audio_seconds,
+            )
+            if result is not None:
+                # The saved audio is already reported by the cache
+                _LOG.debug(
+                    "Joined transcription of %s on other replica",
+                    file_unique_id,
+                )
+                self.joined_waiters += 1
+                _joined_counter.add(1, {"scope": "redis"})
+                return result
+
+            # The other replica failed or had no result, so try ourselves
+
+        return await self._transcribe_and_cache(
+            file_unique_id=file_unique_id,
+            locale=locale,
+            transcribe=transcribe,
+        )
+
+    async def _keep_lease(self, lease_key: str, token: str, lease_ms: int) -> None:
+        while True:
+            await asyncio.sleep(lease_ms / 3000)
+            try:
+                await self._renew_lease(keys=[lease_key], args=[token, lease_ms])
+            except Exception as e:
+                _LOG.warning("Could not renew transcription lease", exc_info=e)
+
+    async def _wait_for_lease(self, lease_key: str) -> bool:
+        """
+        Waits until the lease of another replica is gone.
+
+        Returns False if Redis can't tell us.
+        """
+        with _tracer.start_as_current_span("coalescing.wait_for_lease"):
+            while True:
+                try:
+                    if not await self._redis.exists(lease_key):
+                        return True
+                except Exception as e:
+                    _LOG.warning("Could not check transcription lease", exc_info=e)
+                    return False
+
+                await asyncio.sleep(_LEASE_POLL_INTERVAL.total_seconds())
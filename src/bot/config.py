@@ -1,13 +1,30 @@
 from dataclasses import dataclass
+from datetime import timedelta
+from enum import StrEnum
 from pathlib import Path
 from typing import TYPE_CHECKING, Self
 
 from bs_nats_updater import NatsConfig
 
+from bot.conversion import conversion_profiles
+
 if TYPE_CHECKING:
     from bs_config import Env
 
 
+def _conversion_profile(value: str) -> str:
+    if value not in conversion_profiles:
+        raise ValueError(
+            f"Unknown conversion profile {value!r},"
+            f" expected one of {', '.join(conversion_profiles)}"
+        )
+    return value
+
+
+def _split_list(value: str) -> list[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
 @dataclass
 class SentryConfig:
     dsn: str
@@ -27,15 +44,129 @@ class SentryConfig:
 
 
 @dataclass
-class AzureTtsConfig:
+class SpeechEndpointConfig:
     region: str
     key: str
+    weight: int
+
+
+@dataclass
+class HedgingConfig:
+    enabled: bool
+    # Percentile of the time to the first phrase to wait before hedging
+    percentile: int
+    default_delay: timedelta
+    min_delay: timedelta
+    max_delay: timedelta
+    failure_threshold: int
+    open_duration: timedelta
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            enabled=env.get_bool("enabled", default=True),
+            percentile=env.get_int("percentile", default=95),
+            default_delay=timedelta(
+                milliseconds=env.get_int("default-delay-ms", default=3000)
+            ),
+            min_delay=timedelta(milliseconds=env.get_int("min-delay-ms", default=500)),
+            max_delay=timedelta(
+                milliseconds=env.get_int("max-delay-ms", default=10_000)
+            ),
+            failure_threshold=env.get_int("failure-threshold", default=5),
+            open_duration=timedelta(
+                seconds=env.get_int("open-duration-seconds", default=30)
+            ),
+        )
+
+
+@dataclass
+class ArtifactCacheConfig:
+    enabled: bool
+    max_bytes: int
+    max_age: timedelta
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            enabled=env.get_bool("enabled", default=True),
+            max_bytes=env.get_int("max-megabytes", default=512) * 1024 * 1024,
+            max_age=timedelta(minutes=env.get_int("max-age-minutes", default=60)),
+        )
+
+
+@dataclass
+class AzureTtsConfig:
+    endpoints: list[SpeechEndpointConfig]
+    hedging: HedgingConfig
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        regions = [
+            env.get_string("speech-region", default="westeurope"),
+            *env.get_string(
+                "speech-secondary-regions",
+                default="",
+                transform=_split_list,
+            ),
+        ]
+        keys = [
+            env.get_string("speech-key", required=True),
+            *env.get_string(
+                "speech-secondary-keys",
+                default="",
+                transform=_split_list,
+            ),
+        ]
+        if len(regions) != len(keys):
+            raise ValueError("Got a different number of speech regions and keys")
+
+        weights = env.get_string(
+            "speech-weights",
+            default="",
+            transform=lambda value: [int(weight) for weight in _split_list(value)],
+        ) or [100] * len(regions)
+        if len(weights) != len(regions):
+            raise ValueError("Got a different number of speech regions and weights")
+
+        return cls(
+            endpoints=[
+                SpeechEndpointConfig(region=region, key=key, weight=weight)
+                for region, key, weight in zip(regions, keys, weights, strict=True)
+            ],
+            hedging=HedgingConfig.from_env(env / "hedging"),
+        )
+
+
+@dataclass
+class CoalescingConfig:
+    redis_lease: bool
+    lease_ttl: timedelta
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            redis_lease=env.get_bool("redis-lease", default=False),
+            lease_ttl=timedelta(seconds=env.get_int("lease-ttl-seconds", default=60)),
+        )
+
+
+@dataclass
+class SilenceTrimmingConfig:
+    # Trimming needs decoded audio, so it turns off the compressed passthrough.
+    # That saves billed silence, but every message is converted with ffmpeg.
+    enabled: bool
+    threshold_db: int
+    padding_ms: int
+    min_silence_ms: int
 
     @classmethod
     def from_env(cls, env: Env) -> Self:
         return cls(
-            region=env.get_string("speech-region", default="westeurope"),
-            key=env.get_string("speech-key", required=True),
+            enabled=env.get_bool("enabled", default=False),
+            threshold_db=env.get_int("threshold-db", default=-40),
+            padding_ms=env.get_int("padding-ms", default=300),
+            min_silence_ms=env.get_int("min-silence-ms", default=500),
         )
 
 
@@ -69,6 +200,80 @@ class DatabaseConfig:
         )
 
 
+@dataclass
+class LocaleLearningConfig:
+    enabled: bool
+    min_observations: int
+    min_share_percent: int
+    redetect_percent: int
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            enabled=env.get_bool("enabled", default=True),
+            min_observations=env.get_int("min-observations", default=3),
+            min_share_percent=env.get_int("min-share-percent", default=80),
+            redetect_percent=env.get_int("redetect-percent", default=10),
+        )
+
+
+@dataclass
+class LongAudioConfig:
+    min_duration: int
+    max_segment_duration: int
+    max_parallel_segments: int
+    silence_threshold_db: int
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            min_duration=env.get_int("min-duration", default=180),
+            max_segment_duration=env.get_int("max-segment-duration", default=60),
+            max_parallel_segments=env.get_int("max-parallel-segments", default=4),
+            silence_threshold_db=env.get_int("silence-threshold-db", default=-40),
+        )
+
+
+@dataclass
+class OutboxConfig:
+    global_rate: int
+    private_chat_rate: int
+    group_chat_rate: int
+    max_concurrent_sends: int
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            # Messages per second across all chats
+            global_rate=env.get_int("global-rate", default=30),
+            # Messages per minute within a single chat
+            private_chat_rate=env.get_int("private-chat-rate", default=60),
+            group_chat_rate=env.get_int("group-chat-rate", default=20),
+            max_concurrent_sends=env.get_int("max-concurrent-sends", default=4),
+        )
+
+
+@dataclass
+class ProfilingConfig:
+    stall_threshold: timedelta
+    sample_interval: timedelta
+    max_duration: timedelta
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            stall_threshold=timedelta(
+                milliseconds=env.get_int("stall-threshold-ms", default=250)
+            ),
+            sample_interval=timedelta(
+                milliseconds=env.get_int("sample-interval-ms", default=10)
+            ),
+            max_duration=timedelta(
+                seconds=env.get_int("max-duration-seconds", default=120)
+            ),
+        )
+
+
 @dataclass
 class RateLimitConfig:
     daily: int
@@ -80,6 +285,36 @@ class RateLimitConfig:
         )
 
 
+@dataclass
+class RecognizerPoolConfig:
+    size: int
+    idle_timeout: timedelta
+    # "pcm" or a CompressedFormat value, by default the formats of the enabled
+    # recognition paths
+    formats: list[str]
+    # Locales or "auto" for auto-detection
+    locales: list[str]
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            size=env.get_int("size", default=2),
+            idle_timeout=timedelta(
+                seconds=env.get_int("idle-timeout-seconds", default=120)
+            ),
+            formats=env.get_string(
+                "formats",
+                default="",
+                transform=_split_list,
+            ),
+            locales=env.get_string(
+                "locales",
+                default="auto",
+                transform=_split_list,
+            ),
+        )
+
+
 @dataclass
 class RedisStateConfig:
     host: str
@@ -95,28 +330,135 @@ class RedisStateConfig:
         )
 
 
+class OverflowPolicy(StrEnum):
+    REJECT = "reject"
+    QUEUE = "queue"
+
+
+@dataclass
+class SchedulerConfig:
+    download_workers: int
+    conversion_workers: int
+    transcription_workers: int
+    queue_size: int
+    overflow_policy: OverflowPolicy
+    # A job may take this long plus a share of the audio duration
+    deadline_base: timedelta
+    deadline_audio_percent: int
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            download_workers=env.get_int("download-workers", default=4),
+            conversion_workers=env.get_int("conversion-workers", default=2),
+            transcription_workers=env.get_int("transcription-workers", default=8),
+            queue_size=env.get_int("queue-size", default=16),
+            overflow_policy=env.get_string(
+                "overflow-policy",
+                default=OverflowPolicy.QUEUE,
+                transform=OverflowPolicy,
+            ),
+            deadline_base=timedelta(
+                seconds=env.get_int("deadline-base-seconds", default=60)
+            ),
+            deadline_audio_percent=env.get_int("deadline-audio-percent", default=200),
+        )
+
+
+@dataclass
+class TracingConfig:
+    sample_percent: int
+    # Traces that take longer than this are kept regardless of sampling
+    slow_threshold: timedelta
+    max_buffered_traces: int
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            sample_percent=env.get_int("sample-percent", default=10),
+            slow_threshold=timedelta(
+                seconds=env.get_int("slow-threshold-seconds", default=20)
+            ),
+            max_buffered_traces=env.get_int("max-buffered-traces", default=512),
+        )
+
+
+@dataclass
+class TranscriptCacheConfig:
+    memory_entries: int
+    redis_entries: int
+    ttl: timedelta
+
+    @classmethod
+    def from_env(cls, env: Env) -> Self:
+        return cls(
+            memory_entries=env.get_int("memory-entries", default=512),
+            redis_entries=env.get_int("redis-entries", default=10_000),
+            ttl=timedelta(hours=env.get_int("ttl-hours", default=24 * 7)),
+        )
+
+
 @dataclass
 class Config:
+    artifact_cache: ArtifactCacheConfig
     azure_tts: AzureTtsConfig
+    coalescing: CoalescingConfig
+    compressed_passthrough: bool
+    conversion_profile: str
     database: DatabaseConfig
     enable_telemetry: bool
+    locale_learning: LocaleLearningConfig
+    long_audio: LongAudioConfig
     nats: NatsConfig
+    outbox: OutboxConfig
+    profiling: ProfilingConfig
+    progressive_replies: bool
     rate_limit: RateLimitConfig
+    recognizer_pool: RecognizerPoolConfig
     redis: RedisStateConfig
+    scheduler: SchedulerConfig
     scratch_dir: Path | None
     sentry: SentryConfig | None
+    silence_trimming: SilenceTrimmingConfig
+    streaming_pipeline: bool
     telegram: TelegramConfig
+    tracing: TracingConfig
+    transcript_cache: TranscriptCacheConfig
 
     @classmethod
     def from_env(cls, env: Env) -> Self:
         return cls(
+            artifact_cache=ArtifactCacheConfig.from_env(env / "artifact-cache"),
             azure_tts=AzureTtsConfig.from_env(env / "azure"),
+            coalescing=CoalescingConfig.from_env(env / "coalescing"),
+            # Only applies while silence trimming is disabled, see
+            # SilenceTrimmingConfig
+            compressed_passthrough=env.get_bool(
+                "compressed-passthrough",
+                default=True,
+            ),
+            conversion_profile=env.get_string(
+                "conversion-profile",
+                default="speech",
+                transform=_conversion_profile,
+            ),
             database=DatabaseConfig.from_env(env / "db"),
             enable_telemetry=env.get_bool("enable-telemetry", default=False),
+            locale_learning=LocaleLearningConfig.from_env(env / "locale-learning"),
+            long_audio=LongAudioConfig.from_env(env / "long-audio"),
             nats=NatsConfig.from_env(env / "nats"),
+            outbox=OutboxConfig.from_env(env / "outbox"),
+            profiling=ProfilingConfig.from_env(env / "profiling"),
+            progressive_replies=env.get_bool("progressive-replies", default=False),
             rate_limit=RateLimitConfig.from_env(env / "rate-limit"),
+            recognizer_pool=RecognizerPoolConfig.from_env(env / "recognizer-pool"),
             redis=RedisStateConfig.from_env(env / "state" / "redis"),
+            scheduler=SchedulerConfig.from_env(env / "scheduler"),
             scratch_dir=env.get_string("scratch-dir", transform=Path),
             sentry=SentryConfig.from_env(env),
+            silence_trimming=SilenceTrimmingConfig.from_env(env / "silence-trimming"),
+            streaming_pipeline=env.get_bool("streaming-pipeline", default=False),
             telegram=TelegramConfig.from_env(env / "telegram"),
+            tracing=TracingConfig.from_env(env / "tracing"),
+            transcript_cache=TranscriptCacheConfig.from_env(env / "transcript-cache"),
         )
@@ -1,48 +1,340 @@
 import asyncio
 import logging
-from typing import TYPE_CHECKING
+import wave
+from dataclasses import dataclass
+from enum import StrEnum
+from time import monotonic
+from typing import TYPE_CHECKING, cast
 
-from opentelemetry import trace
+from opentelemetry import metrics, trace
+
+from bot.log_queue import process_output
 
 if TYPE_CHECKING:
+    from collections.abc import AsyncIterable, AsyncIterator
     from pathlib import Path
 
 _LOG = logging.getLogger(__name__)
 _tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
+
+_ffmpeg_duration = _meter.create_histogram(
+    "ffmpeg.duration",
+    unit="s",
+    description="Duration of ffmpeg conversions by mode and profile",
+)
+
+# Format of the raw PCM produced by the streaming conversion
+PCM_SAMPLE_RATE = 16000
+PCM_BITS_PER_SAMPLE = 16
+PCM_CHANNELS = 1
+
+_STREAM_CHUNK_SIZE = 32 * 1024
+_HEADER_SIZE = 64
+
+
+@dataclass(frozen=True)
+class ConversionProfile:
+    name: str
+    input_args: tuple[str, ...]
+    output_args: tuple[str, ...]
+
+
+# What we did originally: keep everything as it is, just decode to WAV
+LEGACY_PROFILE = ConversionProfile(
+    name="legacy",
+    input_args=(),
+    output_args=(),
+)
+
+# Only what the speech service needs: the first audio stream as 16 kHz mono PCM.
+# Probing is kept to a minimum and each process gets a single thread, because
+# we'd rather run multiple conversions in parallel.
+SPEECH_PROFILE = ConversionProfile(
+    name="speech",
+    input_args=(
+        "-nostdin",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-probesize",
+        "32k",
+        "-analyzeduration",
+        "0",
+        "-threads",
+        "1",
+    ),
+    output_args=(
+        "-map",
+        "0:a:0",
+        "-vn",
+        "-ac",
+        str(PCM_CHANNELS),
+        "-ar",
+        str(PCM_SAMPLE_RATE),
+        "-c:a",
+        f"pcm_s{PCM_BITS_PER_SAMPLE}le",
+        "-threads",
+        "1",
+    ),
+)
+
+conversion_profiles = {
+    profile.name: profile for profile in (LEGACY_PROFILE, SPEECH_PROFILE)
+}
+
+
+class CompressedFormat(StrEnum):
+    """Compressed formats the speech service can decode on its own."""
+
+    OGG_OPUS = "ogg_opus"
+    MP3 = "mp3"
+    FLAC = "flac"
+
+
+def detect_compressed_format(header: bytes) -> CompressedFormat | None:
+    """
+    Detects the container format based on the first bytes of a file.
+
+    Returns None if the format needs to be converted first.
+    """
+    if header.startswith(b"OggS"):
+        # The first Ogg page contains the codec's identification header
+        if b"OpusHead" in header[:_HEADER_SIZE]:
+            return CompressedFormat.OGG_OPUS
+        return None
+
+    if header.startswith(b"fLaC"):
+        return CompressedFormat.FLAC
+
+    if header.startswith(b"ID3") or _is_mp3_frame(header):
+        return CompressedFormat.MP3
+
+    return None
+
+
+def _is_mp3_frame(header: bytes) -> bool:
+    """
+    Checks for the header of an MPEG audio Layer III frame.
+
+    AAC in ADTS uses the same sync word, but its version bits would be the
+    reserved 01 and its layer bits are always 00.
+    """
+    if len(header) < 2 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return False
+
+    version = (header[1] >> 3) & 0b11
+    layer = (header[1] >> 1) & 0b11
+    return version != 0b01 and layer == 0b01
+
+
+def is_streamable(header: bytes) -> bool:
+    """
+    Checks whether ffmpeg can decode a file from a pipe, based on its first
+    bytes.
+
+    MP4 and related containers (M4A, MOV) can only be read sequentially if
+    their index (the "moov" box) comes before the media data, but many
+    encoders write it at the end.
+    """
+    if header[4:8] != b"ftyp":
+        return True
+
+    ftyp_size = int.from_bytes(header[:4], "big")
+    return header[ftyp_size + 4 : ftyp_size + 8] == b"moov"
+
+
+async def peek_header(
+    chunks: AsyncIterator[bytes],
+) -> tuple[bytes, AsyncIterator[bytes]]:
+    """
+    Reads enough of the given chunks to detect the format.
+
+    Returns the header and an iterator that yields all chunks, including the
+    ones that were consumed to read the header.
+    """
+    consumed: list[bytes] = []
+    size = 0
+    async for chunk in chunks:
+        consumed.append(chunk)
+        size += len(chunk)
+        if size >= _HEADER_SIZE:
+            break
+
+    async def replay() -> AsyncIterator[bytes]:
+        for chunk in consumed:
+            yield chunk
+        async for chunk in chunks:
+            yield chunk
+
+    return b"".join(consumed)[:_HEADER_SIZE], replay()
+
+
+async def read_header(path: Path) -> bytes:
+    return await asyncio.to_thread(_read_header, path)
+
+
+def _read_header(path: Path) -> bytes:
+    with path.open("rb") as f:
+        return f.read(_HEADER_SIZE)
+
+
+async def read_chunks(path: Path) -> AsyncIterator[bytes]:
+    with path.open("rb") as f:
+        while chunk := await asyncio.to_thread(f.read, _STREAM_CHUNK_SIZE):
+            yield chunk
+
+
+def is_pcm_wave(path: Path) -> bool:
+    """
+    Checks whether a WAV file contains raw PCM in the format the streaming
+    conversion produces (see `PCM_SAMPLE_RATE` etc.).
+    """
+    try:
+        with wave.open(str(path), "rb") as wav:
+            return (
+                wav.getnchannels() == PCM_CHANNELS
+                and wav.getsampwidth() * 8 == PCM_BITS_PER_SAMPLE
+                and wav.getframerate() == PCM_SAMPLE_RATE
+            )
+    except (EOFError, wave.Error) as e:
+        _LOG.debug("Could not read WAV header of %s", path, exc_info=e)
+        return False
+
+
+async def read_wave_frames(path: Path) -> AsyncIterator[bytes]:
+    """Reads the audio data of a WAV file in chunks, without the header."""
+    with wave.open(str(path), "rb") as wav:
+        frame_count = _STREAM_CHUNK_SIZE // (wav.getsampwidth() * wav.getnchannels())
+        while chunk := await asyncio.to_thread(wav.readframes, frame_count):
+            yield chunk
 
 
 class AudioConverter:
-    def __init__(self) -> None:
-        pass
+    def __init__(self, profile: ConversionProfile = SPEECH_PROFILE) -> None:
+        self.profile = profile
 
     async def convert_to_wave(self, input_file: Path) -> Path:
-        with _tracer.start_as_current_span("convert_to_wave"):
-            output_file = input_file.with_suffix(".wav")
-            if output_file == input_file:
-                _LOG.info(
-                    "Short-circuiting due to input file already having wave format"
+        profile = self.profile
+        with _tracer.start_as_current_span(
+            "convert_to_wave",
+            attributes={"conversion.profile": profile.name},
+        ):
+            if profile == LEGACY_PROFILE:
+                output_file = input_file.with_suffix(".wav")
+                if output_file == input_file:
+                    _LOG.info(
+                        "Short-circuiting due to input file already having wave format"
+                    )
+                    return input_file
+            else:
+                output_file = input_file.with_name(
+                    f"{input_file.stem}-{profile.name}.wav"
                 )
-                return input_file
 
+            started_at = monotonic()
             with _tracer.start_as_current_span("ffmpeg"):
                 process = await asyncio.create_subprocess_exec(
                     "ffmpeg",
+                    *profile.input_args,
                     "-i",
                     input_file,
+                    *profile.output_args,
                     output_file,
                     stdout=asyncio.subprocess.PIPE,
                     stderr=asyncio.subprocess.PIPE,
                 )
 
-                stdout, stderr = await process.communicate()
+                try:
+                    stdout, stderr = await process.communicate()
+                except asyncio.CancelledError:
+                    # Don't leave ffmpeg running when the job is abandoned
+                    process.kill()
+                    await process.wait()
+                    raise
 
+            _ffmpeg_duration.record(
+                monotonic() - started_at,
+                {"mode": "file", "profile": profile.name},
+            )
             return_code = process.returncode
             if return_code:
                 _LOG.error(
                     "Converted file with exit code %d",
                     return_code,
-                    extra=dict(stdout=stdout, stderr=stderr),
+                    extra=dict(
+                        stdout=process_output(stdout),
+                        stderr=process_output(stderr),
+                    ),
                 )
                 raise OSError("Could not convert file")
 
             return output_file
+
+    async def stream_to_pcm(
+        self,
+        chunks: AsyncIterable[bytes],
+    ) -> AsyncIterator[bytes]:
+        """
+        Pipes the given input chunks through ffmpeg and yields raw PCM
+        (see `PCM_SAMPLE_RATE` etc.) as soon as ffmpeg produces it.
+        """
+        # Not using start_as_current_span because the context would leak
+        # across the yield points of this generator.
+        span = _tracer.start_span("ffmpeg_stream")
+        started_at = monotonic()
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            *SPEECH_PROFILE.input_args,
+            "-i",
+            "pipe:0",
+            *SPEECH_PROFILE.output_args,
+            "-f",
+            f"s{PCM_BITS_PER_SAMPLE}le",
+            "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdin = cast(asyncio.StreamWriter, process.stdin)
+        stdout = cast(asyncio.StreamReader, process.stdout)
+        stderr = cast(asyncio.StreamReader, process.stderr)
+
+        async def write_input() -> None:
+            try:
+                async for chunk in chunks:
+                    stdin.write(chunk)
+                    await stdin.drain()
+            except ConnectionError:
+                # ffmpeg exited early, its exit code tells us what happened
+                pass
+            finally:
+                stdin.close()
+
+        writer = asyncio.create_task(write_input())
+        stderr_reader = asyncio.create_task(stderr.read())
+        try:
+            while chunk := await stdout.read(_STREAM_CHUNK_SIZE):
+                yield chunk
+
+            await writer
+            return_code = await process.wait()
+            stderr_output = await stderr_reader
+            _ffmpeg_duration.record(
+                monotonic() - started_at,
+                {"mode": "stream", "profile": SPEECH_PROFILE.name},
+            )
+        finally:
+            writer.cancel()
+            stderr_reader.cancel()
+            if process.returncode is None:
+                process.kill()
+            span.end()
+
+        if return_code:
+            _LOG.error(
+                "Streamed conversion exited with code %d",
+                return_code,
+                extra=dict(stderr=process_output(stderr_output)),
+            )
+            raise OSError("Could not convert stream")
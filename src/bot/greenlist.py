@@ -0,0 +1,130 @@
+import asyncio
+import logging
+from datetime import timedelta
+from typing import TYPE_CHECKING
+
+from opentelemetry import trace
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+    from bot.state import GreenlistStorage
+
+_LOG = logging.getLogger(__name__)
+_tracer = trace.get_tracer(__name__)
+
+_VERSION_CHECK_INTERVAL = timedelta(minutes=1)
+_RECONNECT_DELAY = timedelta(seconds=5)
+
+
+class Greenlist:
+    """
+    In-memory copy of the greenlist state.
+
+    Every change increments a version counter in Redis and is announced on a
+    pub/sub channel, so that all replicas reload their copy. In case a
+    notification is missed, the version counter is also checked periodically.
+    """
+
+    def __init__(
+        self,
+        storage: GreenlistStorage,
+        *,
+        redis: Redis,
+        key_prefix: str,
+    ) -> None:
+        self._storage = storage
+        self._redis = redis
+        self._channel = f"{key_prefix}:greenlist-changes"
+        self._version_key = f"{key_prefix}:greenlist-version"
+        self._version: str | None = None
+        self._allowed_chat_ids: frozenset[int] = frozenset()
+        self._informed_chats: frozenset[int] = frozenset()
+        self._tasks: list[asyncio.Task[None]] = []
+
+    async def start(self) -> None:
+        await self.refresh()
+        self._tasks = [
+            asyncio.create_task(self._listen_for_changes()),
+            asyncio.create_task(self._check_version_periodically()),
+        ]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def is_allowed(self, chat_id: int) -> bool:
+        if chat_id in self._allowed_chat_ids:
+            return True
+
+        # The chat might have been allowed very recently, and we haven't
+        # received the notification yet.
+        return await self._storage.is_allowed(chat_id)
+
+    def was_informed(self, chat_id: int) -> bool:
+        return chat_id in self._informed_chats
+
+    @_tracer.start_as_current_span("greenlist.refresh")
+    async def refresh(self) -> None:
+        # Read the version first, so a concurrent change triggers another refresh
+        version = await self._redis.get(self._version_key)
+        snapshot = await self._storage.load()
+        self._allowed_chat_ids = snapshot.allowed_chat_ids
+        self._informed_chats = snapshot.informed_chats
+        self._version = version
+        _LOG.debug("Refreshed greenlist (version %s)", version)
+
+    async def _publish_change(self) -> None:
+        await self._redis.incr(self._version_key)
+        await self._redis.publish(self._channel, "changed")
+        await self.refresh()
+
+    async def allow(self, chat_id: int) -> None:
+        await self._storage.allow(chat_id)
+        await self._publish_change()
+
+    async def deny(self, chat_id: int) -> None:
+        await self._storage.deny(chat_id)
+        await self._publish_change()
+
+    async def informed_chat(self, chat_id: int) -> bool:
+        """
+        Marks the chat as informed.
+
+        Returns True if the chat had not been informed yet, even by a
+        concurrent task or another replica.
+        """
+        if not await self._storage.informed_chat(chat_id):
+            return False
+
+        await self._publish_change()
+        return True
+
+    async def _listen_for_changes(self) -> None:
+        while True:
+            try:
+                async with self._redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self._channel)
+                    # We might have missed a change while (re-)connecting
+                    await self.refresh()
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                _LOG.error("Lost greenlist change subscription", exc_info=e)
+                await asyncio.sleep(_RECONNECT_DELAY.total_seconds())
+
+    async def _check_version_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(_VERSION_CHECK_INTERVAL.total_seconds())
+            try:
+                version = await self._redis.get(self._version_key)
+                if version != self._version:
+                    _LOG.info("Greenlist version changed without notification")
+                    await self.refresh()
+            except Exception as e:
+                _LOG.error("Could not check greenlist version", exc_info=e)
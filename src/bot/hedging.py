@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import random
+import statistics
+from collections import deque
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics, trace
+
+from bot.recognition import TranscriptionError
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterable, AsyncIterator, Awaitable, Callable
+
+    from bot.config import HedgingConfig
+    from bot.recognition import RecognitionBackend
+
+    # Runs the recognition on the given backend, passing on phrases and the
+    # detected language to the given callbacks
+    Attempt = Callable[
+        [RecognitionBackend, Callable[[str], None], Callable[[str], None]],
+        Awaitable[str | None],
+    ]
+    _Outcome = tuple[str | None, list[str]]
+
+_LOG = logging.getLogger(__name__)
+_tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
+
+_attempt_counter = _meter.create_counter(
+    "speech.attempts",
+    description="Number of recognition attempts by endpoint and outcome",
+)
+_hedge_counter = _meter.create_counter(
+    "speech.hedges",
+    description="Number of hedged recognitions by whether the hedge won",
+)
+_circuit_counter = _meter.create_counter(
+    "speech.circuit_opened",
+    description="Number of times an endpoint was taken out of rotation",
+)
+
+# Number of recent first-phrase latencies kept per endpoint
+_LATENCY_WINDOW = 200
+# Below this, the default hedge delay is used
+_MIN_LATENCY_SAMPLES = 20
+
+
+class ReplayableChunks:
+    """
+    Reads an iterable of chunks once, but lets any number of consumers read
+    it from the start, even while it's still being read.
+    """
+
+    def __init__(self, chunks: AsyncIterable[bytes]) -> None:
+        self._source = aiter(chunks)
+        self._chunks: list[bytes] = []
+        self._is_done = False
+        self._error: Exception | None = None
+        self._lock = asyncio.Lock()
+
+    async def _read_next(self) -> None:
+        async with self._lock:
+            if self._is_done:
+                return
+
+            try:
+                self._chunks.append(await anext(self._source))
+            except StopAsyncIteration:
+                self._is_done = True
+            except Exception as e:
+                self._error = e
+                self._is_done = True
+
+    async def replay(self) -> AsyncIterator[bytes]:
+        index = 0
+        while True:
+            if index < len(self._chunks):
+                yield self._chunks[index]
+                index += 1
+            elif self._is_done:
+                if self._error is not None:
+                    raise self._error
+                return
+            else:
+                # Another consumer might read the chunk while we wait for the lock
+                await self._read_next()
+
+    async def aclose(self) -> None:
+        if aclose := getattr(self._source, "aclose", None):
+            await aclose()
+
+
+class _Endpoint:
+    def __init__(self, backend: RecognitionBackend, config: HedgingConfig) -> None:
+        self.backend = backend
+        self._config = config
+        self._attributes = {"endpoint": backend.name}
+        self._latencies: deque[float] = deque(maxlen=_LATENCY_WINDOW)
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+
+    def is_available(self) -> bool:
+        return self._open_until <= monotonic()
+
+    def hedge_delay(self) -> float:
+        """
+        Returns how long to wait for the first phrase before hedging, based on
+        the recent latencies of this endpoint.
+        """
+        config = self._config
+        if len(self._latencies) < _MIN_LATENCY_SAMPLES:
+            return config.default_delay.total_seconds()
+
+        percentiles = statistics.quantiles(self._latencies, n=100)
+        delay = percentiles[config.percentile - 1]
+        return min(
+            max(delay, config.min_delay.total_seconds()),
+            config.max_delay.total_seconds(),
+        )
+
+    def record_first_phrase(self, seconds: float) -> None:
+        self._latencies.append(seconds)
+
+    def record_success(self) -> None:
+        self._consecutive_failures = 0
+        _attempt_counter.add(1, {**self._attributes, "outcome": "success"})
+
+    def record_failure(self) -> None:
+        _attempt_counter.add(1, {**self._attributes, "outcome": "failure"})
+        self._consecutive_failures += 1
+        config = self._config
+        if self._consecutive_failures >= config.failure_threshold:
+            _LOG.warning(
+                "Taking speech endpoint %s out of rotation after %d failures",
+                self.backend.name,
+                self._consecutive_failures,
+            )
+            _circuit_counter.add(1, self._attributes)
+            self._open_until = monotonic() + config.open_duration.total_seconds()
+            # A single failure after the break opens the circuit again
+            self._consecutive_failures = config.failure_threshold - 1
+
+    def record_cancellation(self) -> None:
+        _attempt_counter.add(1, {**self._attributes, "outcome": "canceled"})
+
+
+class EndpointRouter:
+    """
+    Distributes recognitions across endpoints by weight and hedges slow ones.
+
+    An attempt that hasn't recognized any phrase after a delay derived from
+    the endpoint's recent latencies (or that failed) gets a second attempt on
+    another endpoint. The first attempt that succeeds wins and the other one
+    is canceled. Endpoints that fail repeatedly are skipped for a while.
+    """
+
+    def __init__(
+        self,
+        backends: list[RecognitionBackend],
+        config: HedgingConfig,
+    ) -> None:
+        if not backends:
+            raise ValueError("At least one speech endpoint is required")
+
+        self._config = config
+        self._endpoints = [_Endpoint(backend, config) for backend in backends]
+
+    @property
+    def can_hedge(self) -> bool:
+        return self._config.enabled and len(self._endpoints) > 1
+
+    def _choose(self, exclude: _Endpoint | None = None) -> _Endpoint | None:
+        candidates = [
+            endpoint
+            for endpoint in self._endpoints
+            if endpoint is not exclude and endpoint.is_available()
+        ]
+        if not candidates:
+            if exclude is not None:
+                return None
+            # Better to try a broken endpoint than to fail right away
+            candidates = self._endpoints
+
+        [endpoint] = random.choices(
+            candidates,
+            weights=[endpoint.backend.weight for endpoint in candidates],
+        )
+        return endpoint
+
+    async def recognize(
+        self,
+        attempt: Attempt,
+        *,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        primary = self._choose()
+        assert primary is not None
+        first_phrase = asyncio.Event()
+
+        async def run(endpoint: _Endpoint, *, is_primary: bool) -> _Outcome:
+            languages: list[str] = []
+            started_at = monotonic()
+
+            def add_phrase(text: str) -> None:
+                # Phrases of the hedge would duplicate the ones already
+                # passed on, the final result replaces them anyway.
+                if not is_primary:
+                    return
+
+                if not first_phrase.is_set():
+                    endpoint.record_first_phrase(monotonic() - started_at)
+                    first_phrase.set()
+                if on_phrase is not None:
+                    on_phrase(text)
+
+            with _tracer.start_as_current_span(
+                "recognition_attempt",
+                attributes={
+                    "endpoint": endpoint.backend.name,
+                    "hedge": not is_primary,
+                },
+            ):
+                try:
+                    result = await attempt(
+                        endpoint.backend,
+                        add_phrase,
+                        languages.append,
+                    )
+                except TranscriptionError:
+                    endpoint.record_failure()
+                    raise
+                except asyncio.CancelledError:
+                    endpoint.record_cancellation()
+                    raise
+
+            endpoint.record_success()
+            return result, languages
+
+        primary_task = asyncio.create_task(run(primary, is_primary=True))
+        tasks = {primary_task}
+        hedge_task: asyncio.Task[_Outcome] | None = None
+        phrase_waiter = asyncio.create_task(first_phrase.wait())
+        try:
+            if self.can_hedge:
+                await asyncio.wait(
+                    [primary_task, phrase_waiter],
+                    timeout=primary.hedge_delay(),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not first_phrase.is_set() and _may_hedge(primary_task):
+                    if secondary := self._choose(exclude=primary):
+                        _LOG.info(
+                            "Hedging recognition on %s with %s",
+                            primary.backend.name,
+                            secondary.backend.name,
+                        )
+                        hedge_task = asyncio.create_task(
+                            run(secondary, is_primary=False)
+                        )
+                        tasks.add(hedge_task)
+
+            winner = await _first_success(tasks)
+            if hedge_task is not None:
+                _hedge_counter.add(1, {"won": winner is hedge_task})
+        finally:
+            phrase_waiter.cancel()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(phrase_waiter, *tasks, return_exceptions=True)
+
+        result, languages = winner.result()
+        # Only the language detected by the winning attempt counts
+        if on_language is not None and languages:
+            on_language(languages[0])
+        return result
+
+
+def _may_hedge(task: asyncio.Task[_Outcome]) -> bool:
+    """Whether another attempt could still be faster or succeed."""
+    if not task.done():
+        return True
+
+    return not task.cancelled() and isinstance(task.exception(), TranscriptionError)
+
+
+async def _first_success(
+    tasks: set[asyncio.Task[_Outcome]],
+) -> asyncio.Task[_Outcome]:
+    pending = set(tasks)
+    error: BaseException | None = None
+    while pending:
+        done, pending = await asyncio.wait(
+            pending,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        for task in done:
+            if (task_error := task.exception()) is None:
+                return task
+
+            if not isinstance(task_error, TranscriptionError):
+                # Not the endpoint's fault, another attempt won't fare better
+                raise task_error
+
+            error = error or task_error
+
+    assert error is not None
+    raise error
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import random
+from datetime import timedelta
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics, trace
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+    from bot.usage import UsageTracker
+
+_LOG = logging.getLogger(__name__)
+_tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
+
+_run_counter = _meter.create_counter(
+    "housekeeping.runs",
+    description="Number of housekeeping runs by outcome",
+)
+_run_duration = _meter.create_histogram(
+    "housekeeping.duration",
+    unit="s",
+    description="Duration of housekeeping runs",
+)
+
+_INTERVAL = timedelta(hours=1)
+_JITTER = 0.1
+# Shorter than the interval, so the next run on any replica isn't blocked
+_LOCK_DURATION = timedelta(minutes=45)
+
+
+class Housekeeper:
+    """
+    Periodically deletes usages that are past their retention time.
+
+    Runs are spread out with some jitter. Each run first takes a lock in Redis,
+    which is left to expire on its own, so only one replica does the work per
+    interval.
+    """
+
+    def __init__(
+        self,
+        usage_tracker: UsageTracker,
+        *,
+        redis: Redis,
+        key_prefix: str,
+    ) -> None:
+        self._usage_tracker = usage_tracker
+        self._redis = redis
+        self._lock_key = f"{key_prefix}:housekeeping-lock"
+        self._task: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run_periodically())
+
+    async def close(self) -> None:
+        if task := self._task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self._task = None
+
+    @staticmethod
+    def _next_delay() -> float:
+        return _INTERVAL.total_seconds() * random.uniform(1 - _JITTER, 1 + _JITTER)
+
+    async def _run_periodically(self) -> None:
+        # Don't run right away, so restarting replicas don't pile up runs
+        await asyncio.sleep(random.uniform(0, _JITTER) * _INTERVAL.total_seconds())
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                _LOG.error("Housekeeping failed", exc_info=e)
+                _run_counter.add(1, {"outcome": "failed"})
+
+            await asyncio.sleep(self._next_delay())
+
+    @_tracer.start_as_current_span("housekeeping")
+    async def run_once(self) -> None:
+        acquired = await self._redis.set(
+            self._lock_key,
+            "locked",
+            nx=True,
+            ex=_LOCK_DURATION,
+        )
+        if not acquired:
+            _LOG.debug("Skipping housekeeping, another replica did it recently")
+            _run_counter.add(1, {"outcome": "skipped"})
+            return
+
+        _LOG.info("Running rate limiter housekeeping")
+        start = monotonic()
+        await self._usage_tracker.do_housekeeping()
+        _run_duration.record(monotonic() - start)
+        _run_counter.add(1, {"outcome": "done"})
@@ -1,3 +1,4 @@
+import atexit
 import logging
 
 import sentry_sdk
@@ -5,10 +6,13 @@ from bs_config import Env
 from opentelemetry.instrumentation.logging import LoggingInstrumentor
 
 from bot.config import Config, SentryConfig
-from bot.telemetry import setup_tracing
+from bot.log_queue import queue_root_handlers
+from bot.telemetry import setup_telemetry
 
 _LOG = logging.getLogger(__name__)
 
+_LOG_QUEUE_SIZE = 10_000
+
 
 def _setup_logging() -> None:
     LoggingInstrumentor().instrument(set_logging_format=True)
@@ -17,6 +21,15 @@ def _setup_logging() -> None:
     logging.getLogger(__package__).level = logging.DEBUG
 
 
+def _queue_logging() -> None:
+    """
+    Formats and emits log records on a background thread instead of the
+    event loop. Must be called once all handlers are installed.
+    """
+    listener = queue_root_handlers(_LOG_QUEUE_SIZE)
+    atexit.register(listener.stop)
+
+
 def _setup_sentry(config: SentryConfig | None) -> None:
     if not config:
         _LOG.warning("Sentry not configured")
@@ -32,6 +45,7 @@ def initialize() -> Config:
     _setup_logging()
 
     config = Config.from_env(Env.load(include_default_dotenv=True))
-    setup_tracing(config)
+    setup_telemetry(config)
     _setup_sentry(config.sentry)
+    _queue_logging()
     return config
@@ -0,0 +1,189 @@
+import logging
+import random
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics
+
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+    from bot.config import LocaleLearningConfig
+
+_LOG = logging.getLogger(__name__)
+_meter = metrics.get_meter(__name__)
+
+_decision_counter = _meter.create_counter(
+    "locale_learning.decisions",
+    description="Number of recognitions by where their locale came from",
+)
+
+_PINNED_FIELD = "pinned"
+_COUNT_FIELD_PREFIX = "count:"
+_MEMORY_TTL = timedelta(minutes=10)
+_MEMORY_ENTRIES = 4096
+# Older observations are halved once there are more than this, so the stats
+# follow chats that change their language.
+_MAX_OBSERVATIONS = 50
+
+
+@dataclass
+class _LocaleStats:
+    pinned: str | None
+    counts: dict[str, int]
+    loaded_at: float
+
+    @classmethod
+    def from_hash(cls, values: dict[str, str]) -> _LocaleStats:
+        return cls(
+            pinned=values.get(_PINNED_FIELD),
+            counts={
+                field.removeprefix(_COUNT_FIELD_PREFIX): int(count)
+                for field, count in values.items()
+                if field.startswith(_COUNT_FIELD_PREFIX)
+            },
+            loaded_at=monotonic(),
+        )
+
+
+class LocaleLearner:
+    """
+    Remembers which languages were detected in a chat and for a user.
+
+    Once a chat (or, failing that, the user) consistently speaks one
+    language, recognition uses that locale instead of the more expensive
+    auto-detection. Occasionally, auto-detection is used anyway to notice
+    changes. Users can also pin their locale explicitly, which takes
+    precedence over whatever was learned for the chat. Pins are per user so
+    that members of a group can't change how the others are recognized.
+
+    Stats are stored as Redis hashes and kept in memory for a few minutes.
+    """
+
+    def __init__(
+        self,
+        config: LocaleLearningConfig,
+        *,
+        redis: Redis,
+        key_prefix: str,
+    ) -> None:
+        self._config = config
+        self._redis = redis
+        self._key_prefix = f"{key_prefix}:locale-stats"
+        self._memory: OrderedDict[str, _LocaleStats] = OrderedDict()
+
+    def _chat_key(self, chat_id: int) -> str:
+        return f"{self._key_prefix}:chat:{chat_id}"
+
+    def _user_key(self, user_id: int) -> str:
+        return f"{self._key_prefix}:user:{user_id}"
+
+    async def _get_stats(self, key: str) -> _LocaleStats:
+        stats = self._memory.get(key)
+        max_age = _MEMORY_TTL.total_seconds()
+        if stats is not None and monotonic() - stats.loaded_at < max_age:
+            self._memory.move_to_end(key)
+            return stats
+
+        try:
+            values = await self._redis.hgetall(key)
+        except Exception as e:
+            _LOG.warning("Could not load locale stats", exc_info=e)
+            values = {}
+
+        stats = _LocaleStats.from_hash(values)
+        self._memory[key] = stats
+        self._memory.move_to_end(key)
+        while len(self._memory) > _MEMORY_ENTRIES:
+            self._memory.popitem(last=False)
+
+        return stats
+
+    def _confident_locale(self, stats: _LocaleStats) -> str | None:
+        if not stats.counts:
+            return None
+
+        total = sum(stats.counts.values())
+        locale, count = max(stats.counts.items(), key=lambda item: item[1])
+        config = self._config
+        if count < config.min_observations:
+            return None
+        if count * 100 < total * config.min_share_percent:
+            return None
+
+        return locale
+
+    async def resolve(self, *, chat_id: int, user_id: int) -> str | None:
+        """
+        Returns the locale to recognize a message with, or None to use
+        auto-detection.
+        """
+        user_stats = await self._get_stats(self._user_key(user_id))
+        if pinned := user_stats.pinned:
+            _decision_counter.add(1, {"source": "pinned"})
+            return pinned
+
+        if not self._config.enabled:
+            return None
+
+        if random.random() * 100 < self._config.redetect_percent:
+            _decision_counter.add(1, {"source": "redetect"})
+            return None
+
+        chat_stats = await self._get_stats(self._chat_key(chat_id))
+        if locale := self._confident_locale(chat_stats):
+            _decision_counter.add(1, {"source": "chat"})
+            return locale
+
+        if locale := self._confident_locale(user_stats):
+            _decision_counter.add(1, {"source": "user"})
+            return locale
+
+        _decision_counter.add(1, {"source": "auto"})
+        return None
+
+    async def observe(self, *, chat_id: int, user_id: int, locale: str) -> None:
+        """Records the language that auto-detection found in a message."""
+        if not self._config.enabled:
+            return
+
+        for key in (self._chat_key(chat_id), self._user_key(user_id)):
+            stats = await self._get_stats(key)
+            stats.counts[locale] = stats.counts.get(locale, 0) + 1
+            try:
+                if sum(stats.counts.values()) > _MAX_OBSERVATIONS:
+                    await self._decay(key, stats)
+                else:
+                    await self._redis.hincrby(key, f"{_COUNT_FIELD_PREFIX}{locale}")
+            except Exception as e:
+                _LOG.warning("Could not store locale stats", exc_info=e)
+
+    async def _decay(self, key: str, stats: _LocaleStats) -> None:
+        stats.counts = {
+            locale: count // 2 for locale, count in stats.counts.items() if count > 1
+        }
+        values: dict[str, str | int] = {
+            f"{_COUNT_FIELD_PREFIX}{locale}": count
+            for locale, count in stats.counts.items()
+        }
+        if stats.pinned:
+            values[_PINNED_FIELD] = stats.pinned
+
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.delete(key)
+            pipe.hset(key, mapping=values)
+            await pipe.execute()
+
+    async def pin(self, user_id: int, locale: str | None) -> None:
+        """Pins the locale of a user, or removes the pin if `locale` is None."""
+        key = self._user_key(user_id)
+        if locale is None:
+            await self._redis.hdel(key, _PINNED_FIELD)
+        else:
+            await self._redis.hset(key, _PINNED_FIELD, locale)
+
+        # Other replicas pick the change up once their copy expires
+        self._memory.pop(key, None)
@@ -0,0 +1,126 @@
+import copy
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import TYPE_CHECKING, Any
+
+from opentelemetry import context, metrics
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+_meter = metrics.get_meter(__name__)
+
+_dropped_counter = _meter.create_counter(
+    "logging.dropped_records",
+    description="Number of log records dropped because the log queue was full",
+)
+
+_CONTEXT_ATTRIBUTE = "_queued_otel_context"
+# Process output beyond this is cut off at the start, the end has the error
+_MAX_OUTPUT_LENGTH = 8192
+
+
+class LazyLogValue:
+    """
+    A log attribute that is only rendered when the record is handled, i.e.
+    on the logging thread rather than the event loop.
+    """
+
+    def __init__(self, render: Callable[[], str]) -> None:
+        self._render = render
+
+    def __str__(self) -> str:
+        return self._render()
+
+    def __repr__(self) -> str:
+        # Sentry reads the attributes on the calling thread and serializes
+        # unknown values with repr
+        return self._render()
+
+
+def process_output(output: bytes | None) -> LazyLogValue:
+    """Wraps output of a subprocess, like ffmpeg's stderr, for logging."""
+
+    def render() -> str:
+        if not output:
+            return ""
+
+        text = output[-_MAX_OUTPUT_LENGTH:].decode(errors="replace")
+        if len(output) > _MAX_OUTPUT_LENGTH:
+            return f"[...] {text}"
+        return text
+
+    return LazyLogValue(render)
+
+
+class _BoundedQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue[Any]) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Like the default, the message is formatted right away, because its
+        # arguments might change once the caller continues. Unlike the default,
+        # the exception is kept for handlers that record it as attributes, and
+        # LazyLogValue attributes are rendered by the listener.
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        # Needed to correlate the record with the trace
+        setattr(record, _CONTEXT_ATTRIBUTE, context.get_current())
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Logging about it would only make it worse
+            self.dropped += 1
+            _dropped_counter.add(1, {"level": record.levelname})
+
+
+class _ContextQueueListener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # The queue might be full, but stopping must not drop the sentinel
+        self.queue.put(self._sentinel)
+
+    def handle(self, record: logging.LogRecord) -> None:
+        attributes = record.__dict__
+        record_context = attributes.pop(_CONTEXT_ATTRIBUTE, None)
+        for name, value in attributes.items():
+            if isinstance(value, LazyLogValue):
+                attributes[name] = str(value)
+
+        token = None if record_context is None else context.attach(record_context)
+        try:
+            super().handle(record)
+        finally:
+            if token is not None:
+                context.detach(token)
+
+
+def queue_root_handlers(max_size: int) -> QueueListener:
+    """
+    Moves the handlers of the root logger to a background thread.
+
+    Records are put into a queue of at most `max_size` records, and dropped
+    if the logging thread can't keep up. The returned listener must be stopped
+    to flush the queue.
+    """
+    root = logging.root
+    handlers = list(root.handlers)
+    log_queue: queue.Queue[Any] = queue.Queue(max_size)
+    listener = _ContextQueueListener(
+        log_queue,
+        *handlers,
+        respect_handler_level=True,
+    )
+
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(_BoundedQueueHandler(log_queue))
+
+    listener.start()
+    return listener
@@ -0,0 +1,358 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from dataclasses import dataclass, field
+from datetime import timedelta
+from enum import IntEnum
+from time import monotonic
+from typing import TYPE_CHECKING, Any
+
+from opentelemetry import metrics
+from telegram.constants import ChatType
+from telegram.error import RetryAfter
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+    from telegram import Chat
+
+    from bot.config import OutboxConfig
+
+_LOG = logging.getLogger(__name__)
+_meter = metrics.get_meter(__name__)
+
+_queue_depth = _meter.create_up_down_counter(
+    "outbox.queue_depth",
+    description="Number of outgoing requests waiting to be sent",
+)
+_send_delay = _meter.create_histogram(
+    "outbox.send_delay",
+    unit="s",
+    description="Time an outgoing request waited before it was sent",
+)
+_send_duration = _meter.create_histogram(
+    "outbox.send_duration",
+    unit="s",
+    description="Duration of Telegram requests by priority",
+)
+_retry_after = _meter.create_counter(
+    "outbox.retry_after",
+    description="Number of requests Telegram asked us to retry later",
+)
+
+# How many requests a chat may send in quick succession before being throttled
+_CHAT_BURST = 3
+_DRAIN_TIMEOUT = timedelta(seconds=10)
+
+
+class Priority(IntEnum):
+    """Requests with lower values are sent first."""
+
+    REPLY = 0
+    REACTION = 1
+    NOTICE = 2
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return retry_after
+
+
+class _TokenBucket:
+    def __init__(self, *, rate: float, burst: int) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated_at = monotonic()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated_at
+        self._tokens = min(self._burst, self._tokens + elapsed * self._rate)
+        self._updated_at = now
+
+    def delay(self, now: float) -> float:
+        """Returns the seconds until a token is available."""
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self._rate
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self._burst
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+
+@dataclass(order=True)
+class _Request:
+    priority: Priority
+    sequence: int
+    chat_id: int = field(compare=False)
+    send: Callable[[], Awaitable[Any]] = field(compare=False)
+    on_sent: Callable[[Any], Awaitable[None]] | None = field(compare=False)
+    # Set for callers waiting for the result
+    result: asyncio.Future[Any] | None = field(compare=False)
+    submitted_at: float = field(compare=False)
+
+
+class _ChatQueue:
+    def __init__(self, bucket: _TokenBucket) -> None:
+        self.bucket = bucket
+        self.requests: list[_Request] = []
+        self.blocked_until = 0.0
+        self.is_sending = False
+
+
+class Outbox:
+    """
+    Sends everything we say to Telegram, in the background and within the
+    rate limits Telegram imposes.
+
+    Every chat has its own token bucket and all chats share a global one.
+    Requests of a chat are sent one after another. Across chats, requests
+    with a higher priority go first. If Telegram still asks us to slow down,
+    the chat is paused for as long as requested and the request is retried.
+    """
+
+    def __init__(self, config: OutboxConfig) -> None:
+        self._config = config
+        self._global_bucket = _TokenBucket(
+            rate=config.global_rate,
+            burst=config.global_rate,
+        )
+        self._chats: dict[int, _ChatQueue] = {}
+        self._sequence = itertools.count()
+        self._senders = asyncio.Semaphore(config.max_concurrent_sends)
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._pending = 0
+        self._dispatcher: asyncio.Task[None] | None = None
+        self._send_tasks: set[asyncio.Task[None]] = set()
+
+    def start(self) -> None:
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def close(self) -> None:
+        if self._pending:
+            _LOG.info("Waiting for %d outgoing requests", self._pending)
+            try:
+                async with asyncio.timeout(_DRAIN_TIMEOUT.total_seconds()):
+                    await self._drained.wait()
+            except TimeoutError:
+                _LOG.warning("Dropping %d outgoing requests", self._pending)
+
+        tasks = [*self._send_tasks]
+        if dispatcher := self._dispatcher:
+            tasks.append(dispatcher)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._dispatcher = None
+
+        for chat_queue in self._chats.values():
+            for request in chat_queue.requests:
+                if request.result is not None:
+                    request.result.cancel()
+
+    def submit(
+        self,
+        chat: Chat,
+        send: Callable[[], Awaitable[Any]],
+        *,
+        priority: Priority,
+        on_sent: Callable[[Any], Awaitable[None]] | None = None,
+    ) -> None:
+        """
+        Queues a request to the given chat without waiting for it.
+
+        `on_sent` is awaited with the result of `send` once it went through.
+        """
+        self._enqueue(chat, send, priority=priority, on_sent=on_sent, result=None)
+
+    async def send(
+        self,
+        chat: Chat,
+        send: Callable[[], Awaitable[Any]],
+        *,
+        priority: Priority,
+    ) -> Any:
+        """
+        Like `submit`, but waits until the request went through and returns
+        the result of `send`. Errors other than rate limits are raised.
+
+        If the caller stops waiting before the request is sent, it's dropped.
+        """
+        result: asyncio.Future[Any] = asyncio.get_running_loop().create_future()
+        self._enqueue(chat, send, priority=priority, on_sent=None, result=result)
+        return await result
+
+    def _enqueue(
+        self,
+        chat: Chat,
+        send: Callable[[], Awaitable[Any]],
+        *,
+        priority: Priority,
+        on_sent: Callable[[Any], Awaitable[None]] | None,
+        result: asyncio.Future[Any] | None,
+    ) -> None:
+        chat_queue = self._chats.get(chat.id)
+        if chat_queue is None:
+            chat_queue = _ChatQueue(self._create_chat_bucket(chat))
+            self._chats[chat.id] = chat_queue
+
+        heapq.heappush(
+            chat_queue.requests,
+            _Request(
+                priority=priority,
+                sequence=next(self._sequence),
+                chat_id=chat.id,
+                send=send,
+                on_sent=on_sent,
+                result=result,
+                submitted_at=monotonic(),
+            ),
+        )
+        self._pending += 1
+        self._drained.clear()
+        _queue_depth.add(1)
+        self._wakeup.set()
+
+    def _create_chat_bucket(self, chat: Chat) -> _TokenBucket:
+        config = self._config
+        if chat.type == ChatType.PRIVATE:
+            per_minute = config.private_chat_rate
+        else:
+            per_minute = config.group_chat_rate
+
+        return _TokenBucket(rate=per_minute / 60, burst=_CHAT_BURST)
+
+    async def _dispatch(self) -> None:
+        while True:
+            await self._senders.acquire()
+            try:
+                chat_queue = await self._next_chat()
+            except BaseException:
+                self._senders.release()
+                raise
+
+            request = heapq.heappop(chat_queue.requests)
+            chat_queue.is_sending = True
+            _queue_depth.add(-1)
+            _send_delay.record(monotonic() - request.submitted_at)
+
+            task = asyncio.create_task(self._send(chat_queue, request))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+
+    async def _next_chat(self) -> _ChatQueue:
+        """
+        Waits until a request may be sent and returns the chat with the most
+        important one. Consumes the tokens for it.
+        """
+        while True:
+            now = monotonic()
+            best: _ChatQueue | None = None
+            wake_at: float | None = None
+            idle_chat_ids = []
+            for chat_id, chat_queue in self._chats.items():
+                if chat_queue.is_sending:
+                    continue
+
+                if not chat_queue.requests:
+                    if chat_queue.bucket.is_full(now):
+                        idle_chat_ids.append(chat_id)
+                    continue
+
+                ready_at = max(
+                    chat_queue.blocked_until,
+                    now + chat_queue.bucket.delay(now),
+                )
+                if ready_at > now:
+                    if wake_at is None or ready_at < wake_at:
+                        wake_at = ready_at
+                elif best is None or chat_queue.requests[0] < best.requests[0]:
+                    best = chat_queue
+
+            for chat_id in idle_chat_ids:
+                del self._chats[chat_id]
+
+            if best is not None:
+                global_delay = self._global_bucket.delay(now)
+                if global_delay <= 0:
+                    self._global_bucket.take(now)
+                    best.bucket.take(now)
+                    return best
+
+                if wake_at is None or now + global_delay < wake_at:
+                    wake_at = now + global_delay
+
+            self._wakeup.clear()
+            try:
+                async with asyncio.timeout(None if wake_at is None else wake_at - now):
+                    await self._wakeup.wait()
+            except TimeoutError:
+                pass
+
+    async def _send(self, chat_queue: _ChatQueue, request: _Request) -> None:
+        is_done = True
+        waiter = request.result
+        try:
+            if waiter is not None and waiter.done():
+                # The caller stopped waiting
+                return
+
+            result = await _timed_send(request)
+        except RetryAfter as e:
+            seconds = retry_after_seconds(e)
+            _LOG.warning(
+                "Telegram asked to wait %.1f s before sending to chat %d",
+                seconds,
+                request.chat_id,
+            )
+            _retry_after.add(1)
+            chat_queue.blocked_until = monotonic() + seconds
+            heapq.heappush(chat_queue.requests, request)
+            _queue_depth.add(1)
+            is_done = False
+        except Exception as e:
+            if waiter is None:
+                _LOG.error("Could not send to chat %d", request.chat_id, exc_info=e)
+            elif not waiter.done():
+                waiter.set_exception(e)
+        else:
+            if waiter is not None and not waiter.done():
+                waiter.set_result(result)
+            if on_sent := request.on_sent:
+                try:
+                    await on_sent(result)
+                except Exception as e:
+                    _LOG.error("Error after sending to chat", exc_info=e)
+        finally:
+            chat_queue.is_sending = False
+            if is_done:
+                if waiter is not None:
+                    # Only still pending if the outbox was closed
+                    waiter.cancel()
+                self._pending -= 1
+                if not self._pending:
+                    self._drained.set()
+            self._senders.release()
+            self._wakeup.set()
+
+
+async def _timed_send(request: _Request) -> Any:
+    started_at = monotonic()
+    try:
+        return await request.send()
+    finally:
+        _send_duration.record(
+            monotonic() - started_at,
+            {"priority": request.priority.name.lower()},
+        )
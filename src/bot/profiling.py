@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from pathlib import Path
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics
+
+if TYPE_CHECKING:
+    from datetime import timedelta
+    from types import FrameType
+
+    from bot.config import ProfilingConfig
+
+_LOG = logging.getLogger(__name__)
+_meter = metrics.get_meter(__name__)
+
+_lag_histogram = _meter.create_histogram(
+    "event_loop.lag",
+    unit="s",
+    description="How much later than scheduled the event loop woke up a task",
+)
+_stall_counter = _meter.create_counter(
+    "event_loop.stalls",
+    description="Number of times the event loop was blocked for too long",
+)
+
+_HEARTBEAT_INTERVAL = 0.1
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop runs a periodic heartbeat.
+
+    A watchdog thread checks the heartbeat. If it stops for longer than the
+    configured threshold, the loop is blocked by some callback, and the stack
+    of the loop thread is logged so the culprit can be found.
+    """
+
+    def __init__(self, config: ProfilingConfig) -> None:
+        self._threshold = config.stall_threshold.total_seconds()
+        self._last_beat = monotonic()
+        self._loop_thread_id: int | None = None
+        self._heartbeat: asyncio.Task[None] | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = monotonic()
+        self._heartbeat = asyncio.create_task(self._beat())
+        self._watchdog = threading.Thread(
+            target=self._watch,
+            name="loop-lag-monitor",
+            daemon=True,
+        )
+        self._watchdog.start()
+
+    async def close(self) -> None:
+        self._stopped.set()
+        if heartbeat := self._heartbeat:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+            self._heartbeat = None
+        if watchdog := self._watchdog:
+            await asyncio.to_thread(watchdog.join)
+            self._watchdog = None
+
+    async def _beat(self) -> None:
+        while True:
+            scheduled_at = monotonic() + _HEARTBEAT_INTERVAL
+            await asyncio.sleep(_HEARTBEAT_INTERVAL)
+            now = monotonic()
+            _lag_histogram.record(max(0.0, now - scheduled_at))
+            self._last_beat = now
+
+    def _watch(self) -> None:
+        reported_beat: float | None = None
+        while not self._stopped.wait(_HEARTBEAT_INTERVAL / 2):
+            last_beat = self._last_beat
+            blocked = monotonic() - last_beat - _HEARTBEAT_INTERVAL
+            # Only report every stall once
+            if blocked < self._threshold or last_beat == reported_beat:
+                continue
+
+            reported_beat = last_beat
+            _stall_counter.add(1)
+            frame = sys._current_frames().get(self._loop_thread_id or 0)
+            stack = "".join(traceback.format_stack(frame)) if frame else "unknown"
+            _LOG.warning(
+                "Event loop blocked for at least %.0f ms in:\n%s",
+                blocked * 1000,
+                stack,
+            )
+
+
+def _collapse(thread_name: str, frame: FrameType | None) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_qualname} ({Path(code.co_filename).name})")
+        frame = frame.f_back
+
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the stacks of all threads for a while.
+
+    The result is in the collapsed stack format ("root;...;leaf count" per
+    line), which flame graph tools (e.g. speedscope) can read.
+    """
+
+    def __init__(self, config: ProfilingConfig) -> None:
+        self._interval = config.sample_interval.total_seconds()
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return self._lock.locked()
+
+    async def profile(self, duration: timedelta) -> str:
+        async with self._lock:
+            stacks = await asyncio.to_thread(self._sample, duration.total_seconds())
+
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def _sample(self, seconds: float) -> Counter[str]:
+        own_thread_id = threading.get_ident()
+        thread_names: dict[int, str] = {}
+        stacks: Counter[str] = Counter()
+        end = monotonic() + seconds
+        while monotonic() < end:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+
+                if thread_id not in thread_names:
+                    thread_names = {
+                        thread.ident: thread.name
+                        for thread in threading.enumerate()
+                        if thread.ident is not None
+                    }
+
+                thread_name = thread_names.get(thread_id, str(thread_id))
+                stacks[_collapse(thread_name, frame)] += 1
+
+            time.sleep(self._interval)
+
+        return stacks
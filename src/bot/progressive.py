@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from datetime import timedelta
+from functools import partial
+from typing import TYPE_CHECKING
+
+from telegram.error import BadRequest, TelegramError
+
+from bot.outbox import Priority
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from telegram import Message
+
+    from bot.outbox import Outbox
+
+_LOG = logging.getLogger(__name__)
+
+# Telegram doesn't like frequent edits, especially in groups
+_MIN_EDIT_INTERVAL = timedelta(seconds=3)
+_IN_PROGRESS_SUFFIX = " …"
+
+
+class ProgressiveReply:
+    """
+    Replies with the transcript while it is still being recognized.
+
+    The first phrase is sent right away, later phrases are added by editing
+    the reply at most every few seconds. Once the text doesn't fit into one
+    message anymore, additional replies are sent. Everything goes through the
+    outbox, like other replies.
+    """
+
+    def __init__(
+        self,
+        message: Message,
+        *,
+        outbox: Outbox,
+        split_chunks: Callable[[str], list[str]],
+        transform: Callable[[str], str],
+    ) -> None:
+        self._message = message
+        self._outbox = outbox
+        self._split_chunks = split_chunks
+        self._transform = transform
+        self._text = ""
+        self._replies: list[Message] = []
+        self._reply_texts: list[str] = []
+        self._changed = asyncio.Event()
+        # Held while updating, so cancelling doesn't lose a sent reply
+        self._updating = asyncio.Lock()
+        self._task: asyncio.Task[None] | None = None
+
+    @property
+    def has_replied(self) -> bool:
+        return bool(self._replies)
+
+    def add_phrase(self, phrase: str) -> None:
+        if self._text:
+            self._text += " "
+        self._text += self._transform(phrase)
+        self._changed.set()
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._update_periodically())
+
+    async def _update_periodically(self) -> None:
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            try:
+                async with self._updating:
+                    text = self._text + _IN_PROGRESS_SUFFIX
+                    await self._update(self._split_chunks(text))
+            except Exception as e:
+                _LOG.error("Could not update progressive reply", exc_info=e)
+
+            await asyncio.sleep(_MIN_EDIT_INTERVAL.total_seconds())
+
+    async def _update(self, chunks: list[str]) -> None:
+        for index, chunk in enumerate(chunks):
+            if index < len(self._replies):
+                if self._reply_texts[index] == chunk:
+                    continue
+
+                await self._edit(self._replies[index], chunk)
+                self._reply_texts[index] = chunk
+            else:
+                reply = await self._outbox.send(
+                    self._message.chat,
+                    partial(
+                        self._message.reply_text,
+                        text=chunk,
+                        disable_notification=True,
+                    ),
+                    priority=Priority.REPLY,
+                )
+                self._replies.append(reply)
+                self._reply_texts.append(chunk)
+
+    async def _edit(self, reply: Message, text: str) -> None:
+        try:
+            await self._outbox.send(
+                self._message.chat,
+                partial(reply.edit_text, text),
+                priority=Priority.REPLY,
+            )
+        except BadRequest as e:
+            # Telegram strips whitespace, so the text might not have changed
+            if "not modified" not in e.message:
+                raise
+
+    async def cancel(self) -> None:
+        if task := self._task:
+            async with self._updating:
+                task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            self._task = None
+
+    def _delete(self, reply: Message) -> None:
+        # Failures are only logged by the outbox, there's nothing else to do
+        self._outbox.submit(
+            self._message.chat,
+            reply.delete,
+            priority=Priority.REPLY,
+        )
+
+    async def abort(self) -> None:
+        """
+        Stops updating and deletes the replies sent so far, so no partial
+        transcript is left in the chat if the transcription fails.
+        """
+        await self.cancel()
+        for reply in self._replies:
+            self._delete(reply)
+
+        self._replies.clear()
+        self._reply_texts.clear()
+
+    async def finish(self, text: str) -> Message | None:
+        """
+        Replaces the interim text with the final transcript.
+
+        Returns the first reply, or None if the replies couldn't be updated
+        (e.g. because they were deleted). They're removed then, so the caller
+        can reply from scratch.
+        """
+        await self.cancel()
+        chunks = self._split_chunks(text)
+        try:
+            await self._update(chunks)
+        except TelegramError as e:
+            _LOG.warning("Could not finish progressive reply", exc_info=e)
+            await self.abort()
+            return None
+
+        for reply in self._replies[len(chunks) :]:
+            self._delete(reply)
+        del self._replies[len(chunks) :]
+        del self._reply_texts[len(chunks) :]
+
+        return self._replies[0]
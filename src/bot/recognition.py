@@ -0,0 +1,60 @@
+import abc
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterable, Callable
+    from pathlib import Path
+
+    from bot.conversion import CompressedFormat
+
+
+class TranscriptionError(OSError):
+    pass
+
+
+class TranscriptionCanceledError(TranscriptionError):
+    def __init__(self, *, reason: str, error_code: str, error_details: str) -> None:
+        super().__init__(f"Recognition was canceled ({error_code}): {error_details}")
+        self.reason = reason
+        self.error_code = error_code
+        self.error_details = error_details
+
+
+class RecognitionBackend(abc.ABC):
+    """A speech service endpoint that recognizes one recording at a time."""
+
+    def __init__(self, name: str, *, weight: int) -> None:
+        self.name = name
+        self.weight = weight
+
+    def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def recognize_file(
+        self,
+        audio_file: Path,
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        pass
+
+    @abc.abstractmethod
+    async def recognize_stream(
+        self,
+        chunks: AsyncIterable[bytes],
+        audio_format: CompressedFormat | None,
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        """
+        Recognizes pushed audio, which is either raw PCM (if `audio_format` is
+        None) or a compressed file.
+        """
@@ -0,0 +1,270 @@
+import asyncio
+import itertools
+import logging
+from collections import defaultdict, deque
+from datetime import timedelta
+from time import monotonic
+from typing import TYPE_CHECKING, Any
+
+import azure.cognitiveservices.speech as speechsdk
+from opentelemetry import metrics, trace
+
+from bot.conversion import (
+    PCM_BITS_PER_SAMPLE,
+    PCM_CHANNELS,
+    PCM_SAMPLE_RATE,
+    CompressedFormat,
+)
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+    from bot.config import RecognizerPoolConfig
+
+_LOG = logging.getLogger(__name__)
+_tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
+
+_acquisitions = _meter.create_counter(
+    "recognizer_pool.acquisitions",
+    description="Number of recognizers taken from the pool or opened on demand",
+)
+
+_HANDSHAKE_TIMEOUT = timedelta(seconds=10)
+
+_container_formats = {
+    CompressedFormat.OGG_OPUS: speechsdk.AudioStreamContainerFormat.OGG_OPUS,
+    CompressedFormat.MP3: speechsdk.AudioStreamContainerFormat.MP3,
+    CompressedFormat.FLAC: speechsdk.AudioStreamContainerFormat.FLAC,
+}
+
+# The format of the pushed audio (None for raw PCM) and the locale (None for
+# auto-detection)
+_PoolKey = tuple[CompressedFormat | None, str | None]
+
+
+def create_stream_format(
+    audio_format: CompressedFormat | None,
+) -> speechsdk.audio.AudioStreamFormat:
+    if audio_format is None:
+        return speechsdk.audio.AudioStreamFormat(
+            samples_per_second=PCM_SAMPLE_RATE,
+            bits_per_sample=PCM_BITS_PER_SAMPLE,
+            channels=PCM_CHANNELS,
+        )
+
+    return speechsdk.audio.AudioStreamFormat(
+        compressed_stream_format=_container_formats[audio_format],
+    )
+
+
+class PooledRecognizer:
+    """A recognizer reading from a push stream, with its connection."""
+
+    def __init__(
+        self,
+        recognizer: speechsdk.SpeechRecognizer,
+        stream: speechsdk.audio.PushAudioInputStream,
+    ) -> None:
+        self.recognizer = recognizer
+        self.stream = stream
+        self.connection = speechsdk.Connection.from_recognizer(recognizer)
+        self.created_at = monotonic()
+        self.is_connected = False
+
+    async def open(self, *, pooled: bool) -> bool:
+        """
+        Opens the connection to the speech service.
+
+        Returns False if the connection couldn't be established in time.
+        """
+        loop = asyncio.get_running_loop()
+        connected: asyncio.Future[bool] = loop.create_future()
+
+        def set_connected(is_connected: bool) -> None:
+            self.is_connected = is_connected
+            if not connected.done():
+                connected.set_result(is_connected)
+
+        def on_connected(_: Any) -> None:
+            loop.call_soon_threadsafe(set_connected, True)
+
+        def on_disconnected(_: Any) -> None:
+            loop.call_soon_threadsafe(set_connected, False)
+
+        self.connection.connected.connect(on_connected)
+        self.connection.disconnected.connect(on_disconnected)
+
+        try:
+            with _tracer.start_as_current_span(
+                "recognizer_handshake",
+                attributes={"recognizer.pooled": pooled},
+            ):
+                self.connection.open(True)
+                try:
+                    async with asyncio.timeout(_HANDSHAKE_TIMEOUT.total_seconds()):
+                        return await connected
+                except TimeoutError:
+                    _LOG.warning("Timed out connecting to the speech service")
+                    return False
+        finally:
+            # The handshake callbacks refer to the event loop, only a dropped
+            # connection matters from now on
+            self.connection.connected.disconnect_all()
+            self.connection.disconnected.disconnect_all()
+            self.connection.disconnected.connect(self._on_dropped)
+
+    def _on_dropped(self, _: Any) -> None:
+        # Called on an SDK thread, the pool only reads the flag
+        self.is_connected = False
+
+    def close(self) -> None:
+        self.connection.connected.disconnect_all()
+        self.connection.disconnected.disconnect_all()
+        try:
+            self.connection.close()
+        except Exception as e:
+            _LOG.debug("Could not close recognizer connection", exc_info=e)
+        self.stream.close()
+
+
+class RecognizerPool:
+    """
+    Keeps recognizers with already opened connections around, so recognition
+    doesn't have to wait for the TLS and websocket handshake.
+
+    Every combination of stream format and locale has its own pool. The
+    configured combinations are kept warm all the time, others are refilled
+    after they have been used. Connections that aren't used within the idle
+    timeout are closed.
+    """
+
+    def __init__(
+        self,
+        config: RecognizerPoolConfig,
+        *,
+        create_recognizer: Callable[
+            [speechsdk.audio.AudioConfig, str | None],
+            speechsdk.SpeechRecognizer,
+        ],
+    ) -> None:
+        self._config = config
+        self._create_recognizer = create_recognizer
+        self._warm_keys: list[_PoolKey] = [
+            (
+                None if audio_format == "pcm" else CompressedFormat(audio_format),
+                None if locale == "auto" else locale,
+            )
+            for audio_format, locale in itertools.product(
+                config.formats,
+                config.locales,
+            )
+        ]
+        self._idle: dict[_PoolKey, deque[PooledRecognizer]] = defaultdict(deque)
+        self._opening: dict[_PoolKey, int] = defaultdict(int)
+        self._tasks: set[asyncio.Task[None]] = set()
+        self._maintainer: asyncio.Task[None] | None = None
+
+    def start(self) -> None:
+        if self._config.size <= 0:
+            return
+
+        for key in self._warm_keys:
+            self._refill(key)
+        self._maintainer = asyncio.create_task(self._maintain_periodically())
+
+    async def close(self) -> None:
+        tasks = [*self._tasks]
+        if maintainer := self._maintainer:
+            tasks.append(maintainer)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for idle in self._idle.values():
+            for pooled in idle:
+                pooled.close()
+        self._idle.clear()
+
+    def _create(self, key: _PoolKey) -> PooledRecognizer:
+        audio_format, locale = key
+        stream = speechsdk.audio.PushAudioInputStream(
+            stream_format=create_stream_format(audio_format),
+        )
+        recognizer = self._create_recognizer(
+            speechsdk.audio.AudioConfig(stream=stream),
+            locale,
+        )
+        return PooledRecognizer(recognizer, stream)
+
+    def _is_usable(self, pooled: PooledRecognizer) -> bool:
+        age = monotonic() - pooled.created_at
+        return pooled.is_connected and age < self._config.idle_timeout.total_seconds()
+
+    async def acquire(
+        self,
+        audio_format: CompressedFormat | None,
+        locale: str | None,
+    ) -> PooledRecognizer:
+        """
+        Returns a recognizer for the given configuration, opening a new one
+        if none is ready. The caller has to close it when done.
+        """
+        key = (audio_format, locale)
+        idle = self._idle[key]
+        while idle:
+            pooled = idle.popleft()
+            if self._is_usable(pooled):
+                _acquisitions.add(1, {"pooled": True})
+                self._refill(key)
+                return pooled
+
+            pooled.close()
+
+        _acquisitions.add(1, {"pooled": False})
+        self._refill(key)
+        pooled = self._create(key)
+        # Even if this fails, recognition connects on its own
+        await pooled.open(pooled=False)
+        return pooled
+
+    def _refill(self, key: _PoolKey) -> None:
+        missing = self._config.size - len(self._idle[key]) - self._opening[key]
+        for _ in range(missing):
+            self._opening[key] += 1
+            task = asyncio.create_task(self._open_idle(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _open_idle(self, key: _PoolKey) -> None:
+        pooled = self._create(key)
+        try:
+            is_connected = await pooled.open(pooled=True)
+        except Exception as e:
+            _LOG.warning("Could not open pooled recognizer", exc_info=e)
+            is_connected = False
+        except BaseException:
+            pooled.close()
+            raise
+        finally:
+            self._opening[key] -= 1
+
+        if is_connected:
+            self._idle[key].append(pooled)
+        else:
+            pooled.close()
+
+    async def _maintain_periodically(self) -> None:
+        interval = self._config.idle_timeout.total_seconds() / 4
+        while True:
+            await asyncio.sleep(interval)
+            for idle in self._idle.values():
+                usable = [pooled for pooled in idle if self._is_usable(pooled)]
+                for pooled in idle:
+                    if pooled not in usable:
+                        pooled.close()
+                idle.clear()
+                idle.extend(usable)
+
+            for key in self._warm_keys:
+                self._refill(key)
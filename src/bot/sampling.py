@@ -0,0 +1,250 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics, trace
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor
+from opentelemetry.sdk.trace.sampling import (
+    Decision,
+    Sampler,
+    SamplingResult,
+    TraceIdRatioBased,
+)
+from opentelemetry.trace import StatusCode
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Sequence
+    from datetime import timedelta
+
+    from opentelemetry.context import Context
+    from opentelemetry.sdk.trace.export import SpanExporter
+    from opentelemetry.trace import Link, SpanKind
+    from opentelemetry.trace.span import TraceState
+    from opentelemetry.util.types import Attributes
+
+_LOG = logging.getLogger(__name__)
+_meter = metrics.get_meter(__name__)
+
+_tail_decisions = _meter.create_counter(
+    "tracing.tail_decisions",
+    description="Number of unsampled traces by whether they were kept and why",
+)
+
+# Spans beyond this are dropped, so a runaway trace can't exhaust memory
+_MAX_SPANS_PER_TRACE = 256
+# Traces whose root already ended, to recognize spans that end after it
+_MAX_DECIDED_TRACES = 1024
+
+# Attributes of recorded but unsampled spans by span ID, only computed if the
+# tail sampling keeps the trace. Removed by the processor once the span ends.
+_deferred_attributes: dict[int, Callable[[], Attributes]] = {}
+
+
+def set_deferred_attributes(
+    span: trace.Span,
+    compute: Callable[[], Attributes],
+) -> None:
+    """
+    Sets the attributes returned by `compute` on the span, but only once it's
+    known that the span will be exported.
+
+    Sampled spans get them right away. For recorded but unsampled spans, the
+    `TailSamplingSpanProcessor` computes them if it keeps their trace.
+    """
+    if not span.is_recording():
+        return
+
+    span_context = span.get_span_context()
+    if span_context.trace_flags.sampled:
+        span.set_attributes(compute() or {})
+    else:
+        _deferred_attributes[span_context.span_id] = compute
+
+
+def _with_attributes(span: ReadableSpan, attributes: Attributes) -> ReadableSpan:
+    return ReadableSpan(
+        name=span.name,
+        context=span.context,
+        parent=span.parent,
+        resource=span.resource,
+        attributes={**(span.attributes or {}), **(attributes or {})},
+        events=span.events,
+        links=span.links,
+        kind=span.kind,
+        status=span.status,
+        start_time=span.start_time,
+        end_time=span.end_time,
+        instrumentation_scope=span.instrumentation_scope,
+    )
+
+
+class RatioOrRecordSampler(Sampler):
+    """
+    Samples the given ratio of root spans, like a parent-based ratio sampler.
+
+    Traces that aren't sampled are still recorded rather than dropped, so the
+    `TailSamplingSpanProcessor` can decide to keep them once they're done.
+    """
+
+    def __init__(self, ratio: float) -> None:
+        self._ratio = TraceIdRatioBased(ratio)
+
+    def should_sample(
+        self,
+        parent_context: Context | None,
+        trace_id: int,
+        name: str,
+        kind: SpanKind | None = None,
+        attributes: Attributes = None,
+        links: Sequence[Link] | None = None,
+        trace_state: TraceState | None = None,
+    ) -> SamplingResult:
+        parent = trace.get_current_span(parent_context)
+        parent_span_context = parent.get_span_context()
+        if not parent_span_context.is_valid:
+            result = self._ratio.should_sample(
+                parent_context,
+                trace_id,
+                name,
+                kind,
+                attributes,
+                links,
+                trace_state,
+            )
+            if result.decision.is_sampled():
+                return result
+
+            return SamplingResult(Decision.RECORD_ONLY, attributes, trace_state)
+
+        if parent_span_context.trace_flags.sampled:
+            return SamplingResult(
+                Decision.RECORD_AND_SAMPLE,
+                attributes,
+                parent_span_context.trace_state,
+            )
+
+        # Children of a recorded trace are needed for the tail decision
+        if not parent_span_context.is_remote and parent.is_recording():
+            return SamplingResult(
+                Decision.RECORD_ONLY,
+                attributes,
+                parent_span_context.trace_state,
+            )
+
+        return SamplingResult(Decision.DROP, None, parent_span_context.trace_state)
+
+    def get_description(self) -> str:
+        return f"RatioOrRecordSampler{{{self._ratio.get_description()}}}"
+
+
+# A finished span and its deferred attributes
+type _BufferedSpan = tuple[ReadableSpan, Callable[[], Attributes] | None]
+
+
+class TailSamplingSpanProcessor(SpanProcessor):
+    """
+    Buffers the spans of recorded but unsampled traces and exports a trace
+    once its local root span ends, if it failed or was slow.
+
+    Sampled spans are left to the regular (batch) processor. At most
+    `max_traces` traces are buffered, the oldest unfinished ones are dropped.
+    Spans that end after their root (e.g. of abandoned background tasks) are
+    dropped, the decision about their trace has already been made.
+    """
+
+    def __init__(
+        self,
+        exporter: SpanExporter,
+        *,
+        slow_threshold: timedelta,
+        max_traces: int,
+    ) -> None:
+        self._exporter = exporter
+        self._slow_threshold_ns = int(slow_threshold.total_seconds() * 1e9)
+        self._max_traces = max_traces
+        self._traces: OrderedDict[int, list[_BufferedSpan]] = OrderedDict()
+        self._decided: OrderedDict[int, None] = OrderedDict()
+        # Spans can end on any thread
+        self._lock = threading.Lock()
+        # Exporting blocks, so it must not happen on the thread ending the span
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="tail-sampling",
+        )
+
+    def on_end(self, span: ReadableSpan) -> None:
+        context = span.context
+        if context is None or context.trace_flags.sampled:
+            return
+
+        deferred_attributes = _deferred_attributes.pop(context.span_id, None)
+        trace_id = context.trace_id
+        with self._lock:
+            if trace_id in self._decided:
+                return
+
+            spans = self._traces.get(trace_id)
+            if spans is None:
+                spans = self._traces[trace_id] = []
+                while len(self._traces) > self._max_traces:
+                    self._traces.popitem(last=False)
+                    _tail_decisions.add(1, {"kept": False, "reason": "evicted"})
+
+            if len(spans) < _MAX_SPANS_PER_TRACE:
+                spans.append((span, deferred_attributes))
+
+            parent = span.parent
+            if parent is not None and not parent.is_remote:
+                return
+
+            del self._traces[trace_id]
+            self._decided[trace_id] = None
+            if len(self._decided) > _MAX_DECIDED_TRACES:
+                self._decided.popitem(last=False)
+
+        if reason := self._keep_reason(span, spans):
+            _tail_decisions.add(1, {"kept": True, "reason": reason})
+            self._executor.submit(self._export, spans)
+        else:
+            _tail_decisions.add(1, {"kept": False, "reason": "unremarkable"})
+
+    def _keep_reason(
+        self,
+        root: ReadableSpan,
+        spans: list[_BufferedSpan],
+    ) -> str | None:
+        if any(span.status.status_code == StatusCode.ERROR for span, _ in spans):
+            return "error"
+
+        if root.start_time is not None and root.end_time is not None:
+            if root.end_time - root.start_time >= self._slow_threshold_ns:
+                return "slow"
+
+        return None
+
+    def _export(self, spans: list[_BufferedSpan]) -> None:
+        try:
+            self._exporter.export(
+                [
+                    span if compute is None else _with_attributes(span, compute())
+                    for span, compute in spans
+                ]
+            )
+        except Exception as e:
+            _LOG.warning("Could not export tail sampled trace", exc_info=e)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+        self._exporter.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        # Exports run in order, so this waits for those already submitted
+        done = self._executor.submit(lambda: None)
+        try:
+            done.result(timeout=timeout_millis / 1000)
+        except TimeoutError:
+            return False
+
+        return True
@@ -0,0 +1,237 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from opentelemetry import metrics
+
+from bot.config import OverflowPolicy
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+    from bot.config import SchedulerConfig
+
+_LOG = logging.getLogger(__name__)
+_meter = metrics.get_meter(__name__)
+
+_queue_depth = _meter.create_up_down_counter(
+    "scheduler.queue_depth",
+    description="Number of jobs waiting for a worker of a stage",
+)
+_active_workers = _meter.create_up_down_counter(
+    "scheduler.active_workers",
+    description="Number of busy workers of a stage",
+)
+_wait_time = _meter.create_histogram(
+    "scheduler.wait_time",
+    unit="s",
+    description="Time a job waited before a worker of a stage picked it up",
+)
+_rejections = _meter.create_counter(
+    "scheduler.rejections",
+    description="Number of jobs rejected because the pipeline was full",
+)
+_deadlines_exceeded = _meter.create_counter(
+    "scheduler.deadlines_exceeded",
+    description="Number of jobs aborted because they took too long",
+)
+
+
+class JobDeadlineExceededError(Exception):
+    def __init__(self, deadline: float) -> None:
+        super().__init__(f"Job exceeded its deadline of {deadline:.0f} seconds")
+        self.deadline = deadline
+
+
+class _Stage:
+    """
+    A fixed number of workers with a bounded queue in front of them.
+
+    A job first has to reserve a place in the stage (which waits while the
+    queue is full) and then waits for one of the workers.
+    """
+
+    def __init__(self, name: str, *, workers: int, queue_size: int) -> None:
+        self.name = name
+        self._attributes = {"stage": name}
+        self._worker_count = workers
+        self._capacity = asyncio.Semaphore(workers + queue_size)
+        self._workers = asyncio.Semaphore(workers)
+        self.reservations = 0
+        self.queue_depth = 0
+
+    def has_idle_worker(self) -> bool:
+        return self.reservations < self._worker_count
+
+    def is_full(self) -> bool:
+        return self._capacity.locked()
+
+    async def reserve(self) -> None:
+        await self._capacity.acquire()
+        self.reservations += 1
+
+    def release_reservation(self) -> None:
+        self.reservations -= 1
+        self._capacity.release()
+
+    @asynccontextmanager
+    async def worker(self, *, enqueued_at: float) -> AsyncIterator[None]:
+        self.queue_depth += 1
+        _queue_depth.add(1, self._attributes)
+        try:
+            await self._workers.acquire()
+        finally:
+            self.queue_depth -= 1
+            _queue_depth.add(-1, self._attributes)
+
+        _wait_time.record(monotonic() - enqueued_at, self._attributes)
+        _active_workers.add(1, self._attributes)
+        try:
+            yield
+        finally:
+            _active_workers.add(-1, self._attributes)
+            self._workers.release()
+
+    @asynccontextmanager
+    async def additional_worker(self) -> AsyncIterator[None]:
+        """
+        Borrows another worker for a job that already holds one of this stage,
+        so work it does in parallel still counts against the worker limit.
+        """
+        async with self.worker(enqueued_at=monotonic()):
+            yield
+
+
+class Job:
+    def __init__(self, stages: list[_Stage], *, queued: bool) -> None:
+        self._stages = stages
+        self._reserved_at: dict[str, float] = {}
+        self._entered: set[str] = set()
+        self.queued = queued
+        # How long the body of each stage ran on a worker
+        self.worker_seconds: dict[str, float] = {}
+
+    async def _reserve(self, stage: _Stage) -> None:
+        reserved_at = monotonic()
+        await stage.reserve()
+        self._reserved_at[stage.name] = reserved_at
+
+    def _next_stage(self, stage: _Stage) -> _Stage | None:
+        index = self._stages.index(stage)
+        if index + 1 < len(self._stages):
+            return self._stages[index + 1]
+        return None
+
+    @asynccontextmanager
+    async def stage(self, stage: _Stage) -> AsyncIterator[None]:
+        """
+        Runs the body on a worker of the given stage.
+
+        Before the worker is released, a place in the queue of the following
+        stage is reserved. If that queue is full, the worker stays busy, which
+        propagates backpressure up to the admission of new jobs.
+        """
+        if stage.name not in self._reserved_at:
+            await self._reserve(stage)
+
+        self._entered.add(stage.name)
+        try:
+            async with stage.worker(enqueued_at=self._reserved_at[stage.name]):
+                started_at = monotonic()
+                yield
+                self.worker_seconds[stage.name] = monotonic() - started_at
+                next_stage = self._next_stage(stage)
+                if (
+                    next_stage is not None
+                    and next_stage.name not in self._entered
+                    and next_stage.name not in self._reserved_at
+                ):
+                    await self._reserve(next_stage)
+        finally:
+            del self._reserved_at[stage.name]
+            stage.release_reservation()
+
+    def skip(self, stage: _Stage) -> None:
+        """
+        Marks a stage as not needed for this job, releasing its reservation.
+        """
+        self._entered.add(stage.name)
+        if self._reserved_at.pop(stage.name, None) is not None:
+            stage.release_reservation()
+
+    def release(self) -> None:
+        for stage in self._stages:
+            if self._reserved_at.pop(stage.name, None) is not None:
+                stage.release_reservation()
+
+
+class JobScheduler:
+    def __init__(self, config: SchedulerConfig) -> None:
+        self._overflow_policy = config.overflow_policy
+        self._deadline_base = config.deadline_base.total_seconds()
+        self._deadline_audio_factor = config.deadline_audio_percent / 100
+        self.download = _Stage(
+            "download",
+            workers=config.download_workers,
+            queue_size=config.queue_size,
+        )
+        self.conversion = _Stage(
+            "conversion",
+            workers=config.conversion_workers,
+            queue_size=config.queue_size,
+        )
+        self.transcription = _Stage(
+            "transcription",
+            workers=config.transcription_workers,
+            queue_size=config.queue_size,
+        )
+        self._stages = [self.download, self.conversion, self.transcription]
+
+    async def _admit(self) -> Job | None:
+        entry = self.download
+        if entry.has_idle_worker():
+            queued = False
+        elif self._overflow_policy == OverflowPolicy.QUEUE and not entry.is_full():
+            queued = True
+        else:
+            _rejections.add(1)
+            return None
+
+        job = Job(self._stages, queued=queued)
+        # Doesn't block, we just checked that there's room
+        await job._reserve(entry)
+        return job
+
+    def deadline(self, audio_seconds: int) -> float:
+        """Returns how many seconds a job for audio of the given length may take."""
+        return self._deadline_base + audio_seconds * self._deadline_audio_factor
+
+    @asynccontextmanager
+    async def job(self, *, audio_seconds: int) -> AsyncIterator[Job | None]:
+        """
+        Admits a new job into the pipeline, or yields None if the job was
+        rejected according to the configured overflow policy.
+
+        The body is cancelled once the job exceeds its deadline, which is
+        raised as `JobDeadlineExceededError`. The deadline includes the time
+        spent waiting in queues, since that's what the user experiences.
+        """
+        job = await self._admit()
+        if job is None:
+            yield None
+            return
+
+        deadline = self.deadline(audio_seconds)
+        try:
+            async with asyncio.timeout(deadline) as timeout:
+                yield job
+        except TimeoutError as e:
+            if not timeout.expired():
+                raise
+
+            _deadlines_exceeded.add(1)
+            raise JobDeadlineExceededError(deadline) from e
+        finally:
+            job.release()
@@ -1,73 +1,481 @@
 import asyncio
 import logging
-from typing import TYPE_CHECKING, Any
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import timedelta
+from time import monotonic
+from typing import TYPE_CHECKING, Any, Self
 
 import azure.cognitiveservices.speech as speechsdk
-from opentelemetry import trace
+from opentelemetry import metrics, trace
 
+from bot.conversion import is_pcm_wave, read_wave_frames
+from bot.hedging import EndpointRouter, ReplayableChunks
 from bot.localization import auto_detect_languages, locale_by_language
+from bot.recognition import (
+    RecognitionBackend,
+    TranscriptionCanceledError,
+    TranscriptionError,
+)
+from bot.recognizer_pool import RecognizerPool
 
 if TYPE_CHECKING:
+    from collections.abc import AsyncIterable, Callable, Iterator
+    from contextlib import AbstractAsyncContextManager
     from pathlib import Path
 
-    from bot.config import AzureTtsConfig
+    from bot.config import AzureTtsConfig, HedgingConfig, RecognizerPoolConfig
+    from bot.conversion import CompressedFormat
 
 _LOG = logging.getLogger(__name__)
 tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
 
+_recognition_duration = _meter.create_histogram(
+    "speech.recognition_duration",
+    unit="s",
+    description="Duration of recognitions by audio format, locale and outcome",
+)
 
-class Transcriber:
-    def __init__(self, config: AzureTtsConfig) -> None:
+_STOP_TIMEOUT = timedelta(seconds=10)
+# Starting and stopping usually takes milliseconds, these threads are only all
+# busy if the endpoint stopped responding
+_SDK_WAIT_THREADS = 8
+
+
+class AzureRecognitionBackend(RecognitionBackend):
+    def __init__(
+        self,
+        *,
+        region: str,
+        key: str,
+        weight: int,
+        pool_config: RecognizerPoolConfig,
+    ) -> None:
+        super().__init__(region, weight=weight)
         self._speech_config = speechsdk.SpeechConfig(
-            subscription=config.key,
-            region=config.region,
+            subscription=key,
+            region=region,
         )
         self._speech_config.set_profanity(speechsdk.ProfanityOption.Raw)
+        self._pool = RecognizerPool(
+            pool_config,
+            create_recognizer=self._create_recognizer,
+        )
+        # Waiting for an SDK operation blocks a thread until it completes,
+        # even if we gave up on it. Those threads mustn't be taken from the
+        # default executor, which the downloads and conversions rely on.
+        self._sdk_executor = ThreadPoolExecutor(
+            max_workers=_SDK_WAIT_THREADS,
+            thread_name_prefix=f"speech-sdk-{region}",
+        )
 
-    async def transcribe(self, audio_file: Path, locale: str | None) -> str | None:
-        with tracer.start_as_current_span("transcribe"):
-            audio_config = speechsdk.AudioConfig(filename=str(audio_file))
-            if locale is None:
-                recognizer = speechsdk.SpeechRecognizer(
-                    speech_config=self._speech_config,
-                    audio_config=audio_config,
-                    auto_detect_source_language_config=speechsdk.languageconfig.AutoDetectSourceLanguageConfig(
-                        languages=[
-                            locale_by_language[lang] for lang in auto_detect_languages
-                        ],
-                    ),
-                )
+    def start(self) -> None:
+        self._pool.start()
+
+    async def close(self) -> None:
+        await self._pool.close()
+        self._sdk_executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _wait_for_sdk(self, future: speechsdk.ResultFuture) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._sdk_executor, future.get)
+        except Exception as e:
+            raise TranscriptionError("Speech SDK operation failed") from e
+
+    def _create_recognizer(
+        self,
+        audio_config: speechsdk.audio.AudioConfig,
+        locale: str | None,
+    ) -> speechsdk.SpeechRecognizer:
+        if locale is None:
+            return speechsdk.SpeechRecognizer(
+                speech_config=self._speech_config,
+                audio_config=audio_config,
+                auto_detect_source_language_config=speechsdk.languageconfig.AutoDetectSourceLanguageConfig(
+                    languages=[
+                        locale_by_language[lang] for lang in auto_detect_languages
+                    ],
+                ),
+            )
+
+        return speechsdk.SpeechRecognizer(
+            speech_config=self._speech_config,
+            audio_config=audio_config,
+            language=locale,
+        )
+
+    async def recognize_file(
+        self,
+        audio_file: Path,
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        # Audio in the streaming format can be pushed to a pooled recognizer,
+        # which has its connection already open
+        if await asyncio.to_thread(is_pcm_wave, audio_file):
+            return await self.recognize_stream(
+                read_wave_frames(audio_file),
+                None,
+                locale,
+                on_phrase=on_phrase,
+                on_language=on_language,
+            )
+
+        audio_config = speechsdk.AudioConfig(filename=str(audio_file))
+        recognizer = self._create_recognizer(audio_config, locale)
+        return await self._recognize(
+            recognizer,
+            on_phrase=on_phrase,
+            on_language=on_language,
+        )
+
+    async def recognize_stream(
+        self,
+        chunks: AsyncIterable[bytes],
+        audio_format: CompressedFormat | None,
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        pooled = await self._pool.acquire(audio_format, locale)
+        stream = pooled.stream
+
+        async def feed() -> None:
+            try:
+                async for chunk in chunks:
+                    stream.write(chunk)
+            finally:
+                # Closing the stream signals the end of the audio, even if
+                # the download or conversion failed.
+                stream.close()
+
+        feeder = asyncio.create_task(feed())
+        try:
+            result = await self._recognize(
+                pooled.recognizer,
+                on_phrase=on_phrase,
+                on_language=on_language,
+            )
+        except BaseException:
+            feeder.cancel()
+            raise
+        finally:
+            pooled.close()
+
+        # Propagates download/conversion errors
+        await feeder
+        return result
+
+    async def _recognize(
+        self,
+        recognizer: speechsdk.SpeechRecognizer,
+        *,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        """
+        Runs continuous recognition until the audio ends.
+
+        With auto-detection, `on_language` receives the language most of the
+        text was recognized in.
+        """
+        loop = asyncio.get_running_loop()
+        completion: asyncio.Future[None] = loop.create_future()
+        phrases: list[str] = []
+        text_length_by_language: Counter[str] = Counter()
+
+        # The SDK invokes all callbacks on its own threads, so everything is
+        # handed over to the event loop. call_soon_threadsafe keeps the order,
+        # so phrases are always appended before the completion is signaled.
+        def complete(error: TranscriptionError | None) -> None:
+            if completion.done():
+                return
+
+            if error is None:
+                completion.set_result(None)
             else:
-                recognizer = speechsdk.SpeechRecognizer(
-                    speech_config=self._speech_config,
-                    audio_config=audio_config,
-                    language=locale,
+                completion.set_exception(error)
+
+        def add_phrase(text: str, language: str | None) -> None:
+            phrases.append(text)
+            if language:
+                text_length_by_language[language] += len(text)
+            if on_phrase is not None:
+                on_phrase(text)
+
+        def on_recognized(evt: speechsdk.SpeechRecognitionEventArgs) -> None:
+            result = evt.result
+            if text := result.text:
+                # Only set if the recognizer was configured for auto-detection
+                language = speechsdk.AutoDetectSourceLanguageResult(result).language
+                loop.call_soon_threadsafe(add_phrase, text, language)
+
+        def on_stop(_: Any) -> None:
+            loop.call_soon_threadsafe(complete, None)
+
+        def on_canceled(evt: speechsdk.SpeechRecognitionCanceledEventArgs) -> None:
+            details = evt.cancellation_details
+            if details.reason == speechsdk.CancellationReason.EndOfStream:
+                loop.call_soon_threadsafe(complete, None)
+                return
+
+            loop.call_soon_threadsafe(
+                complete,
+                TranscriptionCanceledError(
+                    reason=str(details.reason),
+                    error_code=str(details.code),
+                    error_details=details.error_details,
+                ),
+            )
+
+        recognizer.recognized.connect(on_recognized)
+        recognizer.session_stopped.connect(on_stop)
+        recognizer.canceled.connect(on_canceled)
+        recognizer.speech_end_detected.connect(on_stop)
+
+        try:
+            await self._wait_for_sdk(recognizer.start_continuous_recognition_async())
+            await completion
+        finally:
+            try:
+                # Must not hang when the job was cancelled because it took too long
+                async with asyncio.timeout(_STOP_TIMEOUT.total_seconds()):
+                    await self._wait_for_sdk(
+                        recognizer.stop_continuous_recognition_async()
+                    )
+            except Exception as e:
+                _LOG.warning("Could not stop recognition", exc_info=e)
+
+            recognizer.recognized.disconnect_all()
+            recognizer.session_stopped.disconnect_all()
+            recognizer.canceled.disconnect_all()
+            recognizer.speech_end_detected.disconnect_all()
+
+        if on_language is not None and text_length_by_language:
+            [(language, _)] = text_length_by_language.most_common(1)
+            on_language(language)
+
+        return " ".join(phrases) or None
+
+
+class Transcriber:
+    """
+    Transcribes audio using one or more speech service endpoints.
+
+    Each recognition goes to an endpoint picked by weight. If more than one
+    endpoint is configured and the first one neither finished nor recognized
+    anything after a while, the same audio is also sent to a second endpoint
+    and whichever finishes first wins (see `EndpointRouter`).
+    """
+
+    def __init__(
+        self,
+        backends: list[RecognitionBackend],
+        *,
+        hedging: HedgingConfig,
+    ) -> None:
+        self._backends = backends
+        self._router = EndpointRouter(backends, hedging)
+
+    @classmethod
+    def from_config(
+        cls,
+        config: AzureTtsConfig,
+        *,
+        pool_config: RecognizerPoolConfig,
+    ) -> Self:
+        return cls(
+            [
+                AzureRecognitionBackend(
+                    region=endpoint.region,
+                    key=endpoint.key,
+                    weight=endpoint.weight,
+                    pool_config=pool_config,
                 )
+                for endpoint in config.endpoints
+            ],
+            hedging=config.hedging,
+        )
 
-            # TODO: clean this up.
-            result_text = ""
+    def start(self) -> None:
+        for backend in self._backends:
+            backend.start()
 
-            def on_recognized(evt) -> None:  # type: ignore[no-untyped-def]
-                nonlocal result_text
-                if result_text:
-                    result_text += " "
-                result_text += evt.result.text
+    async def close(self) -> None:
+        for backend in self._backends:
+            await backend.close()
 
-            recognizer.recognized.connect(on_recognized)
+    async def transcribe(
+        self,
+        audio_file: Path,
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None = None,
+        on_language: Callable[[str], None] | None = None,
+    ) -> str | None:
+        with (
+            tracer.start_as_current_span("transcribe"),
+            _measure_recognition(audio_format="wav", locale=locale),
+        ):
+            return await self._router.recognize(
+                lambda backend, on_phrase, on_language: backend.recognize_file(
+                    audio_file,
+                    locale,
+                    on_phrase=on_phrase,
+                    on_language=on_language,
+                ),
+                on_phrase=on_phrase,
+                on_language=on_language,
+            )
 
-            done = False
+    async def transcribe_segments(
+        self,
+        audio_files: list[Path],
+        locale: str | None,
+        *,
+        max_parallel: int,
+        segment_worker: Callable[[], AbstractAsyncContextManager[None]] = nullcontext,
+        on_language: Callable[[str], None] | None = None,
+    ) -> str | None:
+        """
+        Transcribes consecutive segments of a recording concurrently and joins
+        the results in order.
 
-            def on_stop(_: Any) -> None:
-                nonlocal done
-                recognizer.stop_continuous_recognition()
-                done = True
+        Each running segment holds a `segment_worker`, which lets the caller
+        bound recognitions across jobs.
+        """
+        with tracer.start_as_current_span(
+            "transcribe_segments",
+            attributes={"segments": len(audio_files)},
+        ):
+            semaphore = asyncio.Semaphore(max_parallel)
 
-            recognizer.speech_end_detected.connect(on_stop)
+            async def transcribe_segment(audio_file: Path) -> str | None:
+                async with semaphore, segment_worker():
+                    return await self.transcribe(
+                        audio_file,
+                        locale,
+                        on_language=on_language,
+                    )
 
+            tasks = [
+                asyncio.create_task(transcribe_segment(audio_file))
+                for audio_file in audio_files
+            ]
             try:
-                recognizer.start_continuous_recognition()
-                while not done:
-                    await asyncio.sleep(0.5)
-                return result_text or None
-            except BaseException as e:
-                raise OSError from e
+                results = await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                # Recognitions must be stopped before their files are deleted
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+
+            return " ".join(result for result in results if result) or None
+
+    async def transcribe_stream(
+        self,
+        pcm_chunks: AsyncIterable[bytes],
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None = None,
+        on_language: Callable[[str], None] | None = None,
+    ) -> str | None:
+        """
+        Transcribes raw PCM as produced by `AudioConverter.stream_to_pcm`.
+
+        Recognition starts right away and consumes the chunks while they're
+        still being produced.
+        """
+        with tracer.start_as_current_span("transcribe_stream"):
+            return await self._recognize_stream(
+                pcm_chunks,
+                audio_format=None,
+                locale=locale,
+                on_phrase=on_phrase,
+                on_language=on_language,
+            )
+
+    async def transcribe_compressed(
+        self,
+        chunks: AsyncIterable[bytes],
+        audio_format: CompressedFormat,
+        locale: str | None,
+        *,
+        on_phrase: Callable[[str], None] | None = None,
+        on_language: Callable[[str], None] | None = None,
+    ) -> str | None:
+        """
+        Transcribes a compressed file without converting it first. The speech
+        SDK decodes the audio (using GStreamer).
+        """
+        with tracer.start_as_current_span(
+            "transcribe_compressed",
+            attributes={"audio.format": audio_format},
+        ):
+            return await self._recognize_stream(
+                chunks,
+                audio_format=audio_format,
+                locale=locale,
+                on_phrase=on_phrase,
+                on_language=on_language,
+            )
+
+    async def _recognize_stream(
+        self,
+        chunks: AsyncIterable[bytes],
+        *,
+        audio_format: CompressedFormat | None,
+        locale: str | None,
+        on_phrase: Callable[[str], None] | None,
+        on_language: Callable[[str], None] | None,
+    ) -> str | None:
+        replayable: ReplayableChunks | None = None
+        if self._router.can_hedge:
+            # A hedged request needs to read the audio from the start again
+            replayable = ReplayableChunks(chunks)
+
+        try:
+            with _measure_recognition(
+                audio_format=str(audio_format) if audio_format else "pcm",
+                locale=locale,
+            ):
+                return await self._router.recognize(
+                    lambda backend, on_phrase, on_language: backend.recognize_stream(
+                        replayable.replay() if replayable else chunks,
+                        audio_format,
+                        locale,
+                        on_phrase=on_phrase,
+                        on_language=on_language,
+                    ),
+                    on_phrase=on_phrase,
+                    on_language=on_language,
+                )
+        finally:
+            if replayable:
+                await replayable.aclose()
+
+
+@contextmanager
+def _measure_recognition(*, audio_format: str, locale: str | None) -> Iterator[None]:
+    attributes = {"audio.format": audio_format, "locale": locale or "auto"}
+    started_at = monotonic()
+    try:
+        yield
+    except Exception:
+        _recognition_duration.record(
+            monotonic() - started_at,
+            {**attributes, "outcome": "failure"},
+        )
+        raise
+
+    _recognition_duration.record(
+        monotonic() - started_at,
+        {**attributes, "outcome": "success"},
+    )
@@ -1,7 +1,15 @@
-from typing import Self
+import abc
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Self
 
 from pydantic import BaseModel
 
+if TYPE_CHECKING:
+    from redis.asyncio import Redis
+
+_LOG = logging.getLogger(__name__)
+
 
 class GreenlistState(BaseModel):
     allowed_chat_ids: list[int]
@@ -43,3 +51,96 @@ class GreenlistState(BaseModel):
     def informed_chat(self, chat_id: int) -> None:
         if chat_id not in self.informed_chats:
             self.informed_chats.append(chat_id)
+
+
+@dataclass(frozen=True)
+class GreenlistSnapshot:
+    allowed_chat_ids: frozenset[int]
+    informed_chats: frozenset[int]
+
+
+class GreenlistStorage(abc.ABC):
+    @abc.abstractmethod
+    async def load(self) -> GreenlistSnapshot:
+        pass
+
+    @abc.abstractmethod
+    async def is_allowed(self, chat_id: int) -> bool:
+        pass
+
+    @abc.abstractmethod
+    async def allow(self, chat_id: int) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def deny(self, chat_id: int) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def informed_chat(self, chat_id: int) -> bool:
+        """
+        Marks the chat as informed.
+
+        Returns True if the chat had not been informed before.
+        """
+        pass
+
+
+class RedisGreenlistStorage(GreenlistStorage):
+    """
+    Stores the greenlist as two Redis sets, so every change is a single
+    atomic command instead of a rewrite of the whole state.
+    """
+
+    def __init__(self, redis: Redis, *, key_prefix: str) -> None:
+        self._redis = redis
+        self._allowed_key = f"{key_prefix}:greenlist:allowed"
+        self._informed_key = f"{key_prefix}:greenlist:informed"
+        self._migrated_key = f"{key_prefix}:greenlist:migrated"
+
+    async def needs_migration(self) -> bool:
+        return not await self._redis.exists(self._migrated_key)
+
+    async def migrate(self, state: GreenlistState) -> None:
+        """
+        Copies the given state (as previously stored as a single blob) into
+        the sets. This is idempotent, so concurrent migrations are harmless.
+        """
+        _LOG.info(
+            "Migrating greenlist with %d allowed and %d informed chats",
+            len(state.allowed_chat_ids),
+            len(state.informed_chats),
+        )
+        async with self._redis.pipeline(transaction=True) as pipe:
+            if state.allowed_chat_ids:
+                pipe.sadd(self._allowed_key, *state.allowed_chat_ids)
+            if state.informed_chats:
+                pipe.sadd(self._informed_key, *state.informed_chats)
+            pipe.set(self._migrated_key, 1)
+            await pipe.execute()
+
+    async def load(self) -> GreenlistSnapshot:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.smembers(self._allowed_key)
+            pipe.smembers(self._informed_key)
+            allowed, informed = await pipe.execute()
+
+        return GreenlistSnapshot(
+            allowed_chat_ids=frozenset(int(chat_id) for chat_id in allowed),
+            informed_chats=frozenset(int(chat_id) for chat_id in informed),
+        )
+
+    async def is_allowed(self, chat_id: int) -> bool:
+        return bool(await self._redis.sismember(self._allowed_key, str(chat_id)))
+
+    async def allow(self, chat_id: int) -> None:
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.sadd(self._allowed_key, chat_id)
+            pipe.srem(self._informed_key, chat_id)
+            await pipe.execute()
+
+    async def deny(self, chat_id: int) -> None:
+        await self._redis.srem(self._allowed_key, chat_id)
+
+    async def informed_chat(self, chat_id: int) -> bool:
+        return bool(await self._redis.sadd(self._informed_key, chat_id))
@@ -1,40 +1,99 @@
 import logging
 from typing import TYPE_CHECKING
 
-from opentelemetry import trace
+from opentelemetry import metrics, trace
 from opentelemetry._logs import set_logger_provider
 from opentelemetry.exporter.otlp.proto.grpc._log_exporter import OTLPLogExporter
+from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
 from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.asyncio import AsyncioInstrumentor
 from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
 from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
 from opentelemetry.sdk._logs._internal.export import BatchLogRecordProcessor
+from opentelemetry.sdk.metrics import Histogram, MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+from opentelemetry.sdk.metrics.view import ExplicitBucketHistogramAggregation, View
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.sdk.trace.sampling import Decision, StaticSampler
+from opentelemetry.sdk.trace.sampling import ALWAYS_OFF
 from telegram.request import HTTPXRequest
 
+from bot.sampling import RatioOrRecordSampler, TailSamplingSpanProcessor
+
 if TYPE_CHECKING:
+    from collections.abc import Callable
+
     import httpx
+    from opentelemetry.sdk.trace.export import SpanExporter
 
-    from bot.config import Config
+    from bot.config import Config, TracingConfig
 
 
-def setup_tracing(config: Config) -> None:
-    resource = Resource(attributes={SERVICE_NAME: "telegram-transcription-bot"})
+# The SDK's default buckets are meant for milliseconds
+_SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300)
+_RATIO_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5)
+
+
+def _setup_metrics(resource: Resource) -> None:
+    meter_provider = MeterProvider(
+        resource=resource,
+        metric_readers=[PeriodicExportingMetricReader(OTLPMetricExporter())],
+        views=[
+            View(
+                instrument_type=Histogram,
+                instrument_unit="s",
+                aggregation=ExplicitBucketHistogramAggregation(_SECONDS_BUCKETS),
+            ),
+            View(
+                instrument_type=Histogram,
+                instrument_unit="1",
+                aggregation=ExplicitBucketHistogramAggregation(_RATIO_BUCKETS),
+            ),
+        ],
+    )
+    # Instruments created at import time are bound to this provider now
+    metrics.set_meter_provider(meter_provider)
+
+
+def create_tracer_provider(
+    config: TracingConfig | None,
+    *,
+    resource: Resource,
+    create_exporter: Callable[[], SpanExporter],
+) -> TracerProvider:
+    """
+    Creates a provider that samples the configured share of traces and keeps
+    failed and slow ones, or one that records nothing if `config` is None.
+    """
+    if config is None:
+        return TracerProvider(resource=resource, sampler=ALWAYS_OFF)
 
     trace_provider = TracerProvider(
         resource=resource,
-        sampler=StaticSampler(Decision.RECORD_AND_SAMPLE),
+        sampler=RatioOrRecordSampler(config.sample_percent / 100),
+    )
+    trace_provider.add_span_processor(BatchSpanProcessor(create_exporter()))
+    trace_provider.add_span_processor(
+        TailSamplingSpanProcessor(
+            create_exporter(),
+            slow_threshold=config.slow_threshold,
+            max_traces=config.max_buffered_traces,
+        )
     )
+    return trace_provider
 
-    if config.enable_telemetry:
-        exporter = OTLPSpanExporter()
-        processor = BatchSpanProcessor(exporter)
-        trace_provider.add_span_processor(processor)
 
-    trace.set_tracer_provider(trace_provider)
+def setup_telemetry(config: Config) -> None:
+    resource = Resource(attributes={SERVICE_NAME: "telegram-transcription-bot"})
+
+    trace.set_tracer_provider(
+        create_tracer_provider(
+            config.tracing if config.enable_telemetry else None,
+            resource=resource,
+            create_exporter=OTLPSpanExporter,
+        )
+    )
 
     if config.enable_telemetry:
         logger_provider = LoggerProvider(resource=resource)
@@ -43,12 +102,16 @@ def setup_tracing(config: Config) -> None:
         logger_provider.add_log_record_processor(BatchLogRecordProcessor(log_exporter))
         handler = LoggingHandler(logger_provider=logger_provider)
         logging.root.addHandler(handler)
+        _setup_metrics(resource)
+        # Wraps every coroutine, which isn't worth it without an exporter
+        AsyncioInstrumentor().instrument()
+
 
-    AsyncioInstrumentor().instrument()
+def instrument_httpx_client(client: httpx.AsyncClient) -> httpx.AsyncClient:
+    HTTPXClientInstrumentor().instrument_client(client)
+    return client
 
 
 class InstrumentedHttpxRequest(HTTPXRequest):
     def _build_client(self) -> httpx.AsyncClient:
-        client = super()._build_client()
-        HTTPXClientInstrumentor().instrument_client(client)
-        return client
+        return instrument_httpx_client(super()._build_client())
@@ -1,9 +1,11 @@
 import asyncio
 import logging
-from datetime import UTC, datetime, timedelta
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import UTC, date, datetime, timedelta
 from typing import TYPE_CHECKING, Self
 
-from opentelemetry import trace
+from opentelemetry import metrics, trace
 from rate_limiter import RateLimiter, RateLimitingPolicy, RateLimitingRepo, Usage
 from rate_limiter.policy import DailyLimitRateLimitingPolicy
 from rate_limiter.repo import PostgresRateLimitingRepo
@@ -15,6 +17,20 @@ if TYPE_CHECKING:
 
 _LOG = logging.getLogger(__name__)
 _tracer = trace.get_tracer(__name__)
+_meter = metrics.get_meter(__name__)
+
+_rejections = _meter.create_counter(
+    "rate_limit.rejections",
+    description="Number of transcriptions refused by rate limit and reason",
+)
+
+_FLUSH_INTERVAL = timedelta(seconds=5)
+_FLUSH_BATCH_SIZE = 32
+# Should not exceed the connection pool size
+_MAX_CONCURRENT_WRITES = 4
+# Relocalizations are rare per file, the least recently used ones are reloaded
+# from the repo if they are ever needed again
+_MAX_RELOCALIZATIONS = 10_000
 
 
 class _UseOncePolicy(RateLimitingPolicy):
@@ -34,13 +50,66 @@ class _UseOncePolicy(RateLimitingPolicy):
         return None
 
 
+class _CapturingPolicy(RateLimitingPolicy):
+    """
+    Never limits anything, but remembers the usages the rate limiter loaded.
+    """
+
+    def __init__(self, history: int) -> None:
+        self._history = history
+        self.usages: list[Usage] = []
+
+    @property
+    def requested_history(self) -> int:
+        return self._history
+
+    async def get_offending_usage(
+        self, *, at_time: datetime, last_usages: list[Usage]
+    ) -> Usage | None:
+        self.usages = last_usages
+        return None
+
+
+@dataclass(frozen=True)
+class _PendingUsage:
+    time: datetime
+    context_id: str
+    user_id: int
+    response_id: str
+    reference_id: str
+    is_relocalization: bool
+
+
+@dataclass(frozen=True)
+class _DailyUsage:
+    """
+    A usage that counts towards the daily limit.
+
+    Usages tracked while the state of a user is loaded may already be in the
+    repo, so they are told apart by more than their time.
+    """
+
+    time: datetime
+    reference_id: str | None
+    response_id: str | None
+
+
 class UsageTracker:
+    """
+    Answers rate limit decisions from in-memory state.
+
+    The state of a user or relocalization key is loaded from the repo the
+    first time it is needed. New usages are applied locally right away and
+    written to the repo in batches in the background.
+    """
+
     def __init__(
         self,
         repo: RateLimitingRepo,
         limit_config: RateLimitConfig,
     ) -> None:
-        self._last_cleanup: datetime | None = None
+        self._repo = repo
+        self._daily_limit = limit_config.daily
         self._default_rate_limiter = RateLimiter(
             policy=DailyLimitRateLimitingPolicy(limit=limit_config.daily),
             repo=repo,
@@ -53,6 +122,13 @@ class UsageTracker:
             timezone=UTC,
         )
 
+        self._daily_usages: dict[int, set[_DailyUsage]] = {}
+        self._daily_usages_loading: dict[int, asyncio.Task[None]] = {}
+        self._daily_usages_day: date | None = None
+        self._relocalizations: OrderedDict[str, bool] = OrderedDict()
+        self._pending: asyncio.Queue[_PendingUsage] = asyncio.Queue()
+        self._flusher: asyncio.Task[None] | None = None
+
     @classmethod
     async def create(
         cls, db_config: DatabaseConfig, limit_config: RateLimitConfig
@@ -65,40 +141,139 @@ class UsageTracker:
             min_connections=1,
             max_connections=4,
         )
-        return cls(repo, limit_config)
+        tracker = cls(repo, limit_config)
+        tracker.start()
+        return tracker
+
+    def start(self) -> None:
+        self._flusher = asyncio.create_task(self._flush_periodically())
+
+    @staticmethod
+    def _relocalize_context_id(unique_file_id: str, locale: str) -> str:
+        return f"relocalize-{unique_file_id}-{locale}"
+
+    @_tracer.start_as_current_span("load_daily_usages")
+    async def _load_daily_usages(self, user_id: int, at_time: datetime) -> None:
+        # A separate limiter per load, because the policy captures the result
+        policy = _CapturingPolicy(self._daily_limit)
+        limiter = RateLimiter(policy=policy, repo=self._repo, timezone=UTC)
+        await limiter.get_offending_usage(
+            context_id="",
+            user_id=user_id,
+            at_time=at_time,
+        )
+        # Usages tracked while loading are already in the local state, and
+        # possibly in the loaded ones as well if they were flushed meanwhile
+        self._daily_usages.setdefault(user_id, set()).update(
+            _DailyUsage(
+                time=usage.time,
+                reference_id=usage.reference_id,
+                response_id=usage.response_id,
+            )
+            for usage in policy.usages
+        )
 
-    async def get_conflict(
+    def _forget_previous_days(self, day: date) -> None:
+        """
+        Drops the state of users who haven't used the bot since the given day.
+
+        Not part of `do_housekeeping`, because that only runs on one replica.
+        """
+        if self._daily_usages_day is not None and day <= self._daily_usages_day:
+            return
+
+        self._daily_usages_day = day
+        self._daily_usages = {
+            user_id: usages
+            for user_id, usages in self._daily_usages.items()
+            if any(usage.time.astimezone(UTC).date() >= day for usage in usages)
+        }
+
+    async def _get_daily_usages(
+        self,
+        user_id: int,
+        at_time: datetime,
+    ) -> set[_DailyUsage]:
+        day = at_time.astimezone(UTC).date()
+        self._forget_previous_days(day)
+        # Usages tracked during a load are known before the load is done
+        loading = self._daily_usages_loading.get(user_id)
+        if loading is None and user_id not in self._daily_usages:
+            loading = asyncio.create_task(self._load_daily_usages(user_id, at_time))
+            self._daily_usages_loading[user_id] = loading
+        if loading is not None:
+            try:
+                await asyncio.shield(loading)
+            finally:
+                if loading.done():
+                    self._daily_usages_loading.pop(user_id, None)
+
+        usages = {
+            usage
+            for usage in self._daily_usages.get(user_id, set())
+            if usage.time.astimezone(UTC).date() >= day
+        }
+        # Forget about previous days while we're at it
+        self._daily_usages[user_id] = usages
+        return usages
+
+    async def _is_relocalized(
         self,
         *,
         user_id: int,
         at_time: datetime,
-        unique_file_id: str,
-        locale: str | None,
-    ) -> Usage | None:
-        if usage := await self._default_rate_limiter.get_offending_usage(
-            context_id="",
+        context_id: str,
+    ) -> bool:
+        key = f"{user_id}:{context_id}"
+        if (known := self._relocalizations.get(key)) is not None:
+            self._relocalizations.move_to_end(key)
+            return known
+
+        usage = await self._relocalize_rate_limiter.get_offending_usage(
+            context_id=context_id,
             user_id=user_id,
             at_time=at_time,
-        ):
-            return usage
+        )
+        # Don't overwrite a usage that was tracked in the meantime
+        return self._remember_relocalization(
+            key,
+            self._relocalizations.get(key, usage is not None),
+        )
+
+    def _remember_relocalization(self, key: str, relocalized: bool) -> bool:
+        self._relocalizations[key] = relocalized
+        self._relocalizations.move_to_end(key)
+        while len(self._relocalizations) > _MAX_RELOCALIZATIONS:
+            self._relocalizations.popitem(last=False)
+        return relocalized
+
+    async def is_rate_limited(
+        self,
+        *,
+        user_id: int,
+        at_time: datetime,
+        unique_file_id: str,
+        locale: str | None,
+    ) -> bool:
+        daily_usages = await self._get_daily_usages(user_id, at_time)
+        if len(daily_usages) >= self._daily_limit:
+            _rejections.add(1, {"reason": "daily_limit"})
+            return True
 
         if locale is None:
-            return None
+            return False
 
-        return await self._relocalize_rate_limiter.get_offending_usage(
-            context_id=f"relocalize-{unique_file_id}-{locale}",
+        if await self._is_relocalized(
             user_id=user_id,
             at_time=at_time,
-        )
+            context_id=self._relocalize_context_id(unique_file_id, locale),
+        ):
+            _rejections.add(1, {"reason": "relocalization"})
+            return True
 
-    async def _cleanup(self) -> None:
-        now = datetime.now(tz=UTC)
-        last_cleanup = self._last_cleanup
-        if last_cleanup is not None and (now - last_cleanup) < timedelta(hours=1):
-            return
+        return False
 
-        _LOG.info("Triggering rate limiter housekeeping")
-        self._last_cleanup = now
+    async def do_housekeeping(self) -> None:
         await self._default_rate_limiter.do_housekeeping()
 
     async def track(
@@ -109,26 +284,84 @@ class UsageTracker:
         response_id: int | None,
         locale: str | None,
     ) -> None:
-        cleanup = asyncio.create_task(self._cleanup())
-
+        user_id: int = request.from_user.id  # type: ignore[union-attr]
         if locale is None:
-            await self._default_rate_limiter.add_usage(
-                time=request.date,
-                context_id="",
-                user_id=request.from_user.id,  # type: ignore[union-attr]
-                response_id=str(response_id),
-                reference_id=unique_file_id,
+            context_id = ""
+            self._daily_usages.setdefault(user_id, set()).add(
+                _DailyUsage(
+                    time=request.date,
+                    reference_id=unique_file_id,
+                    response_id=str(response_id),
+                )
             )
         else:
-            await self._relocalize_rate_limiter.add_usage(
+            context_id = self._relocalize_context_id(unique_file_id, locale)
+            self._remember_relocalization(f"{user_id}:{context_id}", True)
+
+        self._pending.put_nowait(
+            _PendingUsage(
                 time=request.date,
-                context_id=f"relocalize-{unique_file_id}-{locale}",
-                user_id=request.from_user.id,  # type: ignore[union-attr]
+                context_id=context_id,
+                user_id=user_id,
                 response_id=str(response_id),
                 reference_id=unique_file_id,
+                is_relocalization=locale is not None,
             )
+        )
 
-        await cleanup
+    async def _write_usage(self, usage: _PendingUsage) -> None:
+        if usage.is_relocalization:
+            limiter = self._relocalize_rate_limiter
+        else:
+            limiter = self._default_rate_limiter
+
+        await limiter.add_usage(
+            time=usage.time,
+            context_id=usage.context_id,
+            user_id=usage.user_id,
+            response_id=usage.response_id,
+            reference_id=usage.reference_id,
+        )
+
+    @_tracer.start_as_current_span("flush_usages")
+    async def _flush(self, batch: list[_PendingUsage]) -> None:
+        _LOG.debug("Writing %d usages", len(batch))
+        for index in range(0, len(batch), _MAX_CONCURRENT_WRITES):
+            chunk = batch[index : index + _MAX_CONCURRENT_WRITES]
+            results = await asyncio.gather(
+                *(self._write_usage(usage) for usage in chunk),
+                return_exceptions=True,
+            )
+            for usage, result in zip(chunk, results, strict=True):
+                if isinstance(result, Exception):
+                    _LOG.error(
+                        "Could not write usage of user %d",
+                        usage.user_id,
+                        exc_info=result,
+                    )
+
+    async def _flush_periodically(self) -> None:
+        pending = self._pending
+        while True:
+            batch = [await pending.get()]
+            try:
+                async with asyncio.timeout(_FLUSH_INTERVAL.total_seconds()):
+                    while len(batch) < _FLUSH_BATCH_SIZE:
+                        batch.append(await pending.get())
+            except TimeoutError:
+                pass
+
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    pending.task_done()
 
     async def close(self) -> None:
+        if flusher := self._flusher:
+            # Write everything that's still pending before closing the repo
+            await self._pending.join()
+            flusher.cancel()
+            await asyncio.gather(flusher, return_exceptions=True)
+
         await self._default_rate_limiter.close()
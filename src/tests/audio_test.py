@@ -0,0 +1,90 @@
+import math
+from array import array
+
+import pytest
+
+from bot.audio import PcmAudio, SilenceCompressor, compress_silence
+
+_SAMPLE_RATE = 16000
+
+
+def _tone(milliseconds: int) -> array:
+    count = _SAMPLE_RATE * milliseconds // 1000
+    return array(
+        "h",
+        (
+            int(8000 * math.sin(2 * math.pi * 440 * i / _SAMPLE_RATE))
+            for i in range(count)
+        ),
+    )
+
+
+def _silence(milliseconds: int) -> array:
+    return array("h", bytes(_SAMPLE_RATE * milliseconds // 1000 * 2))
+
+
+def _audio(*parts: array) -> PcmAudio:
+    samples = array("h")
+    for part in parts:
+        samples.extend(part)
+    return PcmAudio(samples=samples, sample_rate=_SAMPLE_RATE)
+
+
+_OPTIONS = dict(threshold_db=-40, padding_ms=300, min_silence_ms=500)
+
+
+def _compress_stream(audio: PcmAudio, chunk_size: int) -> tuple[bytes, float]:
+    compressor = SilenceCompressor(sample_rate=_SAMPLE_RATE, **_OPTIONS)
+    data = audio.samples.tobytes()
+    output = b"".join(
+        compressor.feed(data[start : start + chunk_size])
+        for start in range(0, len(data), chunk_size)
+    )
+    return output + compressor.flush(), compressor.removed_seconds
+
+
+def test_compress_silence_shortens_pauses():
+    audio = _audio(
+        _silence(2000),
+        _tone(500),
+        _silence(2000),
+        _tone(500),
+        _silence(2000),
+    )
+
+    compressed = compress_silence(audio, **_OPTIONS)
+
+    # Padding before, between and after the tones
+    assert compressed.duration == pytest.approx(0.3 + 0.5 + 0.6 + 0.5 + 0.3)
+
+
+def test_compress_silence_keeps_short_pauses():
+    # Pauses need room for the padding on both sides
+    audio = _audio(_tone(500), _silence(1000), _tone(500))
+
+    assert compress_silence(audio, **_OPTIONS) is audio
+
+
+def test_silence_compressor_matches_compress_silence():
+    audio = _audio(
+        _silence(1000),
+        _tone(500),
+        _silence(2000),
+        _tone(500),
+        _silence(1000),
+        _tone(250),
+        _silence(1990),
+    )
+    expected = compress_silence(audio, **_OPTIONS)
+
+    # Chunks that don't align with frames or even samples
+    for chunk_size in (777, 32 * 1024):
+        output, removed_seconds = _compress_stream(audio, chunk_size)
+        assert output == expected.samples.tobytes()
+        assert removed_seconds == round(audio.duration - expected.duration, 2)
+
+
+def test_silence_compressor_keeps_audio_that_is_only_silence():
+    output, _ = _compress_stream(_audio(_silence(500)), 1000)
+
+    assert len(output) == _SAMPLE_RATE
@@ -0,0 +1,159 @@
+import asyncio
+from datetime import UTC, datetime, timedelta
+
+from telegram import Chat, Message, Update, User, Voice
+from telegram.constants import ChatType
+
+from benchmarks.pipeline import (
+    _close_bot,
+    _create_bot,
+    _create_config,
+    _create_message,
+    _Latencies,
+)
+from benchmarks.standins import FakeTelegramBot
+from bot import usage
+
+_NO_LATENCY = _Latencies(
+    telegram_api=timedelta(0),
+    telegram_download=timedelta(0),
+    recognition=timedelta(0),
+)
+
+
+class _RecordingTelegramBot(FakeTelegramBot):
+    def __init__(self) -> None:
+        super().__init__(latency=timedelta(0))
+        self.texts = []
+        self.documents = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.texts.append(text)
+        return await super().send_message(chat_id, text, **kwargs)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self.documents.append(document)
+
+
+class _Context:
+    def __init__(self, bot: FakeTelegramBot, args: list[str]) -> None:
+        self.bot = bot
+        self.args = args
+
+
+async def _start_bot(tmp_path, monkeypatch):
+    # Closing the bot waits for the usages to be written
+    monkeypatch.setattr(usage, "_FLUSH_INTERVAL", timedelta(milliseconds=10))
+
+    config = _create_config(
+        scratch_dir=tmp_path,
+        conversion_profile="speech",
+        streaming=False,
+        passthrough=True,
+        trim_silence=False,
+    )
+    # Only the recognition locale matters, so it's never guessed
+    config.locale_learning.redetect_percent = 0
+    return await _create_bot(
+        config,
+        chat_ids=[1],
+        latencies=_NO_LATENCY,
+        fixture_files={},
+    )
+
+
+async def _process_voice(bot, telegram: FakeTelegramBot) -> str:
+    voice = Voice(file_id="voice", file_unique_id="unique-voice", duration=5)
+    message = _create_message(telegram, voice, chat_id=1)
+    response = telegram.expect_response(1)
+    await bot._process_message(message, voice, update_id=1, locale=None)
+    return await asyncio.wait_for(response, timeout=5)
+
+
+def test_cached_transcript_of_pinned_locale_is_used(tmp_path, monkeypatch):
+    async def run():
+        bot = await _start_bot(tmp_path, monkeypatch)
+        telegram = _RecordingTelegramBot()
+        await bot.locale_learner.pin(1, "en-US")
+        await bot.transcript_cache.put(
+            file_unique_id="unique-voice",
+            locale=None,
+            transcript="Erkannt",
+        )
+        await bot.transcript_cache.put(
+            file_unique_id="unique-voice",
+            locale="en-US",
+            transcript="Recognized",
+        )
+
+        # There's no file to download, only the cache can answer
+        assert await _process_voice(bot, telegram) == "reply"
+        await _close_bot(bot)
+
+        assert telegram.texts == ["Recognized"]
+
+    asyncio.run(run())
+
+
+def test_transcript_is_cached_for_pinned_locale(tmp_path, monkeypatch):
+    async def run():
+        bot = await _start_bot(tmp_path, monkeypatch)
+        telegram = _RecordingTelegramBot()
+        await bot.locale_learner.pin(1, "en-US")
+        locales = []
+
+        async def transcribe(message, file, *, locale, **_):
+            locales.append(locale)
+            return "Recognized"
+
+        bot._transcribe_in_job = transcribe
+
+        assert await _process_voice(bot, telegram) == "reply"
+        await _close_bot(bot)
+
+        assert locales == ["en-US"]
+        for locale, transcript in ((None, None), ("en-US", "Recognized")):
+            cached = await bot.transcript_cache.get(
+                file_unique_id="unique-voice",
+                locale=locale,
+                audio_seconds=5,
+            )
+            assert cached == transcript
+
+    asyncio.run(run())
+
+
+def _command(telegram: FakeTelegramBot, update_id: int, text: str) -> Update:
+    # The admin of the benchmark config
+    admin = User(id=0, first_name="Admin", is_bot=False)
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(UTC),
+        chat=Chat(id=admin.id, type=ChatType.PRIVATE),
+        from_user=admin,
+        text=text,
+    )
+    message.set_bot(telegram)
+    return Update(update_id=update_id, message=message)
+
+
+def test_rejects_profiling_while_profiling(tmp_path, monkeypatch):
+    async def run():
+        bot = await _start_bot(tmp_path, monkeypatch)
+        telegram = _RecordingTelegramBot()
+        context = _Context(telegram, ["1"])
+
+        first = asyncio.create_task(
+            bot._profile(_command(telegram, 1, "/profile 1"), context)
+        )
+        while not bot.profiler.is_running:
+            await asyncio.sleep(0.01)
+        await bot._profile(_command(telegram, 2, "/profile 1"), context)
+        assert telegram.texts == ["Already profiling"]
+
+        await first
+        await _close_bot(bot)
+
+        assert len(telegram.documents) == 1
+
+    asyncio.run(run())
@@ -0,0 +1,231 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from bot import coalescing
+from bot.coalescing import TranscriptionCoalescer
+from bot.config import CoalescingConfig
+
+
+class _FakeRedis:
+    """Just enough Redis for the lease, without expiration."""
+
+    def __init__(self) -> None:
+        self.values = {}
+        self.renewals = 0
+
+    async def set(self, key, value, *, nx=False, px=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+
+    async def exists(self, key):
+        return int(key in self.values)
+
+    def register_script(self, script):
+        async def run(*, keys, args):
+            key, token = keys[0], args[0]
+            if self.values.get(key) != token:
+                return 0
+            if "pexpire" in script:
+                self.renewals += 1
+            else:
+                del self.values[key]
+            return 1
+
+        return run
+
+
+class _FakeCache:
+    def __init__(self) -> None:
+        self.transcripts = {}
+
+    async def get(self, *, file_unique_id, locale, audio_seconds):
+        return self.transcripts.get((file_unique_id, locale))
+
+    async def put(self, *, file_unique_id, locale, transcript):
+        self.transcripts[file_unique_id, locale] = transcript
+
+
+def _coalescer(
+    *,
+    redis=None,
+    cache=None,
+    redis_lease: bool = False,
+    lease_ttl: timedelta = timedelta(seconds=60),
+) -> TranscriptionCoalescer:
+    return TranscriptionCoalescer(
+        CoalescingConfig(redis_lease=redis_lease, lease_ttl=lease_ttl),
+        cache=cache or _FakeCache(),
+        redis=redis or _FakeRedis(),
+        key_prefix="test",
+    )
+
+
+def test_waiters_get_result_of_running_transcription():
+    async def run():
+        cache = _FakeCache()
+        coalescer = _coalescer(cache=cache)
+        calls = 0
+        release = asyncio.Event()
+
+        async def transcribe():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return "hallo"
+
+        callers = [
+            asyncio.create_task(
+                coalescer.transcribe(
+                    file_unique_id="file",
+                    locale=None,
+                    audio_seconds=10,
+                    transcribe=transcribe,
+                )
+            )
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        release.set()
+
+        assert await asyncio.gather(*callers) == ["hallo"] * 3
+        assert calls == 1
+        assert coalescer.joined_waiters == 2
+        assert coalescer.saved_audio_seconds == 20
+        assert cache.transcripts == {("file", None): "hallo"}
+
+    asyncio.run(run())
+
+
+def test_other_locales_are_transcribed_separately():
+    async def run():
+        coalescer = _coalescer()
+
+        async def transcribe(locale):
+            await asyncio.sleep(0.01)
+            return locale
+
+        results = await asyncio.gather(
+            *(
+                coalescer.transcribe(
+                    file_unique_id="file",
+                    locale=locale,
+                    audio_seconds=10,
+                    transcribe=lambda locale=locale: transcribe(locale),
+                )
+                for locale in ("de-DE", "en-US")
+            )
+        )
+
+        assert results == ["de-DE", "en-US"]
+        assert coalescer.joined_waiters == 0
+
+    asyncio.run(run())
+
+
+def test_leader_failure_is_raised_to_waiters():
+    async def run():
+        coalescer = _coalescer()
+        calls = 0
+
+        async def transcribe():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            raise OSError("Could not convert file")
+
+        results = await asyncio.gather(
+            *(
+                coalescer.transcribe(
+                    file_unique_id="file",
+                    locale=None,
+                    audio_seconds=10,
+                    transcribe=transcribe,
+                )
+                for _ in range(3)
+            ),
+            return_exceptions=True,
+        )
+
+        assert calls == 1
+        assert all(isinstance(result, OSError) for result in results)
+
+        # The failure isn't remembered
+        with pytest.raises(OSError):
+            await coalescer.transcribe(
+                file_unique_id="file",
+                locale=None,
+                audio_seconds=10,
+                transcribe=transcribe,
+            )
+        assert calls == 2
+
+    asyncio.run(run())
+
+
+def test_lease_is_renewed_while_transcribing():
+    async def run():
+        redis = _FakeRedis()
+        coalescer = _coalescer(
+            redis=redis,
+            redis_lease=True,
+            lease_ttl=timedelta(milliseconds=30),
+        )
+
+        async def transcribe():
+            assert len(redis.values) == 1
+            await asyncio.sleep(0.1)
+            return "hallo"
+
+        result = await coalescer.transcribe(
+            file_unique_id="file",
+            locale=None,
+            audio_seconds=10,
+            transcribe=transcribe,
+        )
+
+        assert result == "hallo"
+        assert redis.renewals >= 3
+        # Released once done
+        assert redis.values == {}
+
+    asyncio.run(run())
+
+
+def test_waits_for_lease_of_other_replica(monkeypatch):
+    monkeypatch.setattr(
+        coalescing,
+        "_LEASE_POLL_INTERVAL",
+        timedelta(milliseconds=10),
+    )
+
+    async def run():
+        redis = _FakeRedis()
+        cache = _FakeCache()
+        coalescer = _coalescer(redis=redis, cache=cache, redis_lease=True)
+        redis.values["test:transcription-lease:file:auto"] = "other replica"
+
+        async def transcribe():
+            raise AssertionError("Should have used the other replica's result")
+
+        waiter = asyncio.create_task(
+            coalescer.transcribe(
+                file_unique_id="file",
+                locale=None,
+                audio_seconds=10,
+                transcribe=transcribe,
+            )
+        )
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+
+        cache.transcripts["file", None] = "hallo"
+        redis.values.clear()
+
+        assert await asyncio.wait_for(waiter, 1) == "hallo"
+        assert coalescer.joined_waiters == 1
+
+    asyncio.run(run())
@@ -0,0 +1,79 @@
+import asyncio
+import wave
+
+from bot.conversion import (
+    CompressedFormat,
+    detect_compressed_format,
+    is_pcm_wave,
+    is_streamable,
+    read_wave_frames,
+)
+
+
+def _box(box_type: bytes, payload: bytes = b"") -> bytes:
+    return (8 + len(payload)).to_bytes(4, "big") + box_type + payload
+
+
+_FTYP = _box(b"ftyp", b"M4A \x00\x00\x02\x00M4A isom")
+
+
+def test_mp4_with_index_first_is_streamable():
+    assert is_streamable(_FTYP + _box(b"moov") + _box(b"mdat"))
+
+
+def test_mp4_with_index_last_is_not_streamable():
+    assert not is_streamable(_FTYP + _box(b"free") + _box(b"mdat"))
+
+
+def test_other_containers_are_streamable():
+    assert is_streamable(b"OggS\x00\x02" + bytes(58))
+    assert is_streamable(b"ID3\x04" + bytes(60))
+
+
+def test_mp3_frames_are_detected():
+    # MPEG-1 and MPEG-2 Layer III without an ID3 tag
+    assert detect_compressed_format(b"\xff\xfb\x90\x64" + bytes(60)) == (
+        CompressedFormat.MP3
+    )
+    assert detect_compressed_format(b"\xff\xf3\x64\xc4" + bytes(60)) == (
+        CompressedFormat.MP3
+    )
+
+
+def test_adts_is_not_mp3():
+    # AAC LC, 44.1 kHz, stereo
+    assert detect_compressed_format(b"\xff\xf1\x50\x80\x02\x1f\xfc" + bytes(57)) is None
+
+
+def _write_wave(path, *, channels: int, sample_rate: int, frames: bytes) -> None:
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(frames)
+
+
+def test_only_wave_in_stream_format_is_pcm(tmp_path):
+    speech = tmp_path / "speech.wav"
+    _write_wave(speech, channels=1, sample_rate=16000, frames=bytes(3200))
+    stereo = tmp_path / "stereo.wav"
+    _write_wave(stereo, channels=2, sample_rate=48000, frames=bytes(3200))
+    truncated = tmp_path / "truncated.wav"
+    truncated.write_bytes(speech.read_bytes()[:20])
+
+    assert is_pcm_wave(speech)
+    assert not is_pcm_wave(stereo)
+    assert not is_pcm_wave(truncated)
+
+
+def test_wave_frames_are_read_without_header(tmp_path):
+    frames = bytes(range(256)) * 1000
+    path = tmp_path / "speech.wav"
+    _write_wave(path, channels=1, sample_rate=16000, frames=frames)
+
+    async def run():
+        return [chunk async for chunk in read_wave_frames(path)]
+
+    chunks = asyncio.run(run())
+    assert len(chunks) > 1
+    assert b"".join(chunks) == frames
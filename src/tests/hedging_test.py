@@ -0,0 +1,209 @@
+import asyncio
+from datetime import timedelta
+from pathlib import Path
+from time import monotonic
+
+import pytest
+
+from benchmarks.fake_speech import FakeRecognitionBackend
+from bot import hedging
+from bot.config import HedgingConfig
+from bot.hedging import EndpointRouter, _Endpoint
+from bot.recognition import TranscriptionError
+
+
+def _config(
+    *,
+    enabled: bool = True,
+    percentile: int = 90,
+    default_delay: timedelta = timedelta(milliseconds=50),
+    min_delay: timedelta = timedelta(0),
+    max_delay: timedelta = timedelta(seconds=10),
+    failure_threshold: int = 2,
+    open_duration: timedelta = timedelta(milliseconds=50),
+) -> HedgingConfig:
+    return HedgingConfig(
+        enabled=enabled,
+        percentile=percentile,
+        default_delay=default_delay,
+        min_delay=min_delay,
+        max_delay=max_delay,
+        failure_threshold=failure_threshold,
+        open_duration=open_duration,
+    )
+
+
+class _InOrder:
+    """Replaces the weighted choice of endpoints, always picks the first."""
+
+    @staticmethod
+    def choices(population, weights):
+        return [population[0]]
+
+
+@pytest.fixture
+def in_order(monkeypatch):
+    monkeypatch.setattr(hedging, "random", _InOrder())
+
+
+def _recognize(router):
+    def attempt(backend, on_phrase, on_language):
+        return backend.recognize_file(
+            Path("unused.wav"),
+            None,
+            on_phrase=on_phrase,
+            on_language=on_language,
+        )
+
+    return router.recognize(attempt, on_phrase=None, on_language=None)
+
+
+def test_hedge_delay_is_default_without_enough_samples():
+    endpoint = _Endpoint(FakeRecognitionBackend(), _config())
+    for _ in range(5):
+        endpoint.record_first_phrase(1)
+
+    assert endpoint.hedge_delay() == 0.05
+
+
+def test_hedge_delay_is_percentile_of_first_phrase_latencies():
+    endpoint = _Endpoint(FakeRecognitionBackend(), _config(percentile=90))
+    for milliseconds in range(1, 101):
+        endpoint.record_first_phrase(milliseconds / 1000)
+
+    assert endpoint.hedge_delay() == pytest.approx(0.09, abs=0.002)
+
+
+def test_hedge_delay_is_clamped():
+    config = _config(
+        percentile=50,
+        min_delay=timedelta(milliseconds=500),
+        max_delay=timedelta(seconds=2),
+    )
+    fast = _Endpoint(FakeRecognitionBackend(), config)
+    slow = _Endpoint(FakeRecognitionBackend(), config)
+    for _ in range(20):
+        fast.record_first_phrase(0.1)
+        slow.record_first_phrase(5)
+
+    assert fast.hedge_delay() == 0.5
+    assert slow.hedge_delay() == 2
+
+
+def test_circuit_opens_after_consecutive_failures():
+    endpoint = _Endpoint(FakeRecognitionBackend(), _config(failure_threshold=2))
+    endpoint.record_failure()
+    endpoint.record_success()
+    endpoint.record_failure()
+    assert endpoint.is_available()
+
+    endpoint.record_failure()
+    assert not endpoint.is_available()
+
+
+def test_circuit_half_opens_after_break():
+    async def run():
+        endpoint = _Endpoint(FakeRecognitionBackend(), _config(failure_threshold=3))
+        for _ in range(3):
+            endpoint.record_failure()
+        assert not endpoint.is_available()
+
+        await asyncio.sleep(0.06)
+        assert endpoint.is_available()
+
+        # A single failure after the break is enough to open it again
+        endpoint.record_failure()
+        assert not endpoint.is_available()
+
+        await asyncio.sleep(0.06)
+        endpoint.record_success()
+        endpoint.record_failure()
+        assert endpoint.is_available()
+
+    asyncio.run(run())
+
+
+def test_slow_endpoint_is_hedged(in_order):
+    async def run():
+        slow = FakeRecognitionBackend(
+            "slow",
+            transcript="slow",
+            latency=timedelta(seconds=2),
+        )
+        fast = FakeRecognitionBackend(
+            "fast",
+            transcript="fast",
+            latency=timedelta(milliseconds=50),
+        )
+        router = EndpointRouter([slow, fast], _config())
+
+        started_at = monotonic()
+        assert await _recognize(router) == "fast"
+        assert monotonic() - started_at < 1
+        assert slow.recognitions == fast.recognitions == 1
+
+    asyncio.run(run())
+
+
+def test_failed_endpoint_is_hedged_right_away(in_order):
+    async def run():
+        broken = FakeRecognitionBackend(
+            "broken",
+            latency=timedelta(milliseconds=20),
+            failure_rate=1,
+        )
+        healthy = FakeRecognitionBackend(
+            "healthy",
+            transcript="healthy",
+            latency=timedelta(milliseconds=20),
+        )
+        router = EndpointRouter(
+            [broken, healthy],
+            _config(default_delay=timedelta(seconds=5)),
+        )
+
+        started_at = monotonic()
+        assert await _recognize(router) == "healthy"
+        assert monotonic() - started_at < 1
+
+    asyncio.run(run())
+
+
+def test_open_circuit_is_skipped(in_order):
+    async def run():
+        broken = FakeRecognitionBackend(
+            "broken",
+            latency=timedelta(milliseconds=10),
+            failure_rate=1,
+        )
+        healthy = FakeRecognitionBackend(
+            "healthy",
+            latency=timedelta(milliseconds=10),
+        )
+        router = EndpointRouter(
+            [broken, healthy],
+            _config(
+                enabled=False,
+                failure_threshold=1,
+                open_duration=timedelta(seconds=10),
+            ),
+        )
+
+        with pytest.raises(TranscriptionError):
+            await _recognize(router)
+        assert await _recognize(router) == healthy.transcript
+        assert broken.recognitions == 1
+
+    asyncio.run(run())
+
+
+def test_no_hedge_when_disabled(in_order):
+    async def run():
+        slow = FakeRecognitionBackend("slow", latency=timedelta(milliseconds=200))
+        other = FakeRecognitionBackend("other")
+        router = EndpointRouter([slow, other], _config(enabled=False))
+
+        assert await _recognize(router) == slow.transcript
+        assert other.recognitions == 0
+
+    asyncio.run(run())
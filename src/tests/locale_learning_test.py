@@ -0,0 +1,168 @@
+import asyncio
+
+from bot import locale_learning
+from bot.config import LocaleLearningConfig
+from bot.locale_learning import LocaleLearner
+
+
+class _FakeRedis:
+    """Just enough Redis hashes for the learner."""
+
+    def __init__(self) -> None:
+        self.hashes = {}
+
+    async def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    async def hincrby(self, key, name, amount=1):
+        values = self.hashes.setdefault(key, {})
+        values[name] = str(int(values.get(name, 0)) + amount)
+        return int(values[name])
+
+    async def hset(self, key, name=None, value=None, *, mapping=None):
+        values = self.hashes.setdefault(key, {})
+        if name is not None:
+            values[name] = str(value)
+        values.update((name, str(value)) for name, value in (mapping or {}).items())
+
+    async def hdel(self, key, *names):
+        for name in names:
+            self.hashes.get(key, {}).pop(name, None)
+
+    async def delete(self, key):
+        self.hashes.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return _FakePipeline(self)
+
+
+class _FakePipeline:
+    def __init__(self, redis: _FakeRedis) -> None:
+        self._redis = redis
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        pass
+
+    def delete(self, *args):
+        self._commands.append(self._redis.delete(*args))
+
+    def hset(self, *args, **kwargs):
+        self._commands.append(self._redis.hset(*args, **kwargs))
+
+    async def execute(self):
+        return [await command for command in self._commands]
+
+
+def _learner(redis: _FakeRedis | None = None, *, enabled: bool = True) -> LocaleLearner:
+    return LocaleLearner(
+        LocaleLearningConfig(
+            enabled=enabled,
+            min_observations=3,
+            min_share_percent=80,
+            redetect_percent=10,
+        ),
+        redis=redis or _FakeRedis(),
+        key_prefix="test",
+    )
+
+
+def _never_redetect(monkeypatch) -> None:
+    monkeypatch.setattr(locale_learning.random, "random", lambda: 0.99)
+
+
+async def _observe(learner: LocaleLearner, locale: str, times: int, **ids: int) -> None:
+    for _ in range(times):
+        await learner.observe(locale=locale, **ids)
+
+
+def test_uses_locale_once_confident(monkeypatch):
+    _never_redetect(monkeypatch)
+
+    async def run():
+        learner = _learner()
+        await _observe(learner, "de-DE", 2, chat_id=1, user_id=1)
+        assert await learner.resolve(chat_id=1, user_id=1) is None
+
+        await _observe(learner, "de-DE", 1, chat_id=1, user_id=1)
+        assert await learner.resolve(chat_id=1, user_id=1) == "de-DE"
+
+    asyncio.run(run())
+
+
+def test_mixed_chat_falls_back_to_user(monkeypatch):
+    _never_redetect(monkeypatch)
+
+    async def run():
+        learner = _learner()
+        await _observe(learner, "de-DE", 4, chat_id=1, user_id=1)
+        await _observe(learner, "en-US", 3, chat_id=1, user_id=2)
+
+        # 4 of 7 is below the share the chat needs
+        assert await learner.resolve(chat_id=1, user_id=1) == "de-DE"
+        assert await learner.resolve(chat_id=1, user_id=2) == "en-US"
+        assert await learner.resolve(chat_id=1, user_id=3) is None
+
+    asyncio.run(run())
+
+
+def test_redetects_occasionally(monkeypatch):
+    async def run():
+        learner = _learner()
+        await _observe(learner, "de-DE", 3, chat_id=1, user_id=1)
+
+        monkeypatch.setattr(locale_learning.random, "random", lambda: 0.05)
+        assert await learner.resolve(chat_id=1, user_id=1) is None
+
+    asyncio.run(run())
+
+
+def test_user_pin_overrides_chat(monkeypatch):
+    _never_redetect(monkeypatch)
+
+    async def run():
+        redis = _FakeRedis()
+        learner = _learner(redis)
+        await _observe(learner, "de-DE", 5, chat_id=1, user_id=1)
+        await learner.pin(2, "en-US")
+
+        assert await learner.resolve(chat_id=1, user_id=2) == "en-US"
+        # Other members of the chat aren't affected
+        assert await learner.resolve(chat_id=1, user_id=1) == "de-DE"
+        # Replicas that didn't see the pin load it from Redis
+        assert await _learner(redis).resolve(chat_id=3, user_id=2) == "en-US"
+
+        await learner.pin(2, None)
+        assert await learner.resolve(chat_id=1, user_id=2) == "de-DE"
+
+    asyncio.run(run())
+
+
+def test_pin_applies_without_learning(monkeypatch):
+    # Even the redetection is skipped for pinned users
+    monkeypatch.setattr(locale_learning.random, "random", lambda: 0.0)
+
+    async def run():
+        learner = _learner(enabled=False)
+        await learner.pin(1, "en-US")
+
+        assert await learner.resolve(chat_id=1, user_id=1) == "en-US"
+
+    asyncio.run(run())
+
+
+def test_pin_survives_decay(monkeypatch):
+    _never_redetect(monkeypatch)
+
+    async def run():
+        redis = _FakeRedis()
+        learner = _learner(redis)
+        await learner.pin(1, "en-US")
+        await _observe(learner, "de-DE", 60, chat_id=1, user_id=1)
+
+        assert await _learner(redis).resolve(chat_id=2, user_id=1) == "en-US"
+
+    asyncio.run(run())
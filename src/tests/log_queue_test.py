@@ -0,0 +1,98 @@
+import logging
+import queue
+
+from sentry_sdk.serializer import serialize
+
+from bot.log_queue import (
+    LazyLogValue,
+    _BoundedQueueHandler,
+    _ContextQueueListener,
+    process_output,
+)
+
+
+class _CapturingHandler(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def _log_to_queue(log_queue, *args, **kwargs):
+    logger = logging.getLogger("tests.log_queue")
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = _BoundedQueueHandler(log_queue)
+    logger.addHandler(handler)
+    try:
+        logger.info(*args, **kwargs)
+    finally:
+        logger.removeHandler(handler)
+    return handler
+
+
+def test_message_is_formatted_on_calling_thread():
+    log_queue = queue.Queue(1)
+    values = ["before"]
+    _log_to_queue(log_queue, "Values: %s", values)
+    values[0] = "after"
+
+    record = log_queue.get_nowait()
+    assert record.getMessage() == "Values: ['before']"
+    assert record.args is None
+
+
+def test_lazy_values_are_rendered_by_listener():
+    log_queue = queue.Queue(1)
+    renders = []
+
+    def render():
+        renders.append(1)
+        return "ffmpeg output"
+
+    _log_to_queue(log_queue, "Converted", extra=dict(stderr=LazyLogValue(render)))
+    record = log_queue.get_nowait()
+    assert not renders
+
+    capturing = _CapturingHandler()
+    _ContextQueueListener(log_queue, capturing).handle(record)
+    assert capturing.records[0].stderr == "ffmpeg output"
+
+
+def test_lazy_values_are_rendered_for_sentry():
+    # Sentry handles records on the calling thread, before they're queued
+    capturing = _CapturingHandler()
+    logger = logging.getLogger("tests.log_queue.sentry")
+    logger.propagate = False
+    logger.addHandler(capturing)
+    logger.error(
+        "Converted file with exit code %d",
+        1,
+        extra=dict(stderr=process_output(b"Invalid data found")),
+    )
+
+    event = serialize({"extra": {"stderr": capturing.records[0].stderr}})
+    assert event["extra"]["stderr"] == "Invalid data found"
+
+
+def test_exception_is_kept_for_handlers():
+    log_queue = queue.Queue(1)
+    try:
+        raise ValueError("broken")
+    except ValueError:
+        _log_to_queue(log_queue, "Failed", exc_info=True)
+
+    record = log_queue.get_nowait()
+    assert record.exc_info[0] is ValueError
+    assert record.getMessage() == "Failed"
+
+
+def test_records_are_dropped_when_queue_is_full():
+    log_queue = queue.Queue(1)
+    _log_to_queue(log_queue, "first")
+    handler = _log_to_queue(log_queue, "second")
+
+    assert handler.dropped == 1
+    assert log_queue.get_nowait().getMessage() == "first"
@@ -0,0 +1,167 @@
+import asyncio
+from datetime import timedelta
+from time import monotonic
+
+import pytest
+from telegram import Chat
+from telegram.constants import ChatType
+from telegram.error import BadRequest, RetryAfter
+
+from bot.config import OutboxConfig
+from bot.outbox import Outbox, Priority
+
+
+def _outbox(*, max_concurrent_sends: int = 1) -> Outbox:
+    return Outbox(
+        OutboxConfig(
+            global_rate=30,
+            private_chat_rate=60,
+            group_chat_rate=20,
+            max_concurrent_sends=max_concurrent_sends,
+        )
+    )
+
+
+def _chat(chat_id: int) -> Chat:
+    return Chat(id=chat_id, type=ChatType.PRIVATE)
+
+
+def test_higher_priorities_are_sent_first():
+    async def run():
+        outbox = _outbox()
+        sent = []
+
+        def send(name):
+            async def do_send():
+                sent.append(name)
+
+            return do_send
+
+        outbox.submit(_chat(1), send("notice"), priority=Priority.NOTICE)
+        outbox.submit(_chat(2), send("reaction"), priority=Priority.REACTION)
+        outbox.submit(_chat(3), send("reply"), priority=Priority.REPLY)
+        outbox.submit(_chat(4), send("second reply"), priority=Priority.REPLY)
+        outbox.start()
+        await outbox.close()
+
+        assert sent == ["reply", "second reply", "reaction", "notice"]
+
+    asyncio.run(run())
+
+
+def test_requests_of_a_chat_are_sent_in_order():
+    async def run():
+        outbox = _outbox(max_concurrent_sends=4)
+        chat = _chat(1)
+        sent = []
+
+        def send(index):
+            async def do_send():
+                await asyncio.sleep(0.01)
+                sent.append(index)
+
+            return do_send
+
+        for index in range(3):
+            outbox.submit(chat, send(index), priority=Priority.REPLY)
+        outbox.start()
+        await outbox.close()
+
+        assert sent == [0, 1, 2]
+
+    asyncio.run(run())
+
+
+def test_retry_after_requeues_request(monkeypatch):
+    monkeypatch.setenv("PTB_TIMEDELTA", "true")
+
+    async def run():
+        outbox = _outbox()
+        chat = _chat(1)
+        attempts = []
+        results = []
+
+        async def flaky_send():
+            attempts.append(monotonic())
+            if len(attempts) == 1:
+                raise RetryAfter(timedelta(milliseconds=200))
+            return "sent"
+
+        async def on_sent(result):
+            results.append(result)
+
+        outbox.submit(chat, flaky_send, priority=Priority.REPLY, on_sent=on_sent)
+        outbox.start()
+        await outbox.close()
+
+        assert len(attempts) == 2
+        assert attempts[1] - attempts[0] >= 0.2
+        assert results == ["sent"]
+
+    asyncio.run(run())
+
+
+def test_retry_after_pauses_only_the_chat(monkeypatch):
+    monkeypatch.setenv("PTB_TIMEDELTA", "true")
+
+    async def run():
+        outbox = _outbox()
+        sent = []
+
+        async def rate_limited():
+            if not sent:
+                sent.append("rate limited")
+                raise RetryAfter(timedelta(seconds=1))
+            sent.append("retried")
+
+        async def other_chat():
+            sent.append("other chat")
+
+        outbox.submit(_chat(1), rate_limited, priority=Priority.REPLY)
+        outbox.submit(_chat(2), other_chat, priority=Priority.NOTICE)
+        outbox.start()
+        await outbox.close()
+
+        assert sent == ["rate limited", "other chat", "retried"]
+
+    asyncio.run(run())
+
+
+def test_send_returns_result_and_raises_errors():
+    async def run():
+        outbox = _outbox()
+        outbox.start()
+
+        async def succeed():
+            return "sent"
+
+        async def fail():
+            raise BadRequest("Message to edit not found")
+
+        assert await outbox.send(_chat(1), succeed, priority=Priority.REPLY) == "sent"
+        with pytest.raises(BadRequest):
+            await outbox.send(_chat(1), fail, priority=Priority.REPLY)
+        await outbox.close()
+
+    asyncio.run(run())
+
+
+def test_send_is_dropped_if_caller_stops_waiting():
+    async def run():
+        outbox = _outbox()
+        sent = []
+
+        async def send():
+            sent.append(1)
+
+        waiter = asyncio.create_task(
+            outbox.send(_chat(1), send, priority=Priority.REPLY)
+        )
+        await asyncio.sleep(0)
+        waiter.cancel()
+        outbox.start()
+        await outbox.close()
+
+        assert not sent
+
+    asyncio.run(run())
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from bot.config import ProfilingConfig
+from bot.profiling import LoopLagMonitor, SamplingProfiler
+
+
+def _config() -> ProfilingConfig:
+    return ProfilingConfig(
+        stall_threshold=timedelta(milliseconds=100),
+        sample_interval=timedelta(milliseconds=5),
+        max_duration=timedelta(seconds=10),
+    )
+
+
+def _block_event_loop() -> None:
+    time.sleep(0.4)
+
+
+def test_reports_blocked_loop_once(caplog):
+    async def run():
+        monitor = LoopLagMonitor(_config())
+        monitor.start()
+        await asyncio.sleep(0.2)
+        _block_event_loop()
+        await asyncio.sleep(0.2)
+        await monitor.close()
+
+    with caplog.at_level(logging.WARNING, logger="bot.profiling"):
+        asyncio.run(run())
+
+    [record] = caplog.records
+    assert record.getMessage().startswith("Event loop blocked for at least")
+    assert "_block_event_loop" in record.getMessage()
+
+
+def test_short_lag_is_not_reported(caplog):
+    async def run():
+        monitor = LoopLagMonitor(_config())
+        monitor.start()
+        await asyncio.sleep(0.1)
+        time.sleep(0.02)
+        await asyncio.sleep(0.2)
+        await monitor.close()
+
+    with caplog.at_level(logging.WARNING, logger="bot.profiling"):
+        asyncio.run(run())
+
+    assert caplog.records == []
+
+
+def _busy_worker(stopped: threading.Event) -> None:
+    while not stopped.wait(0.001):
+        pass
+
+
+def test_profile_collapses_stacks_of_other_threads():
+    async def run():
+        profiler = SamplingProfiler(_config())
+        stopped = threading.Event()
+        worker = threading.Thread(
+            target=_busy_worker,
+            args=(stopped,),
+            name="busy",
+        )
+        worker.start()
+        try:
+            profiling = asyncio.create_task(
+                profiler.profile(timedelta(milliseconds=100))
+            )
+            await asyncio.sleep(0)
+            assert profiler.is_running
+            stacks = await profiling
+        finally:
+            stopped.set()
+            worker.join()
+
+        assert not profiler.is_running
+        busy = [line for line in stacks.splitlines() if line.startswith("busy;")]
+        assert busy
+        assert all("_busy_worker (profiling_test.py)" in line for line in busy)
+
+    asyncio.run(run())
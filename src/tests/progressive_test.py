@@ -0,0 +1,141 @@
+import asyncio
+
+from telegram import Chat
+from telegram.constants import ChatType
+from telegram.error import BadRequest
+
+from bot.config import OutboxConfig
+from bot.outbox import Outbox
+from bot.progressive import ProgressiveReply
+
+
+class _FakeMessage:
+    def __init__(self, text: str = "") -> None:
+        self.chat = Chat(id=1, type=ChatType.PRIVATE)
+        self.text = text
+        self.replies = []
+        self.is_deleted = False
+        self.edit_error = None
+
+    async def reply_text(self, text, disable_notification=False):
+        reply = _FakeMessage(text)
+        self.replies.append(reply)
+        return reply
+
+    async def edit_text(self, text):
+        if self.is_deleted:
+            raise BadRequest("Message to edit not found")
+        if self.edit_error is not None:
+            raise self.edit_error
+        self.text = text
+
+    async def delete(self):
+        if self.is_deleted:
+            raise BadRequest("Message to delete not found")
+        self.is_deleted = True
+
+
+def _split_chunks(text: str) -> list[str]:
+    return [text[start : start + 10] for start in range(0, len(text), 10)]
+
+
+def _outbox() -> Outbox:
+    outbox = Outbox(
+        OutboxConfig(
+            global_rate=30,
+            private_chat_rate=600,
+            group_chat_rate=600,
+            max_concurrent_sends=4,
+        )
+    )
+    outbox.start()
+    return outbox
+
+
+async def _started_reply(
+    message: _FakeMessage,
+    phrase: str,
+    *,
+    outbox: Outbox,
+) -> ProgressiveReply:
+    reply = ProgressiveReply(
+        message,
+        outbox=outbox,
+        split_chunks=_split_chunks,
+        transform=str.upper,
+    )
+    reply.add_phrase(phrase)
+    while not reply.has_replied:
+        await asyncio.sleep(0.001)
+    return reply
+
+
+def test_finish_replaces_interim_text():
+    async def run():
+        outbox = _outbox()
+        message = _FakeMessage()
+        reply = await _started_reply(message, "hallo welt", outbox=outbox)
+        assert [r.text for r in message.replies] == ["HALLO WELT", " …"]
+
+        first_reply = await reply.finish("Hallo Welt")
+        await outbox.close()
+
+        assert first_reply is message.replies[0]
+        assert first_reply.text == "Hallo Welt"
+        # The chunk that only held the suffix isn't needed anymore
+        assert message.replies[1].is_deleted
+
+    asyncio.run(run())
+
+
+def test_finish_ignores_unmodified_message():
+    async def run():
+        outbox = _outbox()
+        message = _FakeMessage()
+        reply = await _started_reply(message, "hallo", outbox=outbox)
+        message.replies[0].edit_error = BadRequest("Message is not modified")
+
+        assert await reply.finish("Hallo") is message.replies[0]
+        await outbox.close()
+
+    asyncio.run(run())
+
+
+def test_finish_gives_up_if_reply_was_deleted():
+    async def run():
+        outbox = _outbox()
+        message = _FakeMessage()
+        reply = await _started_reply(message, "hallo welt, wie geht es", outbox=outbox)
+        first, *others = message.replies
+        first.is_deleted = True
+
+        assert await reply.finish("Hallo Welt, wie geht es?") is None
+        await outbox.close()
+
+        # Nothing partial is left for the caller's new reply
+        assert all(other.is_deleted for other in others)
+        assert not reply.has_replied
+
+    asyncio.run(run())
+
+
+def test_cancelling_keeps_sent_reply():
+    async def run():
+        outbox = _outbox()
+        message = _FakeMessage()
+        reply = ProgressiveReply(
+            message,
+            outbox=outbox,
+            split_chunks=_split_chunks,
+            transform=str.upper,
+        )
+        reply.add_phrase("hallo")
+        # The reply is still on its way
+        await asyncio.sleep(0)
+        await reply.cancel()
+        await outbox.close()
+
+        assert len(message.replies) == 1
+        assert reply.has_replied
+
+    asyncio.run(run())
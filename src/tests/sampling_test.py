@@ -0,0 +1,99 @@
+from datetime import timedelta
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+    InMemorySpanExporter,
+)
+from opentelemetry.trace import Status, StatusCode
+
+from bot import sampling
+from bot.sampling import (
+    RatioOrRecordSampler,
+    TailSamplingSpanProcessor,
+    set_deferred_attributes,
+)
+
+
+def _tracer(max_traces: int = 8, ratio: float = 0):
+    exporter = InMemorySpanExporter()
+    processor = TailSamplingSpanProcessor(
+        exporter,
+        slow_threshold=timedelta(seconds=10),
+        max_traces=max_traces,
+    )
+    provider = TracerProvider(sampler=RatioOrRecordSampler(ratio))
+    provider.add_span_processor(processor)
+    return provider.get_tracer(__name__), processor, exporter
+
+
+def test_failed_trace_is_kept():
+    tracer, processor, exporter = _tracer()
+    with tracer.start_as_current_span("root"):
+        with tracer.start_as_current_span("child") as child:
+            child.set_status(Status(StatusCode.ERROR))
+
+    processor.force_flush()
+    assert [span.name for span in exporter.get_finished_spans()] == ["child", "root"]
+
+
+def test_unremarkable_trace_is_dropped():
+    tracer, processor, exporter = _tracer()
+    with tracer.start_as_current_span("root"):
+        with tracer.start_as_current_span("child"):
+            pass
+
+    processor.force_flush()
+    assert not exporter.get_finished_spans()
+    assert not processor._traces
+
+
+def test_spans_ending_after_root_are_dropped():
+    tracer, processor, exporter = _tracer(max_traces=1)
+    with tracer.start_as_current_span("root"):
+        late = tracer.start_span("background")
+
+    late.set_status(Status(StatusCode.ERROR))
+    late.end()
+
+    # The late span doesn't start a new buffer that evicts other traces
+    assert not processor._traces
+    with tracer.start_as_current_span("other root"):
+        with tracer.start_as_current_span("child") as child:
+            child.set_status(Status(StatusCode.ERROR))
+
+    processor.force_flush()
+    assert [span.name for span in exporter.get_finished_spans()] == [
+        "child",
+        "other root",
+    ]
+
+
+def test_deferred_attributes_are_only_computed_for_kept_traces():
+    tracer, processor, exporter = _tracer()
+    computed = []
+
+    def compute():
+        computed.append(1)
+        return {"telegram.update_id": 1}
+
+    with tracer.start_as_current_span("unremarkable") as span:
+        set_deferred_attributes(span, compute)
+    with tracer.start_as_current_span("failed") as span:
+        set_deferred_attributes(span, compute)
+        span.set_status(Status(StatusCode.ERROR))
+
+    processor.force_flush()
+    [exported] = exporter.get_finished_spans()
+    assert exported.name == "failed"
+    assert exported.attributes["telegram.update_id"] == 1
+    assert len(computed) == 1
+    assert not sampling._deferred_attributes
+
+
+def test_deferred_attributes_are_set_on_sampled_spans_right_away():
+    tracer, _, _ = _tracer(ratio=1)
+    with tracer.start_as_current_span("sampled") as span:
+        set_deferred_attributes(span, lambda: {"telegram.update_id": 1})
+        assert span.attributes["telegram.update_id"] == 1
+
+    assert not sampling._deferred_attributes
@@ -0,0 +1,163 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+from bot.config import OverflowPolicy, SchedulerConfig
+from bot.scheduler import JobDeadlineExceededError, JobScheduler
+
+
+def _scheduler(
+    *,
+    workers: int = 1,
+    transcription_workers: int = 1,
+    queue_size: int = 0,
+    overflow_policy: OverflowPolicy = OverflowPolicy.QUEUE,
+    deadline: timedelta = timedelta(seconds=60),
+) -> JobScheduler:
+    return JobScheduler(
+        SchedulerConfig(
+            download_workers=workers,
+            conversion_workers=workers,
+            transcription_workers=transcription_workers,
+            queue_size=queue_size,
+            overflow_policy=overflow_policy,
+            deadline_base=deadline,
+            deadline_audio_percent=0,
+        )
+    )
+
+
+def test_reject_policy_rejects_when_workers_are_busy():
+    async def run():
+        scheduler = _scheduler(
+            queue_size=4,
+            overflow_policy=OverflowPolicy.REJECT,
+        )
+        async with scheduler.job(audio_seconds=1) as first:
+            assert first is not None
+            assert not first.queued
+            async with scheduler.job(audio_seconds=1) as second:
+                assert second is None
+
+    asyncio.run(run())
+
+
+def test_queue_policy_rejects_when_queue_is_full():
+    async def run():
+        scheduler = _scheduler(queue_size=1)
+        async with scheduler.job(audio_seconds=1) as first:
+            async with scheduler.job(audio_seconds=1) as second:
+                async with scheduler.job(audio_seconds=1) as third:
+                    assert first is not None and not first.queued
+                    assert second is not None and second.queued
+                    assert third is None
+
+        # Everything is released again
+        async with scheduler.job(audio_seconds=1) as job:
+            assert job is not None and not job.queued
+
+    asyncio.run(run())
+
+
+def test_deadline_cancels_job():
+    async def run():
+        scheduler = _scheduler(deadline=timedelta(milliseconds=50))
+        with pytest.raises(JobDeadlineExceededError):
+            async with scheduler.job(audio_seconds=10) as job:
+                assert job is not None
+                async with job.stage(scheduler.download):
+                    await asyncio.sleep(1)
+
+        assert scheduler.download.reservations == 0
+        assert scheduler.conversion.reservations == 0
+
+    asyncio.run(run())
+
+
+def test_deadline_grows_with_audio_duration():
+    scheduler = JobScheduler(
+        SchedulerConfig(
+            download_workers=1,
+            conversion_workers=1,
+            transcription_workers=1,
+            queue_size=0,
+            overflow_policy=OverflowPolicy.QUEUE,
+            deadline_base=timedelta(seconds=60),
+            deadline_audio_percent=200,
+        )
+    )
+    assert scheduler.deadline(30) == 120
+
+
+def test_stage_workers_are_bounded():
+    async def run():
+        scheduler = _scheduler(workers=4, transcription_workers=2, queue_size=8)
+        active = 0
+        max_active = 0
+
+        async def transcribe() -> None:
+            nonlocal active, max_active
+            async with scheduler.job(audio_seconds=1) as job:
+                assert job is not None
+                async with job.stage(scheduler.download):
+                    pass
+                async with job.stage(scheduler.conversion):
+                    pass
+                async with job.stage(scheduler.transcription):
+                    active += 1
+                    max_active = max(max_active, active)
+                    await asyncio.sleep(0.01)
+                    active -= 1
+
+        await asyncio.gather(*(transcribe() for _ in range(8)))
+        assert max_active == 2
+
+    asyncio.run(run())
+
+
+def test_skipped_stage_releases_reservation():
+    async def run():
+        scheduler = _scheduler()
+        async with scheduler.job(audio_seconds=1) as job:
+            assert job is not None
+            async with job.stage(scheduler.download):
+                pass
+            # Leaving a stage reserves a place in the next one
+            assert scheduler.conversion.reservations == 1
+            job.skip(scheduler.conversion)
+            assert scheduler.conversion.reservations == 0
+            async with job.stage(scheduler.transcription):
+                assert scheduler.transcription.reservations == 1
+
+        assert scheduler.transcription.reservations == 0
+        assert set(job.worker_seconds) == {"download", "transcription"}
+
+    asyncio.run(run())
+
+
+def test_additional_workers_count_against_the_limit():
+    async def run():
+        scheduler = _scheduler(transcription_workers=2)
+        stage = scheduler.transcription
+        borrowed = asyncio.Event()
+
+        async def borrow() -> None:
+            async with stage.additional_worker():
+                borrowed.set()
+
+        async with scheduler.job(audio_seconds=1) as job:
+            assert job is not None
+            job.skip(scheduler.download)
+            job.skip(scheduler.conversion)
+            async with job.stage(stage):
+                async with stage.additional_worker():
+                    borrowing = asyncio.create_task(borrow())
+                    await asyncio.sleep(0.01)
+                    # Both workers are taken by the job
+                    assert not borrowed.is_set()
+                    assert stage.queue_depth == 1
+
+                await asyncio.wait_for(borrowing, 1)
+
+    asyncio.run(run())
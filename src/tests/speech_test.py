@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from datetime import timedelta
+
+from bot import speech
+from bot.config import RecognizerPoolConfig
+from bot.speech import AzureRecognitionBackend
+
+
+class _FakeSignal:
+    def __init__(self) -> None:
+        self.callbacks = []
+
+    def connect(self, callback) -> None:
+        self.callbacks.append(callback)
+
+    def disconnect_all(self) -> None:
+        self.callbacks = []
+
+
+class _FakeFuture:
+    def __init__(self, release: threading.Event | None = None) -> None:
+        self.release = release
+        self.thread_name = None
+
+    def get(self) -> None:
+        self.thread_name = threading.current_thread().name
+        if self.release is not None:
+            self.release.wait()
+
+
+class _FakeRecognizer:
+    """Stops the session right away, but never confirms stopping."""
+
+    def __init__(self, release_stop: threading.Event) -> None:
+        self.recognized = _FakeSignal()
+        self.session_stopped = _FakeSignal()
+        self.canceled = _FakeSignal()
+        self.speech_end_detected = _FakeSignal()
+        self.stop = _FakeFuture(release_stop)
+
+    def start_continuous_recognition_async(self) -> _FakeFuture:
+        for callback in self.session_stopped.callbacks:
+            callback(None)
+        return _FakeFuture()
+
+    def stop_continuous_recognition_async(self) -> _FakeFuture:
+        return self.stop
+
+
+def test_hanging_stop_does_not_block_default_executor(monkeypatch):
+    monkeypatch.setattr(speech, "_STOP_TIMEOUT", timedelta(milliseconds=50))
+
+    async def run():
+        backend = AzureRecognitionBackend(
+            region="test",
+            key="unused",
+            weight=100,
+            pool_config=RecognizerPoolConfig(
+                size=0,
+                idle_timeout=timedelta(minutes=2),
+                formats=[],
+                locales=[],
+            ),
+        )
+        release_stop = threading.Event()
+        recognizer = _FakeRecognizer(release_stop)
+        try:
+            result = await backend._recognize(
+                recognizer,
+                on_phrase=None,
+                on_language=None,
+            )
+        finally:
+            release_stop.set()
+            await backend.close()
+
+        assert result is None
+        assert recognizer.stop.thread_name.startswith("speech-sdk-test")
+        assert not recognizer.session_stopped.callbacks
+
+    asyncio.run(run())
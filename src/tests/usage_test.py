@@ -0,0 +1,216 @@
+import asyncio
+from datetime import UTC, datetime, timedelta
+
+from rate_limiter import RateLimitingRepo, Usage
+from telegram import Chat, Message, User
+from telegram.constants import ChatType
+
+from bot import usage
+from bot.config import RateLimitConfig
+from bot.usage import UsageTracker
+
+_NOW = datetime(2024, 5, 1, 12, tzinfo=UTC)
+
+
+class _CountingRepo(RateLimitingRepo):
+    def __init__(self) -> None:
+        self.usages = []
+        self.loads = 0
+        self.loading = asyncio.Event()
+        self.load_released = asyncio.Event()
+        self.load_released.set()
+
+    async def get_usages(self, context_id, user_id, limit=1):
+        self.loads += 1
+        self.loading.set()
+        await self.load_released.wait()
+        usages = [
+            usage
+            for usage in self.usages
+            if usage.context_id == context_id and usage.user_id == user_id
+        ]
+        usages.sort(key=lambda usage: usage.time, reverse=True)
+        return usages[:limit]
+
+    async def add_usage(
+        self,
+        context_id,
+        user_id,
+        utc_time,
+        reference_id=None,
+        response_id=None,
+    ):
+        usage = Usage(
+            context_id=context_id,
+            user_id=user_id,
+            time=utc_time,
+            reference_id=reference_id,
+            response_id=response_id,
+        )
+        self.usages.append(usage)
+        return usage
+
+    async def delete_old_usages(self, retention_time):
+        pass
+
+    async def close(self):
+        pass
+
+
+def _message(message_id: int, *, user_id: int = 1) -> Message:
+    return Message(
+        message_id=message_id,
+        date=_NOW,
+        chat=Chat(id=user_id, type=ChatType.PRIVATE),
+        from_user=User(id=user_id, first_name="Test", is_bot=False),
+    )
+
+
+def _tracker(repo: _CountingRepo, *, daily: int = 2) -> UsageTracker:
+    tracker = UsageTracker(repo, RateLimitConfig(daily=daily))
+    tracker.start()
+    return tracker
+
+
+async def _is_rate_limited(
+    tracker: UsageTracker,
+    *,
+    user_id: int = 1,
+    file: str = "file",
+    locale: str | None = None,
+) -> bool:
+    return await tracker.is_rate_limited(
+        user_id=user_id,
+        at_time=_NOW,
+        unique_file_id=file,
+        locale=locale,
+    )
+
+
+async def _track(
+    tracker: UsageTracker,
+    message_id: int,
+    *,
+    file: str = "file",
+    locale: str | None = None,
+) -> None:
+    await tracker.track(
+        _message(message_id),
+        unique_file_id=file,
+        response_id=message_id + 1,
+        locale=locale,
+    )
+
+
+def test_loads_daily_usages_once(monkeypatch):
+    monkeypatch.setattr(usage, "_FLUSH_INTERVAL", timedelta(milliseconds=10))
+
+    async def run():
+        repo = _CountingRepo()
+        await repo.add_usage("", 1, _NOW - timedelta(days=1))
+        await repo.add_usage("", 1, _NOW - timedelta(hours=1))
+        tracker = _tracker(repo)
+
+        # Yesterday's usage doesn't count
+        assert not await _is_rate_limited(tracker)
+        await _track(tracker, 1)
+        assert await _is_rate_limited(tracker)
+        await tracker.close()
+
+        assert repo.loads == 1
+        assert len(repo.usages) == 3
+
+    asyncio.run(run())
+
+
+def test_usage_flushed_during_load_is_counted_once(monkeypatch):
+    monkeypatch.setattr(usage, "_FLUSH_INTERVAL", timedelta(milliseconds=10))
+
+    async def run():
+        repo = _CountingRepo()
+        repo.load_released.clear()
+        tracker = _tracker(repo)
+
+        loading = asyncio.create_task(_is_rate_limited(tracker))
+        await repo.loading.wait()
+        await _track(tracker, 1)
+        while not repo.usages:
+            await asyncio.sleep(0.01)
+        repo.load_released.set()
+
+        # The load returns the flushed usage that is already tracked
+        assert not await loading
+        assert not await _is_rate_limited(tracker)
+        await tracker.close()
+
+    asyncio.run(run())
+
+
+def test_waits_for_load_after_tracking(monkeypatch):
+    monkeypatch.setattr(usage, "_FLUSH_INTERVAL", timedelta(milliseconds=10))
+
+    async def run():
+        repo = _CountingRepo()
+        await repo.add_usage("", 1, _NOW - timedelta(hours=1))
+        repo.load_released.clear()
+        tracker = _tracker(repo)
+
+        loading = asyncio.create_task(_is_rate_limited(tracker))
+        await repo.loading.wait()
+        await _track(tracker, 1)
+        # Known locally, but the usage in the repo isn't loaded yet
+        checking = asyncio.create_task(_is_rate_limited(tracker))
+        await asyncio.sleep(0.01)
+        repo.load_released.set()
+
+        assert await loading
+        assert await checking
+        assert repo.loads == 1
+        await tracker.close()
+
+    asyncio.run(run())
+
+
+def test_close_writes_pending_usages(monkeypatch):
+    monkeypatch.setattr(usage, "_FLUSH_INTERVAL", timedelta(milliseconds=10))
+
+    async def run():
+        repo = _CountingRepo()
+        tracker = _tracker(repo)
+        await _track(tracker, 1)
+        await _track(tracker, 2, locale="en-US")
+        assert repo.usages == []
+
+        await tracker.close()
+
+        assert [usage.context_id for usage in repo.usages] == [
+            "",
+            "relocalize-file-en-US",
+        ]
+        assert [usage.response_id for usage in repo.usages] == ["2", "3"]
+
+    asyncio.run(run())
+
+
+def test_forgotten_relocalizations_are_loaded_again(monkeypatch):
+    monkeypatch.setattr(usage, "_FLUSH_INTERVAL", timedelta(milliseconds=10))
+    monkeypatch.setattr(usage, "_MAX_RELOCALIZATIONS", 2)
+
+    async def run():
+        repo = _CountingRepo()
+        tracker = _tracker(repo, daily=10)
+        for index, file in enumerate(("a", "b", "c")):
+            await _track(tracker, index, file=file, locale="en-US")
+        while len(repo.usages) < 3:
+            await asyncio.sleep(0.01)
+
+        # Still remembered
+        assert await _is_rate_limited(tracker, file="c", locale="en-US")
+        assert repo.loads == 1
+        # The least recently used one was forgotten, but is still in the repo
+        assert await _is_rate_limited(tracker, file="a", locale="en-US")
+        assert repo.loads == 2
+        assert not await _is_rate_limited(tracker, file="a", locale="de-DE")
+        await tracker.close()
+
+    asyncio.run(run())